@@ -0,0 +1,78 @@
+'''Read cost of a year of events before and after compaction.
+
+Seeds one user with a year of synthetic events, reads the whole year with
+`archive.fetch_events`, compacts everything older than a month and reads
+the year again, counting the billed document reads of each:
+
+    python -m server.bench_archive --visits-per-day 12 --backend sqlite
+'''
+import argparse
+import os
+import random
+import tempfile
+from time import perf_counter
+
+from .utils import archive, metrics, schemas
+from .utils.storage import MemoryClient, SqliteClient
+
+DAY = 24 * 60 * 60
+YEAR_START = 1704067200 # 2024-01-01 UTC
+
+def seed(db, user_id: str, visits_per_day: int, days: int, seed_value: int) -> int:
+    rng = random.Random(seed_value)
+    batch, size, count = db.batch(), 0, 0
+    for day in range(days):
+        for _ in range(visits_per_day):
+            created = YEAR_START + day * DAY + rng.randrange(DAY)
+            event = schemas.Event(
+                eventId=f"event-{count:07d}",
+                userId=user_id,
+                locationId=f"location-{rng.randrange(20):02d}",
+                createdAt=created,
+                updatedAt=created + int(rng.expovariate(1 / 3600)),
+            )
+            batch.set(db.collection("Events").document(event.eventId), event.model_dump())
+            size += 1
+            count += 1
+            if size == 500:
+                batch.commit()
+                batch, size = db.batch(), 0
+    batch.commit()
+    return count
+
+def read_year(db, user_id: str, end: int):
+    reads = metrics.registry.rpcs['reads']
+    start = perf_counter()
+    events = archive.fetch_events(db, user_id, end - 365 * DAY, end)
+    return events, metrics.registry.rpcs['reads'] - reads, perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--visits-per-day', type=int, default=12)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--backend', choices=('memory', 'sqlite'), default='memory')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.backend == 'sqlite':
+            target = SqliteClient(os.path.join(directory, 'bench.sqlite3'))
+        else:
+            target = MemoryClient()
+        db = metrics.instrument(target)
+        user_id = 'user-000001'
+        count = seed(db, user_id, args.visits_per_day, args.days, args.seed)
+        now = YEAR_START + args.days * DAY
+
+        before, before_reads, before_seconds = read_year(db, user_id, now)
+        start = perf_counter()
+        archived = archive.compact(db, max_age_days=30, user_id=user_id, now=now)
+        compact_seconds = perf_counter() - start
+        after, after_reads, after_seconds = read_year(db, user_id, now)
+        assert [event.model_dump() for event in after] == [event.model_dump() for event in before]
+
+        print(f"{count} events over {args.days} days, {args.backend} backend")
+        print(f"{'read a year, all hot':<34}{before_reads:>8} reads{before_seconds * 1000:>10.1f} ms")
+        print(f"{'compact (older than 30 days)':<34}{archived:>8} events{compact_seconds * 1000:>9.1f} ms")
+        print(f"{'read a year, archived':<34}{after_reads:>8} reads{after_seconds * 1000:>10.1f} ms")
+        target.close()
@@ -0,0 +1,152 @@
+'''Authentication cost per request.
+
+Mints Firebase style ID tokens signed with a throwaway RSA key and checks
+them with `utils.verify_firebase_token`, which runs the real firebase_admin
+verifier. Only the download of the public signing keys is answered locally,
+with the `Cache-Control: max-age` the real endpoint sends, so the keys go
+through firebase_admin's caching session and the script also counts how
+often they are fetched. Times tokens seen for the first time (key lookup,
+signature check, claims and model), the bare signature check, and repeats
+answered by `token_cache`:
+
+    python -m server.bench_auth --tokens 1000
+'''
+import argparse
+import http.client
+import json
+from io import BytesIO
+import timeit
+from datetime import datetime, timedelta, timezone
+from email.utils import formatdate
+from os import environ as env
+from time import time
+from typing import Dict, List
+
+import urllib3
+from cachecontrol.adapter import CacheControlAdapter
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from firebase_admin import auth, credentials, initialize_app
+from firebase_admin._token_gen import ID_TOKEN_CERT_URI, ID_TOKEN_ISSUER_PREFIX
+from google.auth import crypt, jwt
+from requests.adapters import HTTPAdapter
+
+env.setdefault('WHEREABOUT_STORAGE', 'memory')
+
+from .utils import utils
+
+PROJECT_ID = 'whereabout-bench'
+KEY_ID = 'bench-key'
+
+class MemorySocket:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def makefile(self, mode: str) -> BytesIO:
+        return BytesIO(self.data)
+
+class CertsAdapter(HTTPAdapter):
+    '''Answers the signing key download in process, counting the fetches.
+    '''
+    body = b'{}'
+    fetches = 0
+
+    def send(self, request, *args, **kwargs):
+        self.fetches += 1
+        # Freshness is judged from Date and max-age, like Google's response
+        head = '\r\n'.join([
+            'HTTP/1.1 200 OK',
+            'Content-Type: application/json',
+            'Cache-Control: public, max-age=21600',
+            f"Date: {formatdate(usegmt=True)}",
+            f"Content-Length: {len(self.body)}",
+        ])
+        # An http.client response releases its file at the end of the body, which is when it is cached
+        raw = http.client.HTTPResponse(MemorySocket(head.encode('latin-1') + b'\r\n\r\n' + self.body))
+        raw.begin()
+        response = urllib3.HTTPResponse(body=raw, headers=dict(raw.getheaders()), status=raw.status, preload_content=False, original_response=raw)
+        return self.build_response(request, response)
+
+class CachingCertsAdapter(CacheControlAdapter, CertsAdapter):
+    '''The caching adapter firebase_admin mounts, with `CertsAdapter` in place of the network.
+    '''
+
+    def __init__(self, certs: Dict[str, str], cache):
+        super().__init__(cache=cache)
+        self.body = json.dumps(certs).encode('utf8')
+
+def make_key():
+    '''Signing key with a self-signed certificate, like the ones Google publishes.
+    '''
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, KEY_ID)])
+    now = datetime.now(timezone.utc)
+    certificate = x509.CertificateBuilder()\
+        .subject_name(name)\
+        .issuer_name(name)\
+        .public_key(key.public_key())\
+        .serial_number(x509.random_serial_number())\
+        .not_valid_before(now - timedelta(days=1))\
+        .not_valid_after(now + timedelta(days=1))\
+        .sign(key, hashes.SHA256())
+    private_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode('utf8')
+    return private_pem, certificate.public_bytes(serialization.Encoding.PEM).decode('utf8')
+
+def mint_tokens(private_pem: str, count: int) -> List[str]:
+    signer = crypt.RSASigner.from_string(private_pem, key_id=KEY_ID)
+    now = int(time())
+    return [
+        jwt.encode(signer, {
+            'iss': ID_TOKEN_ISSUER_PREFIX + PROJECT_ID,
+            'aud': PROJECT_ID,
+            'auth_time': now,
+            'user_id': f"user-{index:06d}",
+            'sub': f"user-{index:06d}",
+            'iat': now,
+            'exp': now + 3600,
+            'email': f"user-{index:06d}@example.com",
+            'email_verified': True,
+        }).decode('utf8')
+        for index in range(count)
+    ]
+
+def install(private_pem: str, certificate_pem: str) -> CertsAdapter:
+    '''Register the default app for the bench project and serve its keys locally.
+    '''
+    app = initialize_app(credentials.Certificate({
+        'type': 'service_account',
+        'project_id': PROJECT_ID,
+        'private_key': private_pem,
+        'client_email': f"bench@{PROJECT_ID}.iam.gserviceaccount.com",
+        'token_uri': 'https://oauth2.googleapis.com/token',
+    }))
+    session = auth._get_client(app)._token_verifier.request.session
+    adapter = CachingCertsAdapter({KEY_ID: certificate_pem}, session.get_adapter(ID_TOKEN_CERT_URI).cache)
+    session.mount(ID_TOKEN_CERT_URI, adapter)
+    return adapter
+
+def measure(name: str, fn, number: int):
+    seconds = timeit.timeit(fn, number=number) / number
+    print(f"{name:<36}{seconds * 1e6:>10.1f} us{1 / seconds:>12.0f} req/s")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tokens', type=int, default=1000, help='distinct tokens, each verified once cold')
+    args = parser.parse_args()
+    if utils.LOCAL_AUTH:
+        parser.error("unset WHEREABOUT_LOCAL_AUTH, it skips verification")
+
+    private_pem, certificate_pem = make_key()
+    adapter = install(private_pem, certificate_pem)
+    tokens = mint_tokens(private_pem, args.tokens)
+    cold = iter(tokens)
+    # Warms the key cache, and checks that the tokens verify at all
+    assert utils.verify_firebase_token(tokens[-1]).uid == f"user-{args.tokens - 1:06d}"
+
+    print(f"{args.tokens} tokens, RS256 with a 2048 bit key")
+    measure('new token, verified', lambda: utils.verify_firebase_token(next(cold)), args.tokens - 1)
+    measure('  of which the signature check', lambda: jwt.decode(tokens[0], certs={KEY_ID: certificate_pem}, audience=PROJECT_ID), args.tokens)
+    measure('repeat token, token_cache', lambda: utils.verify_firebase_token(tokens[0]), args.tokens * 10)
+    print(f"signing keys fetched {adapter.fetches} time(s), token cache {utils.token_cache.stats()}")
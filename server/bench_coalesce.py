@@ -0,0 +1,56 @@
+'''Firestore reads saved by coalescing bursts of identical requests.
+
+Every user fires the same feed, locations and profile requests several
+times at once, like app screens mounting together after a reconnect. The
+burst runs in-process on the memory backend with coalescing off and on:
+
+    python -m server.bench_coalesce --users 100 --burst 5
+'''
+import argparse
+import asyncio
+import random
+from os import environ as env
+from time import perf_counter
+
+env.setdefault('WHEREABOUT_STORAGE', 'memory')
+env.setdefault('WHEREABOUT_LOCAL_AUTH', '1')
+# Every request of a burst is slow on purpose
+env.setdefault('SLOW_REQUEST_SECONDS', '60')
+
+from . import main
+from .loadtest import auth, make_client, seed
+from .utils import cache, metrics
+
+async def burst(client, user_ids, size: int):
+    requests = []
+    for user_id in user_ids:
+        for _ in range(size):
+            requests.append(client.get('/api/feed', headers=auth(user_id)))
+            requests.append(client.get('/api/locations', headers=auth(user_id)))
+            requests.append(client.get(f"/api/users/{user_id}", headers=auth(user_id)))
+    responses = await asyncio.gather(*requests)
+    assert all(response.status_code == 200 for response in responses)
+    return len(responses)
+
+async def run(num_users: int, num_friends: int, size: int):
+    client = make_client('')
+    user_ids = list(await seed(client, num_users, num_friends, random.Random(0)))
+    print(f"{num_users} users, bursts of {size} identical requests per endpoint")
+    print(f"{'coalescing':<12}{'requests':>10}{'reads':>10}{'rpcs':>10}{'seconds':>10}")
+    for enabled in (False, True):
+        main.reads.enabled = enabled
+        cache.model_cache.clear()
+        reads, rpcs = metrics.registry.rpcs['reads'], metrics.registry.rpcs['rpcs']
+        start = perf_counter()
+        count = await burst(client, user_ids, size)
+        elapsed = perf_counter() - start
+        print(f"{'on' if enabled else 'off':<12}{count:>10}{metrics.registry.rpcs['reads'] - reads:>10}{metrics.registry.rpcs['rpcs'] - rpcs:>10}{elapsed:>10.2f}")
+    print(f"coalesced {main.reads.coalesced} of {count} requests with coalescing on")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--friends', type=int, default=20)
+    parser.add_argument('--burst', type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.friends, args.burst))
@@ -0,0 +1,115 @@
+'''Round trips and latency of building one feed page.
+
+Seeds a user with friends, each with a latest event, on the memory backend
+with a fixed delay per round trip, like a Firestore emulator or a remote
+project. Builds the page with the original serial lookups (the relations
+query, then per friend a `Users` get, an `Events` query and a `Locations`
+get) and with `feed.build_feed`, counting the RPCs of each:
+
+    python -m server.bench_feed --friends 50 --latency 0.01
+'''
+import argparse
+import threading
+from time import perf_counter, sleep
+from typing import List
+
+from firebase_admin import firestore
+
+from .utils import feed, metrics, schemas
+from .utils.friends import friend_list_ref, relation_ref
+from .utils.latest_events import latest_event_ref
+from .utils.storage import MemoryClient
+
+class SlowMemoryClient(MemoryClient):
+    '''Memory backend sleeping once per round trip.
+    '''
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+        self._local = threading.local()
+
+    def _scan(self, collection: str):
+        sleep(self.latency)
+        return super()._scan(collection)
+
+    def _snapshot(self, reference, field_paths=None):
+        # Documents of a batched get arrive in its single round trip
+        if not getattr(self._local, 'batched', False):
+            sleep(self.latency)
+        return super()._snapshot(reference, field_paths)
+
+    def get_all(self, references, field_paths=None, transaction=None, **kwargs):
+        sleep(self.latency)
+        self._local.batched = True
+        try:
+            yield from super().get_all(references, field_paths=field_paths, transaction=transaction, **kwargs)
+        finally:
+            self._local.batched = False
+
+def seed(db, num_friends: int) -> str:
+    user_id = 'user-000000'
+    friend_ids = [f"friend-{index:06d}" for index in range(num_friends)]
+    for friend_id in friend_ids:
+        user = schemas.User(userId=friend_id, firstName='Ada', createdAt=0, updatedAt=0)
+        location = schemas.Location(locationId=f"location-{friend_id}", userId=friend_id, latitude=37.0, longitude=-122.0, width=0.002, height=0.002, tag='Home', createdAt=0, updatedAt=0)
+        event = schemas.Event(eventId=f"event-{friend_id}", userId=friend_id, locationId=location.locationId, createdAt=0, updatedAt=0)
+        db.collection("Users").document(friend_id).set(user.model_dump())
+        db.collection("Locations").document(location.locationId).set(location.model_dump())
+        db.collection("Events").document(event.eventId).set(event.model_dump())
+        latest_event_ref(db, friend_id).set(schemas.LatestEvent(userId=friend_id, event=event, location=location).model_dump())
+        relation = schemas.Relation(userId=user_id, recipientId=friend_id, relation=1, createdAt=0, updatedAt=0)
+        relation_ref(db, user_id, friend_id).set(relation.model_dump())
+    friend_list_ref(db, user_id).set(schemas.FriendList(userId=user_id, friendIds=friend_ids, updatedAt=0).model_dump())
+    return user_id
+
+def serial_feed(db, user_id: str) -> List[schemas.FeedItem]:
+    '''The feed as it was built before batching, one lookup after another.
+    '''
+    items: List[schemas.FeedItem] = []
+    relation_docs = db.collection("Relations")\
+        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
+        .stream()
+    for relation_doc in relation_docs:
+        friend_id = relation_doc.to_dict()['recipientId']
+        user_doc = db.collection("Users").document(friend_id).get()
+        event_docs = db.collection("Events")\
+            .where(filter=firestore.firestore.FieldFilter('userId', '==', friend_id))\
+            .order_by('updatedAt', direction=firestore.Query.DESCENDING)\
+            .limit(1)\
+            .get()
+        for event_doc in event_docs:
+            event = schemas.event_to_pydantic(event_doc, event_doc.id)
+            location_doc = db.collection("Locations").document(event.locationId).get()
+            if not location_doc.exists:
+                continue
+            items.append(schemas.FeedItem(
+                user=schemas.user_to_pydantic(user_doc),
+                event=event,
+                location=schemas.location_to_pydantic(location_doc, location_doc.id),
+            ))
+    return items
+
+def measure(name: str, fn, latency: float):
+    rpcs, reads = metrics.registry.rpcs['rpcs'], metrics.registry.rpcs['reads']
+    start = perf_counter()
+    items = fn()
+    elapsed = perf_counter() - start
+    rounds = elapsed / latency if latency > 0 else float('nan')
+    print(f"{name:<14}{len(items):>8}{metrics.registry.rpcs['rpcs'] - rpcs:>8}{metrics.registry.rpcs['reads'] - reads:>8}{rounds:>9.1f}{elapsed * 1000:>10.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--friends', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds per round trip')
+    args = parser.parse_args()
+
+    target = SlowMemoryClient(0)
+    db = metrics.instrument(target)
+    user_id = seed(db, args.friends)
+    target.latency = args.latency
+
+    print(f"{args.friends} friends, {args.latency * 1000:.0f} ms per round trip")
+    print(f"{'':<14}{'items':>8}{'rpcs':>8}{'reads':>8}{'rounds':>9}{'ms':>10}")
+    measure('serial', lambda: serial_feed(db, user_id), args.latency)
+    measure('build_feed', lambda: feed.build_feed(db, user_id, args.friends).items, args.latency)
@@ -0,0 +1,101 @@
+'''Cost of the friend list migration and of friend lookups before and after it.
+
+Seeds a synthetic friend graph on the memory backend as relations under
+auto-generated ids, the way they were stored before `FriendLists`, times
+`friends.migrate`, then lists the friends of sampled users and checks
+friendships with the old `Relations` queries and with the adjacency docs:
+
+    python -m server.bench_friends --users 10000 --degree 20 --samples 50
+'''
+import argparse
+import random
+from time import perf_counter
+from typing import Callable, List
+from uuid import uuid4
+
+from firebase_admin import firestore
+
+from .utils import friends, metrics, schemas
+from .utils.storage import MemoryClient
+
+def seed(db, num_users: int, degree: int, rng: random.Random) -> List[str]:
+    '''Random friendships with every user making `degree / 2` of them on average.
+    '''
+    user_ids = [f"user-{index:06d}" for index in range(num_users)]
+    pairs = set()
+    while len(pairs) < num_users * degree // 2:
+        user_id, friend_id = rng.sample(user_ids, 2)
+        pairs.add((min(user_id, friend_id), max(user_id, friend_id)))
+    batch, size = db.batch(), 0
+    for user_id, friend_id in pairs:
+        for owner_id, other_id in ((user_id, friend_id), (friend_id, user_id)):
+            relation = schemas.Relation(userId=owner_id, recipientId=other_id, relation=friends.RELATION_FRIEND, createdAt=0, updatedAt=0)
+            batch.set(db.collection("Relations").document(uuid4().hex), relation.model_dump(exclude={'relationId'}))
+            size += 1
+        if size >= friends.BATCH_SIZE - 1:
+            batch.commit()
+            batch, size = db.batch(), 0
+    batch.commit()
+    return user_ids
+
+def query_friend_ids(db, user_id: str) -> List[str]:
+    '''Friend ids the way they were listed before, with a relations query.
+    '''
+    relation_docs = db.collection("Relations")\
+        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
+        .where(filter=firestore.firestore.FieldFilter('relation', '==', friends.RELATION_FRIEND))\
+        .stream()
+    return sorted(relation_doc.to_dict()['recipientId'] for relation_doc in relation_docs)
+
+def query_are_friends(db, user_id: str, friend_id: str) -> bool:
+    relation_docs = db.collection("Relations")\
+        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
+        .where(filter=firestore.firestore.FieldFilter('recipientId', '==', friend_id))\
+        .limit(1)\
+        .get()
+    return len(relation_docs) > 0
+
+def measure(name: str, fn: Callable, samples: List) -> list:
+    rpcs, reads = metrics.registry.rpcs['rpcs'], metrics.registry.rpcs['reads']
+    start = perf_counter()
+    results = [fn(*sample) for sample in samples]
+    elapsed = perf_counter() - start
+    count = len(samples)
+    print(f"{name:<34}{(metrics.registry.rpcs['rpcs'] - rpcs) / count:>8.1f}{(metrics.registry.rpcs['reads'] - reads) / count:>8.1f}{elapsed / count * 1000:>10.3f}")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--degree', type=int, default=20, help='average friends per user')
+    parser.add_argument('--samples', type=int, default=50, help='users looked up; each relations query scans the whole memory collection')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    target = MemoryClient()
+    user_ids = seed(target, args.users, args.degree, rng)
+    db = metrics.instrument(target)
+
+    writes = metrics.registry.rpcs['writes']
+    start = perf_counter()
+    migrated = friends.migrate(db)
+    migrate_seconds = perf_counter() - start
+    print(f"{args.users} users, {args.users * args.degree} relations")
+    print(f"migrate: {migrated} friend lists, {metrics.registry.rpcs['writes'] - writes} writes, {migrate_seconds:.2f} s")
+
+    samples = [(user_id,) for user_id in rng.sample(user_ids, args.samples)]
+    print(f"{'per lookup':<34}{'rpcs':>8}{'reads':>8}{'ms':>10}")
+    expected = measure('list friends, relations query', lambda user_id: query_friend_ids(db, user_id), samples)
+    friends.friend_list_cache.clear()
+    listed = measure('list friends, friend list doc', lambda user_id: friends.fetch_friend_ids(db, user_id), samples)
+    assert listed == expected
+    measure('list friends, cached friend list', lambda user_id: friends.fetch_friend_ids(db, user_id), samples)
+
+    pairs = [(user_id, rng.choice(user_ids)) for (user_id,) in samples]
+    expected = measure('are friends, relations query', lambda user_id, friend_id: query_are_friends(db, user_id, friend_id), pairs)
+    # The slow relations queries outlast the friend list TTL, so start cold again
+    friends.friend_list_cache.clear()
+    checked = measure('are friends, friend list doc', lambda user_id, friend_id: friends.are_friends(db, user_id, friend_id), pairs)
+    assert checked == expected
+    measure('are friends, cached friend list', lambda user_id, friend_id: friends.are_friends(db, user_id, friend_id), pairs)
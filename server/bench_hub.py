@@ -0,0 +1,104 @@
+'''Fan-out of live feed updates to thousands of simulated sockets.
+
+Every simulated user holds one connection to a `FeedHub` on the memory
+broker, served exactly like `/ws/feed`. Events of random users are
+published to random friends; a share of the sockets is slow, and a share
+fails on its first send and has to be unregistered. Reports the publish
+cost, delivery latency percentiles and drops:
+
+    python -m server.bench_hub --sockets 5000 --events 2000 --friends 50
+'''
+import argparse
+import asyncio
+import json
+import logging
+import random
+from time import perf_counter
+from typing import Dict, List
+import numpy as np
+from fastapi import WebSocketDisconnect
+
+from .utils.hub import HEARTBEAT, FeedHub, MemoryBroker
+
+class FakeSocket:
+    '''Stands in for a websocket, recording when messages arrive.
+    '''
+
+    def __init__(self, published: Dict[int, float], latencies: List[float], delay: float = 0, fail: bool = False):
+        self.published = published
+        self.latencies = latencies
+        self.delay = delay
+        self.fail = fail
+        self.closed = asyncio.Event()
+
+    async def send_text(self, message: str):
+        if self.fail:
+            raise ConnectionResetError("simulated broken socket")
+        if self.delay > 0:
+            await asyncio.sleep(self.delay)
+        if message != HEARTBEAT:
+            self.latencies.append(perf_counter() - self.published[json.loads(message)['id']])
+
+    async def receive_text(self) -> str:
+        await self.closed.wait()
+        raise WebSocketDisconnect()
+
+async def run(num_sockets: int, num_events: int, num_friends: int, slow_share: float, slow_delay: float, fail_share: float, queue_size: int, seed: int):
+    rng = random.Random(seed)
+    hub = FeedHub(MemoryBroker(), queue_size=queue_size, heartbeat_interval=60)
+    published: Dict[int, float] = {}
+    latencies: List[float] = []
+    user_ids = [f"user-{index:06d}" for index in range(num_sockets)]
+    sockets: List[FakeSocket] = []
+    serving = []
+    for user_id in user_ids:
+        draw = rng.random()
+        socket = FakeSocket(published, latencies, delay=slow_delay if draw < slow_share else 0, fail=slow_share <= draw < slow_share + fail_share)
+        sockets.append(socket)
+        serving.append(asyncio.create_task(hub.serve(hub.open(socket, user_id))))
+    # Let every connection register
+    await asyncio.sleep(0)
+    connected = hub.stats()['connections']
+
+    publish_seconds = []
+    for event_id in range(num_events):
+        friend_ids = rng.sample(user_ids, num_friends)
+        message = json.dumps({'type': 'feed', 'id': event_id})
+        published[event_id] = perf_counter()
+        start = perf_counter()
+        await hub.publish(friend_ids, message)
+        publish_seconds.append(perf_counter() - start)
+        # Yield so that senders run between events, like requests on a loop
+        await asyncio.sleep(0)
+
+    # Wait for queues to drain, bounded by the slow sockets' backlog
+    deadline = perf_counter() + queue_size * slow_delay + 5
+    while perf_counter() < deadline and any(connection.queue.qsize() > 0 for connection in hub.connections):
+        await asyncio.sleep(0.01)
+    stats = hub.stats()
+    for socket in sockets:
+        socket.closed.set()
+    await asyncio.gather(*serving)
+
+    deliveries = np.array(latencies) * 1000
+    publish = np.array(publish_seconds) * 1000
+    print(f"{num_sockets} sockets ({slow_share:.0%} slow by {slow_delay * 1000:.0f} ms, {fail_share:.0%} failing), {num_events} events to {num_friends} friends each")
+    print(f"connected {connected}, still registered after failures {stats['connections']}, after close {hub.stats()['connections']}")
+    print(f"publish per event   p50 {np.percentile(publish, 50):7.3f} ms   p99 {np.percentile(publish, 99):7.3f} ms")
+    print(f"delivery latency    p50 {np.percentile(deliveries, 50):7.3f} ms   p99 {np.percentile(deliveries, 99):7.3f} ms")
+    print(f"delivered {len(deliveries)} of {num_events * num_friends}, dropped {stats['dropped']} by full queues")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sockets', type=int, default=5000)
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--friends', type=int, default=50)
+    parser.add_argument('--slow-share', type=float, default=0.05)
+    parser.add_argument('--slow-delay', type=float, default=0.05, help='seconds a slow socket takes per send')
+    parser.add_argument('--fail-share', type=float, default=0.01)
+    parser.add_argument('--queue-size', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    # Failing sockets are logged one by one
+    logging.getLogger('server.utils.hub').setLevel(logging.ERROR)
+    asyncio.run(run(args.sockets, args.events, args.friends, args.slow_share, args.slow_delay, args.fail_share, args.queue_size, args.seed))
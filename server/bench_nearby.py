@@ -0,0 +1,94 @@
+'''Cost of the friends nearby search.
+
+Friends' latest locations are scattered over a region around the query
+point. Times the distance pass as a per-friend Python loop, as one NumPy
+haversine pass, and with the geohash cell prefilter in front, then the
+whole `find_nearby` call on the memory backend:
+
+    python -m server.bench_nearby --friends 5000 --radius 5000
+'''
+import argparse
+import random
+import timeit
+from math import asin, cos, radians, sin, sqrt
+from typing import Callable, List, Tuple
+import numpy as np
+
+from .utils import feed, geo, schemas
+from .utils.friends import friend_list_ref
+from .utils.latest_events import latest_event_ref
+from .utils.storage import MemoryClient
+
+CENTER = (37.7749, -122.4194)
+
+def python_nearby(latitude: float, longitude: float, radius: float, limit: int, positions: List[Tuple[float, float]]) -> List[Tuple[float, int]]:
+    '''The same search without NumPy, for comparison.
+    '''
+    found = []
+    for index, (friend_latitude, friend_longitude) in enumerate(positions):
+        a = sin(radians(friend_latitude - latitude) / 2) ** 2 + \
+            cos(radians(latitude)) * cos(radians(friend_latitude)) * sin(radians(friend_longitude - longitude) / 2) ** 2
+        distance = 2 * geo.EARTH_RADIUS * asin(sqrt(min(a, 1.0)))
+        if distance <= radius:
+            found.append((distance, index))
+    return sorted(found)[:limit]
+
+def numpy_nearby(latitude: float, longitude: float, radius: float, limit: int, latitudes: np.ndarray, longitudes: np.ndarray, prefilter: bool) -> np.ndarray:
+    candidates = np.arange(len(latitudes))
+    if prefilter:
+        candidates = np.flatnonzero(geo.nearby_cells(latitude, longitude, radius, latitudes, longitudes))
+    distances = geo.haversine(latitude, longitude, latitudes[candidates], longitudes[candidates])
+    inside = np.flatnonzero(distances <= radius)
+    if len(inside) > limit:
+        inside = inside[np.argpartition(distances[inside], limit - 1)[:limit]]
+    return candidates[inside[np.argsort(distances[inside], kind='stable')]]
+
+def seed(db, positions: List[Tuple[float, float]]) -> str:
+    user_id = 'user-000000'
+    friend_ids = [f"friend-{index:06d}" for index in range(len(positions))]
+    batch, size = db.batch(), 0
+    for friend_id, (latitude, longitude) in zip(friend_ids, positions):
+        user = schemas.User(userId=friend_id, firstName='Ada', createdAt=0, updatedAt=0)
+        location = schemas.Location(locationId=f"location-{friend_id}", userId=friend_id, latitude=latitude, longitude=longitude, width=0.002, height=0.002, tag='Home', createdAt=0, updatedAt=0)
+        event = schemas.Event(eventId=f"event-{friend_id}", userId=friend_id, locationId=location.locationId, createdAt=0, updatedAt=0)
+        batch.set(db.collection("Users").document(friend_id), user.model_dump())
+        batch.set(latest_event_ref(db, friend_id), schemas.LatestEvent(userId=friend_id, event=event, location=location).model_dump())
+        size += 2
+        if size >= 498:
+            batch.commit()
+            batch, size = db.batch(), 0
+    batch.commit()
+    friend_list_ref(db, user_id).set(schemas.FriendList(userId=user_id, friendIds=friend_ids, updatedAt=0).model_dump())
+    return user_id
+
+def measure(name: str, fn: Callable, number: int):
+    seconds = timeit.timeit(fn, number=number) / number
+    print(f"{name:<36}{seconds * 1000:>10.3f} ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--friends', type=int, default=5000)
+    parser.add_argument('--radius', type=float, default=5000, help='search radius in meters')
+    parser.add_argument('--spread', type=float, default=2.0, help='degrees friends are scattered over')
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    positions = [
+        (CENTER[0] + rng.uniform(-args.spread, args.spread), CENTER[1] + rng.uniform(-args.spread, args.spread))
+        for _ in range(args.friends)
+    ]
+    latitudes = np.array([position[0] for position in positions])
+    longitudes = np.array([position[1] for position in positions])
+    expected = [index for _, index in python_nearby(*CENTER, args.radius, args.limit, positions)]
+    assert numpy_nearby(*CENTER, args.radius, args.limit, latitudes, longitudes, True).tolist() == expected
+
+    print(f"{args.friends} friends, {len(expected)} within {args.radius:.0f} m")
+    measure('python loop', lambda: python_nearby(*CENTER, args.radius, args.limit, positions), 20)
+    measure('numpy haversine', lambda: numpy_nearby(*CENTER, args.radius, args.limit, latitudes, longitudes, False), 200)
+    measure('numpy with cell prefilter', lambda: numpy_nearby(*CENTER, args.radius, args.limit, latitudes, longitudes, True), 200)
+
+    db = MemoryClient()
+    user_id = seed(db, positions)
+    measure('find_nearby, memory backend', lambda: feed.find_nearby(db, user_id, *CENTER, args.radius, args.limit), 10)
@@ -0,0 +1,74 @@
+'''Fan-out throughput of arrival notifications.
+
+Every sender user has the same synthetic recipients as friends, each with
+a device token. Notifications go through `MemorySender` with a fixed call
+latency and a share of retryable failures, standing in for FCM:
+
+    python -m server.bench_notifications --recipients 5000 --events 20 --latency 0.1
+'''
+import argparse
+import asyncio
+from time import perf_counter
+
+from .utils import notifications, repository, schemas
+from .utils.friends import friend_list_ref
+from .utils.storage import MemoryClient
+
+def seed(db, num_senders: int, num_recipients: int):
+    recipient_ids = [f"recipient-{index:06d}" for index in range(num_recipients)]
+    batch, size = db.batch(), 0
+    for index, recipient_id in enumerate(recipient_ids):
+        user = schemas.User(userId=recipient_id, token=f"token-{index:06d}", createdAt=0, updatedAt=0)
+        batch.set(db.collection("Users").document(recipient_id), user.model_dump())
+        size += 1
+        if size == notifications.MULTICAST_SIZE:
+            batch.commit()
+            batch, size = db.batch(), 0
+    batch.commit()
+    for index in range(num_senders):
+        sender_id = f"sender-{index:04d}"
+        db.collection("Users").document(sender_id).set(schemas.User(userId=sender_id, firstName='Ada', createdAt=0, updatedAt=0).model_dump())
+        location = schemas.Location(locationId=f"location-{index:04d}", userId=sender_id, latitude=0, longitude=0, width=1, height=1, tag='Home', createdAt=0, updatedAt=0)
+        db.collection("Locations").document(location.locationId).set(location.model_dump())
+        friend_list = schemas.FriendList(userId=sender_id, friendIds=recipient_ids, updatedAt=0)
+        friend_list_ref(db, sender_id).set(friend_list.model_dump())
+
+async def main(args):
+    db = MemoryClient()
+    seed(db, args.events, args.recipients)
+    sender = notifications.MemorySender(latency=args.latency, failure_rate=args.failure_rate, seed=0)
+    notifier = notifications.Notifier(
+        db, repository.UsersRepository(db), repository.LocationsRepository(db), sender, workers=args.workers,
+    )
+    # Every event reaches every recipient
+    notifications.RECIPIENT_LIMIT = args.events
+    notifications.BACKOFF_BASE = args.latency
+    events = [
+        schemas.Event(eventId=f"event-{index:04d}", userId=f"sender-{index:04d}", locationId=f"location-{index:04d}", createdAt=0, updatedAt=0)
+        for index in range(args.events)
+    ]
+    notifier.start()
+    start = perf_counter()
+    for event in events:
+        notifier.enqueue(event)
+    enqueued = perf_counter()
+    await notifier.queue.join()
+    elapsed = perf_counter() - start
+    await notifier.stop()
+
+    stats = notifier.stats()
+    print(f"{args.events} events x {args.recipients} recipients, {args.workers} workers, {args.latency * 1000:.0f} ms per call")
+    print(f"{'enqueue per event':<28}{(enqueued - start) / args.events * 1e6:>12.1f} us")
+    print(f"{'delivery time':<28}{elapsed:>12.2f} s")
+    print(f"{'notifications per second':<28}{stats['sent'] / elapsed:>12.0f}")
+    for field in ('calls', 'retries', 'sent', 'failed'):
+        print(f"{field:<28}{stats[field]:>12}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--recipients', type=int, default=5000)
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=notifications.WORKERS)
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds per multicast call')
+    parser.add_argument('--failure-rate', type=float, default=0.01, help='share of tokens failing with a retryable error')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,61 @@
+'''Throughput of concurrent requests with blocking calls on and off the event loop.
+
+Each simulated request makes a few sequential document reads against the
+memory backend, every read first sleeping for a fixed RPC latency the way
+a call to Firestore blocks its thread. The requests run at increasing
+concurrency, once calling the client inline like the handlers used to and
+once through `repository.run`:
+
+    python -m server.bench_repository --latency 0.02 --requests 256
+'''
+import argparse
+import asyncio
+from time import perf_counter, sleep
+
+from .utils import repository
+from .utils.storage import MemoryClient
+
+def slow_get(ref, latency: float):
+    sleep(latency)
+    return ref.get()
+
+async def inline_request(db, user_id: str, reads: int, latency: float):
+    for _ in range(reads):
+        slow_get(db.collection("Users").document(user_id), latency)
+
+async def executor_request(db, user_id: str, reads: int, latency: float):
+    for _ in range(reads):
+        await repository.run(slow_get, db.collection("Users").document(user_id), latency)
+
+async def measure(request, db, num_requests: int, concurrency: int, reads: int, latency: float) -> float:
+    '''Requests per second with at most `concurrency` in flight.
+    '''
+    limit = asyncio.Semaphore(concurrency)
+
+    async def _one(index: int):
+        async with limit:
+            await request(db, f"user-{index % 100:06d}", reads, latency)
+
+    start = perf_counter()
+    await asyncio.gather(*(_one(index) for index in range(num_requests)))
+    return num_requests / (perf_counter() - start)
+
+async def main(num_requests: int, reads: int, latency: float, levels):
+    db = MemoryClient()
+    for index in range(100):
+        db.collection("Users").document(f"user-{index:06d}").set({'userId': f"user-{index:06d}", 'createdAt': 0, 'updatedAt': 0})
+    print(f"{num_requests} requests of {reads} reads, {latency * 1000:.0f} ms per read, {repository.FIRESTORE_MAX_WORKERS} threads")
+    print(f"{'in flight':<12}{'inline req/s':>14}{'executor req/s':>16}")
+    for concurrency in levels:
+        inline = await measure(inline_request, db, num_requests, concurrency, reads, latency)
+        executor = await measure(executor_request, db, num_requests, concurrency, reads, latency)
+        print(f"{concurrency:<12}{inline:>14.1f}{executor:>16.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=256)
+    parser.add_argument('--reads', type=int, default=3, help='sequential reads per request')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds each read blocks')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 64])
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.reads, args.latency, args.concurrency))
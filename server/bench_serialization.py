@@ -0,0 +1,69 @@
+'''Serialization cost and size of feed and location pages.
+
+Compares the encoders a response could go through, then the bytes on the
+wire with gzip and the cost of the ETag hash:
+
+    python -m server.bench_serialization --items 100
+'''
+import argparse
+import gzip
+import json
+import timeit
+from typing import Callable
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from .utils import schemas
+from .utils.etag import compute_etag
+
+def make_location(index: int) -> schemas.Location:
+    return schemas.Location(
+        locationId=f"location-{index:06d}",
+        userId='user-000001',
+        latitude=37.4275 + index * 1e-3,
+        longitude=-122.1697 - index * 1e-3,
+        width=0.002,
+        height=0.002,
+        tag=f"Place {index}",
+        category='home',
+        cells=['9q9hvu', '9q9hvv'],
+        createdAt=1700000000 + index,
+        updatedAt=1700000000 + index,
+    )
+
+def make_feed_item(index: int) -> schemas.FeedItem:
+    user = schemas.User(userId=f"user-{index:06d}", email=f"user{index}@example.com", firstName='Ada', lastName='Lovelace', createdAt=1700000000, updatedAt=1700000000)
+    location = make_location(index)
+    event = schemas.Event(eventId=f"event-{index:06d}", userId=user.userId, locationId=location.locationId, createdAt=1700000000, updatedAt=1700000000)
+    return schemas.FeedItem(user=user, event=event, location=location)
+
+def measure(name: str, fn: Callable, number: int):
+    seconds = timeit.timeit(fn, number=number) / number
+    print(f"  {name:<36}{seconds * 1e6:>10.1f} us")
+
+def bench(name: str, page, number: int, gzip_level: int):
+    adapter = TypeAdapter(type(page))
+    print(f"{name} ({len(page.items)} items)")
+    # What FastAPI does for an endpoint with a return annotation
+    measure('validate + dump_json (current)', lambda: adapter.dump_json(adapter.validate_python(page)), number)
+    # What FastAPI does without one, the old default
+    measure('jsonable_encoder + json.dumps', lambda: json.dumps(jsonable_encoder(page)).encode('utf8'), number)
+    try:
+        import orjson
+        measure('model_dump + orjson.dumps', lambda: orjson.dumps(page.model_dump()), number)
+    except ImportError:
+        pass
+    body = adapter.dump_json(page)
+    for level in sorted({1, gzip_level, 9}):
+        measure(f"gzip level {level}", lambda: gzip.compress(body, level), number)
+    measure('etag hash', lambda: compute_etag(body), number)
+    print(f"  {'bytes raw / gzip':<36}{len(body):>10} / {len(gzip.compress(body, gzip_level))}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--number', type=int, default=200, help='repetitions per measurement')
+    parser.add_argument('--gzip-level', type=int, default=6, help='level used by GZipMiddleware, see GZIP_LEVEL')
+    args = parser.parse_args()
+    bench('Page[Location]', schemas.Page[schemas.Location](items=[make_location(i) for i in range(args.items)], nextCursor='cursor'), args.number, args.gzip_level)
+    bench('Page[FeedItem]', schemas.Page[schemas.FeedItem](items=[make_feed_item(i) for i in range(args.items)], nextCursor='cursor'), args.number, args.gzip_level)
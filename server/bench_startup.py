@@ -0,0 +1,64 @@
+'''Cold start benchmark: import time and time to first request.
+
+Each run starts a fresh interpreter, so nothing is shared between runs:
+
+    python -m server.bench_startup --runs 5
+
+Time to first request is measured from spawning uvicorn until `GET /`
+answers, which includes interpreter start, imports and the lifespan.
+'''
+import argparse
+import socket
+import statistics
+import subprocess
+import sys
+from time import perf_counter, sleep
+from typing import List
+import httpx
+
+IMPORT_SCRIPT = '''
+from time import perf_counter
+start = perf_counter()
+import server.main
+print(perf_counter() - start)
+'''
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def time_import() -> float:
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], check=True, capture_output=True, text=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+def time_first_request(timeout: float = 60) -> float:
+    port = free_port()
+    start = perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'server.main:app', '--port', str(port), '--log-level', 'warning'],
+    )
+    try:
+        while perf_counter() - start < timeout:
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                    return perf_counter() - start
+            except httpx.TransportError:
+                pass
+            if server.poll() is not None:
+                raise RuntimeError("Server exited before answering")
+            sleep(0.005)
+        raise TimeoutError(f"No response within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+def summarize(name: str, samples: List[float]):
+    print(f"{name:<20} min {min(samples) * 1000:8.1f} ms   median {statistics.median(samples) * 1000:8.1f} ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    summarize('import server.main', [time_import() for _ in range(args.runs)])
+    summarize('first request', [time_first_request() for _ in range(args.runs)])
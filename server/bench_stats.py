@@ -0,0 +1,82 @@
+'''Location stats over a year of synthetic events.
+
+Times the vectorized rollup against a plain Python loop over the same
+events, both producing plain totals, then the cost of validating them
+into models, the per-event incremental update and the stats read:
+
+    python -m server.bench_stats --locations 20 --visits-per-day 12
+'''
+import argparse
+import random
+import timeit
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from .utils import schemas, stats
+from .utils.storage import MemoryClient
+
+YEAR_START = 1704067200 # 2024-01-01 UTC
+
+def synthetic_intervals(num_locations: int, visits_per_day: int, days: int, seed: int) -> List[stats.Interval]:
+    rng = random.Random(seed)
+    intervals = []
+    for day in range(days):
+        for _ in range(visits_per_day):
+            start = YEAR_START + day * stats.DAY + rng.randrange(stats.DAY)
+            # Mostly short stops, some long enough to cross midnight
+            duration = int(rng.expovariate(1 / 3600))
+            intervals.append((f"location-{rng.randrange(num_locations):03d}", start, start + duration, 1))
+    return intervals
+
+def python_rollup(intervals: List[stats.Interval]) -> Dict[Tuple[str, int], List[int]]:
+    '''The same per-day split without NumPy, for comparison.
+    '''
+    totals: Dict[Tuple[str, int], List[int]] = defaultdict(lambda: [0, 0])
+    for location_id, start, end, visits in intervals:
+        totals[(location_id, start // stats.DAY)][0] += visits
+        cursor = start
+        while cursor < end:
+            stop = min(end, (cursor // stats.DAY + 1) * stats.DAY)
+            totals[(location_id, cursor // stats.DAY)][1] += stop - cursor
+            cursor = stop
+    return totals
+
+def measure(name: str, fn, number: int):
+    seconds = timeit.timeit(fn, number=number) / number
+    print(f"{name:<40}{seconds * 1000:>10.3f} ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--locations', type=int, default=20)
+    parser.add_argument('--visits-per-day', type=int, default=12)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    intervals = synthetic_intervals(args.locations, args.visits_per_day, args.days, args.seed)
+    print(f"{len(intervals)} events over {args.days} days at {args.locations} locations")
+    measure('rollup, numpy (stats.rollup)', lambda: stats.rollup(intervals), 5)
+    measure('rollup, python loop', lambda: python_rollup(intervals), 5)
+    measure('rollup and models (stats.aggregate)', lambda: stats.aggregate(intervals), 5)
+
+    db = MemoryClient()
+    user_id = 'user-000001'
+    batch = db.batch()
+    for location_id, location_stats in stats.aggregate(intervals).items():
+        location_stats = location_stats.model_copy(update={'userId': user_id})
+        batch.set(stats.location_stats_ref(db, location_id), location_stats.model_dump())
+    batch.commit()
+
+    def _increment():
+        batch = db.batch()
+        stats.stage_intervals(batch, db, user_id, [intervals[-1]])
+        batch.commit()
+
+    location = schemas.Location(
+        locationId=intervals[-1][0], userId=user_id, latitude=0, longitude=0, width=1, height=1,
+        tag='bench', createdAt=YEAR_START, updatedAt=YEAR_START,
+    )
+    now = YEAR_START + args.days * stats.DAY
+    measure('incremental update of one event', _increment, 200)
+    measure('read stats, last 7 days', lambda: stats.fetch_stats(db, location, 7, now=now), 200)
+    measure('read stats, last 366 days', lambda: stats.fetch_stats(db, location, 366, now=now), 200)
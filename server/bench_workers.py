@@ -0,0 +1,76 @@
+'''Throughput scaling across gunicorn worker counts.
+
+Each run starts the production server (see gunicorn.conf.py) on a fresh
+SQLite file shared by its workers, with local auth, and drives it with the
+load generator:
+
+    python -m server.bench_workers --workers 1 2 4 8 --duration 20
+
+The load generator is a single process, so on small machines it can become
+the bottleneck before the server does.
+'''
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, sleep
+import httpx
+
+from .bench_startup import free_port
+from .loadtest import run
+
+def start_server(workers: int, port: int, sqlite_path: str) -> subprocess.Popen:
+    server_env = dict(
+        os.environ,
+        WHEREABOUT_STORAGE='sqlite',
+        WHEREABOUT_SQLITE_PATH=sqlite_path,
+        WHEREABOUT_LOCAL_AUTH='1',
+        WEB_CONCURRENCY=str(workers),
+        BIND=f"127.0.0.1:{port}",
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'server.main:app', '--config', 'server/gunicorn.conf.py', '--log-level', 'warning'],
+        env=server_env,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    start = perf_counter()
+    while perf_counter() - start < 60:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/ready", timeout=1).status_code == 200:
+                return server
+        except httpx.TransportError:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError("Server exited before becoming ready")
+        sleep(0.05)
+    server.terminate()
+    raise TimeoutError("Server not ready within 60s")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--friends', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args()
+
+    results = []
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as directory:
+            port = free_port()
+            server = start_server(workers, port, os.path.join(directory, 'bench.sqlite3'))
+            try:
+                print(f"--- {workers} workers")
+                rows = asyncio.run(run(f"http://127.0.0.1:{port}", args.users, args.friends, args.duration, args.concurrency))
+            finally:
+                server.terminate()
+                server.wait()
+        _, count, failed, rps, p50, p99 = rows[-1]
+        results.append((workers, rps, p50, p99, failed))
+
+    print(f"{'workers':<10}{'rps':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for workers, rps, p50, p99, failed in results:
+        print(f"{workers:<10}{rps:>10.1f}{p50:>10.2f}{p99:>10.2f}{failed:>8}")
@@ -0,0 +1,64 @@
+'''Firestore round trips per mutation.
+
+Sends each create and edit request once through the app on the memory
+backend and counts the RPCs it made on the instrumented client. Every
+mutation used to cost three: an existence get, the write and a get to
+return the document. User and location writes now take one round trip.
+Creating an event stays a transaction, because it advances the latest
+event index and the stats: it begins, reads the location and the latest
+event in one batched get, then commits, so three sequential round trips,
+plus the friend list read of the feed push after the response. A second
+event closes the first in the same transaction, which the location stats
+must show as dwell time. The script fails if any endpoint needs more than
+its expected count:
+
+    python -m server.bench_writes
+'''
+import asyncio
+from os import environ as env
+
+env.setdefault('WHEREABOUT_STORAGE', 'memory')
+env.setdefault('WHEREABOUT_LOCAL_AUTH', '1')
+
+from .loadtest import auth, make_client
+from .utils import cache, metrics
+
+LOCATION = {'userId': 'user-000001', 'latitude': 37.4275, 'longitude': -122.1697, 'width': 0.002, 'height': 0.002, 'tag': 'Home'}
+
+async def count(name: str, expected: int, request) -> dict:
+    '''Send one request and check its RPCs against the expected count.
+    '''
+    before = dict(metrics.registry.rpcs)
+    response = await request
+    assert response.status_code == 200, (name, response.status_code, response.text)
+    counts = {field: metrics.registry.rpcs[field] - before[field] for field in before}
+    print(f"{name:<34}{counts['rpcs']:>6}{counts['reads']:>7}{counts['writes']:>8}{counts['queries']:>9}{expected:>10}")
+    assert counts['rpcs'] <= expected, f"{name} made {counts['rpcs']} RPCs, expected at most {expected}"
+    return response.json()
+
+async def run():
+    client = make_client('')
+    user_id = LOCATION['userId']
+    headers = auth(user_id)
+    print(f"{'mutation':<34}{'rpcs':>6}{'reads':>7}{'writes':>8}{'queries':>9}{'expected':>10}")
+    await count('create user', 1, client.post('/api/users/create', headers=headers, json={'firstName': 'Ada'}))
+    await count('update token', 1, client.post(f"/api/users/{user_id}/token", headers=headers, json={'userId': user_id, 'token': 'token'}))
+    cache.model_cache.clear()
+    await count('update token, cold cache', 2, client.post(f"/api/users/{user_id}/token", headers=headers, json={'userId': user_id, 'token': 'token'}))
+    location = await count('create location', 1, client.post('/api/locations/create', headers=headers, json=LOCATION))
+    edit = {key: value for key, value in LOCATION.items() if key != 'userId'}
+    # The second RPC refreshes the location snapshot in the latest event index
+    await count('edit location', 2, client.post(f"/api/locations/{location['locationId']}/edit", headers=headers, json={**edit, 'tag': 'Work'}))
+    # Begin, one batched get of the location and latest event, commit, then the push's friend list read
+    await count('create event', 4, client.post('/api/events/create', headers=headers, json={'userId': user_id, 'locationId': location['locationId']}))
+    # Events are stamped in whole seconds
+    await asyncio.sleep(1.1)
+    await count('create event, closing the first', 4, client.post('/api/events/create', headers=headers, json={'userId': user_id, 'locationId': location['locationId']}))
+    response = await client.get(f"/api/locations/{location['locationId']}/stats", headers=headers)
+    assert response.status_code == 200, response.text
+    stats = response.json()
+    assert stats['visits'] == 2 and stats['dwellSeconds'] > 0, f"two events, expected dwell time: {stats}"
+    print(f"two events, {stats['visits']} visits and {stats['dwellSeconds']} s dwell")
+
+if __name__ == '__main__':
+    asyncio.run(run())
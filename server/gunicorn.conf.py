@@ -0,0 +1,25 @@
+'''Gunicorn settings for production, see start_server.sh.
+
+Each worker creates its own firebase client, and with it its own gRPC
+channel, on startup. The master only warms up fork-safe state.
+'''
+from multiprocessing import cpu_count
+from os import environ as env
+
+bind = env.get('BIND', '0.0.0.0:8000')
+# One worker per core unless WEB_CONCURRENCY says otherwise
+workers = int(env.get('WEB_CONCURRENCY', cpu_count()))
+worker_class = 'server.worker.Worker'
+# Import the app once in the master so workers share its memory
+preload_app = True
+# Seconds idle connections stay open, longer than the load balancer's idle timeout
+keepalive = int(env.get('KEEPALIVE', 75))
+# Seconds workers get to finish in-flight requests on shutdown
+graceful_timeout = int(env.get('GRACEFUL_TIMEOUT', 30))
+# Seconds a silent worker lives before it is restarted
+timeout = int(env.get('WORKER_TIMEOUT', 60))
+accesslog = env.get('ACCESS_LOG')
+
+def on_starting(server):
+    from server.utils import database
+    database.warm_up()
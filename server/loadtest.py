@@ -0,0 +1,148 @@
+'''Load generator reporting throughput and latency percentiles per endpoint.
+
+By default the app runs in-process on the memory backend, so no server,
+network or credentials are needed:
+
+    python -m server.loadtest --users 200 --duration 30 --concurrency 50
+
+To drive a running server instead, start it with a local backend and local
+auth (`WHEREABOUT_STORAGE=sqlite WHEREABOUT_LOCAL_AUTH=1`) and pass `--url`.
+'''
+import argparse
+import asyncio
+import random
+from os import environ as env
+from time import perf_counter
+from typing import Dict, List, Tuple
+import httpx
+import numpy as np
+
+# Share of each operation in the generated traffic
+WORKLOAD = (
+    ('feed', 0.60),
+    ('create_event', 0.20),
+    ('friends', 0.10),
+    ('locations', 0.05),
+    ('befriend', 0.05),
+)
+
+def make_client(url: str) -> httpx.AsyncClient:
+    if url:
+        return httpx.AsyncClient(base_url=url, timeout=30)
+    env.setdefault('WHEREABOUT_STORAGE', 'memory')
+    env.setdefault('WHEREABOUT_LOCAL_AUTH', '1')
+    from .main import app
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://loadtest', timeout=30)
+
+def auth(user_id: str) -> Dict[str, str]:
+    return {'Authorization': f"Bearer {user_id}"}
+
+async def seed(client: httpx.AsyncClient, num_users: int, num_friends: int, rng: random.Random) -> Dict[str, List[str]]:
+    '''Create users, friendships and a few locations per user.
+    :return: location ids keyed by user id
+    '''
+    user_ids = [f"load-{index:06d}" for index in range(num_users)]
+    for user_id in user_ids:
+        response = await client.post('/api/users/create', headers=auth(user_id), json={
+            'email': f"{user_id}@local", 'firstName': 'Load', 'lastName': user_id,
+        })
+        if response.status_code not in (200, 400):
+            response.raise_for_status()
+    for user_id in user_ids:
+        for friend_id in rng.sample(user_ids, min(num_friends, num_users)):
+            if friend_id != user_id:
+                response = await client.post('/api/friends/create', headers=auth(user_id), json={'recipientId': friend_id})
+                response.raise_for_status()
+    location_ids: Dict[str, List[str]] = {}
+    for user_id in user_ids:
+        location_ids[user_id] = []
+        for _ in range(2):
+            response = await client.post('/api/locations/create', headers=auth(user_id), json={
+                'userId': user_id,
+                'latitude': rng.uniform(-60, 60),
+                'longitude': rng.uniform(-180, 180),
+                'width': 0.01,
+                'height': 0.01,
+                'tag': 'Place',
+            })
+            response.raise_for_status()
+            location_ids[user_id].append(response.json()['locationId'])
+    return location_ids
+
+async def request(client: httpx.AsyncClient, operation: str, user_id: str, user_ids: List[str], location_ids: Dict[str, List[str]], rng: random.Random) -> httpx.Response:
+    headers = auth(user_id)
+    if operation == 'feed':
+        return await client.get('/api/feed', headers=headers, params={'limit': 20})
+    if operation == 'create_event':
+        return await client.post('/api/events/create', headers=headers, json={
+            'userId': user_id,
+            'locationId': rng.choice(location_ids[user_id]),
+        })
+    if operation == 'friends':
+        return await client.get('/api/friends', headers=headers, params={'limit': 50})
+    if operation == 'locations':
+        return await client.get('/api/locations', headers=headers, params={'limit': 20})
+    friend_id = rng.choice([other_id for other_id in user_ids if other_id != user_id])
+    return await client.post('/api/friends/create', headers=headers, json={'recipientId': friend_id})
+
+async def worker(client: httpx.AsyncClient, deadline: float, user_ids: List[str], location_ids: Dict[str, List[str]], rng: random.Random, samples: Dict[str, List[float]], errors: Dict[str, int]):
+    operations, weights = zip(*WORKLOAD)
+    while perf_counter() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        user_id = rng.choice(user_ids)
+        start = perf_counter()
+        try:
+            response = await request(client, operation, user_id, user_ids, location_ids, rng)
+            failed = response.status_code >= 400
+        except httpx.HTTPError:
+            failed = True
+        samples.setdefault(operation, []).append(perf_counter() - start)
+        if failed:
+            errors[operation] = errors.get(operation, 0) + 1
+
+def report(samples: Dict[str, List[float]], errors: Dict[str, int], elapsed: float) -> List[Tuple]:
+    rows = []
+    for operation, latencies in sorted(samples.items()) + [('total', sum(samples.values(), []))]:
+        latencies = np.asarray(latencies) * 1000
+        failed = errors.get(operation, 0) if operation != 'total' else sum(errors.values())
+        rows.append((
+            operation,
+            len(latencies),
+            failed,
+            len(latencies) / elapsed,
+            np.percentile(latencies, 50),
+            np.percentile(latencies, 99),
+        ))
+    print(f"{'operation':<14}{'requests':>10}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for operation, count, failed, rps, p50, p99 in rows:
+        print(f"{operation:<14}{count:>10}{failed:>8}{rps:>10.1f}{p50:>10.2f}{p99:>10.2f}")
+    return rows
+
+async def run(url: str, users: int, friends: int, duration: float, concurrency: int, seed_value: int = 0) -> List[Tuple]:
+    '''Seed the data, generate load and print the report.
+    :return: report rows of operation, requests, errors, rps, p50 and p99 in ms
+    '''
+    rng = random.Random(seed_value)
+    async with make_client(url) as client:
+        location_ids = await seed(client, users, friends, rng)
+        user_ids = list(location_ids)
+        samples: Dict[str, List[float]] = {}
+        errors: Dict[str, int] = {}
+        start = perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*[
+            worker(client, deadline, user_ids, location_ids, random.Random(rng.random()), samples, errors)
+            for _ in range(concurrency)
+        ])
+        return report(samples, errors, perf_counter() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='', help='base url of a running server, in-process when empty')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--friends', type=int, default=20, help='friends added per user while seeding')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--concurrency', type=int, default=50, help='concurrent virtual users')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.users, args.friends, args.duration, args.concurrency, args.seed))
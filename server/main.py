@@ -1,36 +1,75 @@
-from cmath import rect
-import json
+import asyncio
 import secrets
-import requests
+from contextlib import asynccontextmanager
 from time import time
-from typing import Optional, Tuple, List
-from firebase_admin import firestore
-from fastapi import Depends, FastAPI, HTTPException, status
-from fastapi import WebSocket, WebSocketDisconnect
+from typing import Callable, Dict, FrozenSet, Optional, Tuple, Type, List
+from fastapi import APIRouter, BackgroundTasks, Depends, FastAPI, HTTPException, Query, Request, status
+from fastapi import WebSocket
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from dotenv import load_dotenv
+from pydantic import BaseModel
 from os import environ as env
 
-from .utils import database, schemas, utils, requests
-
-# Load environment variables
+# Load environment variables before the utils read their settings
 load_dotenv()
 
-# Initialize firebase client
-db = database.get_firebase_client()
+from .utils import (
+    database,
+    schemas,
+    utils,
+    requests,
+    feed,
+    latest_events,
+    repository,
+    cache,
+    geo,
+    pings,
+    hub,
+    pagination,
+    friends,
+    metrics,
+    etag,
+    stats,
+    transfer,
+    notifications,
+    coalesce,
+    archive,
+    cascade,
+)
+
+# Shared firebase client, created on first use
+db = database.client
 
-# Initialize FastAPI
-app = FastAPI(title="whereabout")
+# Non-blocking repositories over the firebase client
+users = repository.UsersRepository(db)
+locations = repository.LocationsRepository(db)
+events = repository.EventsRepository(db)
 
-# Add CORS to site
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Push channel for live feed updates
+feed_hub = hub.FeedHub(hub.MemoryBroker())
+
+# Identical concurrent reads share one computation
+reads = coalesce.SingleFlight()
+# Concurrent geofence index misses of a user build it once per cache generation
+index_builds = coalesce.SingleFlight(window=0)
+
+# Push notifications to friends, sent in the background
+notifier = notifications.Notifier(db, users, locations, notifications.create_sender())
+
+# Deletes of what depends on a deleted location or account, run in the background
+cascades = cascade.CascadeEngine(db)
+
+# Smallest response body in bytes worth compressing
+GZIP_MINIMUM_SIZE = int(env.get('GZIP_MINIMUM_SIZE', 1000))
+# Starlette defaults to 9, which costs several times the serialization for little gain
+GZIP_LEVEL = int(env.get('GZIP_LEVEL', 6))
+
+# Endpoints, mounted on the app by `create_app`
+router = APIRouter()
 
 # Create basic security parameters for admin
 admin_security = HTTPBasic()
@@ -61,71 +100,194 @@ def check_admin_credentials(credentials: HTTPBasicCredentials = Depends(admin_se
         )
     return True
 
-@app.get("/")
+@router.get("/")
 def read_root():
     return {"message": "Welcome to whereabout's server"}
 
+@router.get("/ready")
+def check_ready():
+    '''Readiness probe, succeeds once this worker's firebase client exists.
+    '''
+    if not database.is_ready():
+        raise HTTPException(status_code=503, detail="Firebase client not initialized")
+    return {"status": "ready"}
+
+# --- admin endpoints ---
+
+@router.get('/api/admin/cache')
+async def fetch_cache_stats(is_admin: bool = Depends(check_admin_credentials)):
+    '''Hit ratios of the in-process caches.
+    '''
+    return {
+        'models': cache.model_cache.stats(),
+        'tokens': utils.token_cache.stats(),
+        'hub': feed_hub.stats(),
+        'push': notifier.stats(),
+        'coalesce': reads.stats(),
+        'cascade': cascades.stats(),
+    }
+
+@router.get('/metrics', response_class=PlainTextResponse)
+async def fetch_metrics(is_admin: bool = Depends(check_admin_credentials)):
+    '''Request latency, firestore RPC and cache metrics for Prometheus.
+    '''
+    gauges = {}
+    for name, cache_stats in (('model', cache.model_cache.stats()), ('token', utils.token_cache.stats())):
+        for field, value in cache_stats.items():
+            gauges[f"{name}_cache_{field}"] = value
+    for field, value in feed_hub.stats().items():
+        gauges[f"feed_hub_{field}"] = value
+    for field, value in notifier.stats().items():
+        gauges[f"push_{field}"] = value
+    for field, value in reads.stats().items():
+        gauges[f"coalesce_{field}"] = value
+    for field, value in cascades.stats().items():
+        gauges[f"cascade_{field}"] = value
+    return metrics.registry.render(gauges)
+
+@router.get('/api/admin/export/{user_id}', response_class=StreamingResponse)
+async def export_user_data(user_id: str, is_admin: bool = Depends(check_admin_credentials)):
+    '''Stream a user's locations, events and relations as NDJSON.
+    '''
+    return StreamingResponse(
+        transfer.export_records(db, user_id),
+        media_type='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{user_id}.ndjson"'},
+    )
+
+@router.post('/api/admin/import')
+async def import_user_data(request: Request, is_admin: bool = Depends(check_admin_credentials)) -> Dict[str, int]:
+    '''Write the documents of an NDJSON export, read from the request body as it arrives.
+    '''
+    return await transfer.import_records(db, request.stream())
+
 # --- feed endpoints ---
 
-@app.get('/api/feed')
+@router.get('/api/feed')
 async def fetch_feed(
-    page: int = 0,
-    limit: int = 10,
+    limit: int = Query(10, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
-    ) -> List[schemas.FeedItem]:
+    ) -> schemas.Page[schemas.FeedItem]:
     '''Fetch latest events for each friend.
     '''
     user_id = fb_user.uid
-    # Fetch list of friends
-    relation_docs = db.collection("Relations")\
-        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
-        .offset(page * limit)\
-        .limit(limit)\
-        .stream()
-    friends: List[schemas.User] = []
-    for relation_doc in relation_docs:
-        relation = schemas.relation_to_pydantic(relation_doc, relation_doc.id)
-        friend_id = relation.recipientId if relation.userId == user_id else relation.userId
-        friend = schemas.user_to_pydantic(friend_id)
-        friends.append(friend)
-    # For each friend
-    feed_items: List[schemas.FeedItem] = []
-    for friend in friends:
-        friend_id = friend.userId
-        # Find the latest event
-        event_docs = db.collection("Events")\
-            .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
-            .order_by('updated_at', direction=firestore.Query.DESCENDING)\
-            .limit(1)\
-            .get()
-        if len(event_docs) == 0:
-            continue
-        event_doc = event_docs[0]
-        event = schemas.event_to_pydantic(event_doc, event_doc.id)
-        # Fetch the corresponding location
-        location_id = event.locationId
-        location_doc = db.collection("Locations").document(location_id).get()
-        if not location_doc.exists:
-            continue
-        location = schemas.location_to_pydantic(location_doc, location_id)
-        feed_item = schemas.FeedItem(user=friend, event=event, location=location)
-        feed_items.append(feed_item)
-    return feed_items
+    feed_page = await reads.do(
+        ('feed', user_id, limit, cursor),
+        lambda: repository.run(feed.build_feed, db, user_id, limit, cursor),
+    )
+    return feed_page
+
+async def publish_event(event: schemas.Event):
+    '''Push a new event to the connected friends of its user.
+    '''
+    user, location, friend_ids = await asyncio.gather(
+        users.get(event.userId),
+        locations.get(event.locationId),
+        repository.run(friends.fetch_friend_ids, db, event.userId),
+    )
+    if user is None or location is None:
+        return
+    feed_item = schemas.FeedItem(user=schemas.public_user(user), event=event, location=schemas.public_location(location))
+    message = schemas.FeedMessage(item=feed_item).model_dump_json()
+    await feed_hub.publish(friend_ids, message)
+
+@router.websocket('/ws/feed')
+async def feed_socket(websocket: WebSocket, token: Optional[str] = None):
+    '''Stream feed items of friends as they happen.
+
+    The ID token is taken from the `token` query parameter or a bearer
+    authorization header.
+    '''
+    id_token = token
+    authorization = websocket.headers.get('authorization', '')
+    if id_token is None and authorization.lower().startswith('bearer '):
+        id_token = authorization[len('bearer '):]
+    try:
+        fb_user = await run_in_threadpool(utils.verify_firebase_token, id_token)
+    except Exception:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    connection = feed_hub.open(websocket, fb_user.uid)
+    await feed_hub.serve(connection)
+
+# --- batch reads ---
+
+# Most ids per batch request
+MAX_BATCH_IDS = 300
+
+async def fetch_visible(
+    repo: repository.Repository,
+    doc_ids: List[str],
+    user_id: str,
+    model: Type[BaseModel],
+    hidden: FrozenSet[str] = frozenset(),
+    owner: Callable[[str, BaseModel], str] = lambda doc_id, found: found.userId,
+    fallback: Optional[Callable[[List[str]], Dict[str, BaseModel]]] = None,
+) -> Dict[str, Optional[BaseModel]]:
+    '''Fetch documents of a user and their friends in one batched get.
+
+    Documents of other users come back as misses just like missing ones,
+    so a response never reveals whether someone else's id exists.
+    :param repo: repository of the collection
+    :param doc_ids: requested document ids
+    :param user_id: id of the requesting user
+    :param model: model of the collection, only its fields outside hidden are read
+    :param hidden: fields never returned
+    :param owner: id of the user owning a found document
+    :param fallback: blocking lookup of the ids missing from the collection
+    :return: map from every requested id to its model, or None on a miss
+    '''
+    if len(doc_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} ids per batch")
+    field_paths = [field for field in model.model_fields if field not in hidden] if hidden else None
+    found = await repo.get_many(doc_ids, field_paths)
+    missing = [doc_id for doc_id in doc_ids if doc_id not in found]
+    if fallback is not None and len(missing) > 0:
+        found.update(await repository.run(fallback, missing))
+    owners = {doc_id: owner(doc_id, item) for doc_id, item in found.items()}
+    visible = {user_id}
+    # One friend list read, usually cached, covers every foreign document
+    if any(owner_id != user_id for owner_id in owners.values()):
+        visible.update(await repository.run(friends.fetch_friend_ids, db, user_id))
+    cleared = dict.fromkeys(hidden)
+    items: Dict[str, Optional[BaseModel]] = {}
+    for doc_id in doc_ids:
+        item = found.get(doc_id)
+        if item is None or owners[doc_id] not in visible:
+            items[doc_id] = None
+        else:
+            # Cache hits are whole documents
+            items[doc_id] = item.model_copy(update=cleared) if hidden else item
+    return items
 
 # --- user endpoints ---
 
-@app.get('/api/users/{user_id')
-async def fetch_user(fb_user: schemas.FBUser = Depends(utils.get_firebase_user)) -> schemas.User:
-    '''Fetch a user.
+@router.get('/api/users/{user_id}')
+async def fetch_user(
+    user_id: str,
+    fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
+    ) -> schemas.User:
+    '''Fetch the user or one of their friends. Only the user sees their push token.
     '''
-    user_id = fb_user.uid
-    user_doc = db.collection("Users").document(user_id).get()
-    if not user_doc.exists:
+    if user_id != fb_user.uid and not await repository.run(friends.are_friends, db, fb_user.uid, user_id):
+        raise HTTPException(status_code=403, detail=f"User {user_id} is not a friend of {fb_user.uid}")
+    user = await reads.do(('user', fb_user.uid, user_id), lambda: users.get(user_id))
+    if user is None:
         raise HTTPException(status_code=400, detail="User does not exist")
-    user = schemas.user_to_pydantic(user_doc)
-    return user
+    return user if user_id == fb_user.uid else schemas.public_user(user)
 
-@app.post('/api/users/create')
+@router.post('/api/users/batch')
+async def fetch_users_batch(
+    body: requests.BatchGetRequest,
+    fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
+) -> Dict[str, Optional[schemas.User]]:
+    '''Fetch the user and their friends by id, None for everyone else. Push tokens are left out.
+    '''
+    return await fetch_visible(users, body.ids, fb_user.uid, schemas.User, frozenset({'token'}), lambda doc_id, _: doc_id)
+
+@router.post('/api/users/create')
 async def create_user(
     body: requests.CreateUserRequest,
     fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
@@ -133,30 +295,28 @@ async def create_user(
     '''Create a user.
     '''
     user_id = fb_user.uid
-    user_ref = db.collection("Users").document(user_id).get()
-    if user_ref.exists:
-        raise HTTPException(status_code=400, detail="User with email already exists")
-
     now = int(time())
     user = schemas.User(
         userId=user_id,
         email=body.email,
         firstName=body.firstName,
         lastName=body.lastName,
+        token=body.token,
         createdAt=now,
         updatedAt=now,
     )
-    # Create the user in Firebase
+    # Create the user in Firebase, keyed by the firebase uid
     try:
-        _, user_ref = db.collection("Users").add(user.model_dump())
+        user = await users.create(user, user_id)
+    except repository.FirestoreTimeout:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to write user to Firebase: {e}")
-
-    # Return the user
-    user = schemas.user_to_pydantic(user_ref.get())
+    if user is None:
+        raise HTTPException(status_code=400, detail="User with email already exists")
     return user
 
-@app.post('/api/users/{user_id}/token')
+@router.post('/api/users/{user_id}/token')
 async def update_user_token(
     user_id: str,
     body: requests.UpdateUserTokenRequest,
@@ -165,21 +325,69 @@ async def update_user_token(
     '''Updates a user in Firebase to set the notification token.
     '''
     user_id = fb_user.uid
-    user_ref = db.collection("Users").document(user_id)
-    user = user_ref.get()
-    if not user.exists:
-        raise HTTPException(status_code=400, detail=f"User {user_id} does not exist")
     try:
-        user_ref.update({'token': body.token, 'updatedAt': int(time())})
+        user = await users.patch(user_id, {'token': body.token, 'updatedAt': int(time())})
+    except repository.FirestoreTimeout:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, default=f"Failed to write; error: {e}")
-    user = user_ref.get()
-    user = schemas.User.model_validate(user.to_dict())
+        raise HTTPException(status_code=500, detail=f"Failed to write; error: {e}")
+    if user is None:
+        raise HTTPException(status_code=400, detail=f"User {user_id} does not exist")
     return user
 
+@router.post('/api/users/{user_id}/delete')
+async def delete_user(
+    user_id: str,
+    fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
+) -> bool:
+    '''Delete the user's account. Friendships, locations and events are removed in the background.
+    '''
+    if user_id != fb_user.uid:
+        raise HTTPException(status_code=403, detail=f"User {fb_user.uid} cannot delete user {user_id}")
+    user = await users.get(user_id)
+    if user is None:
+        raise HTTPException(status_code=400, detail=f"User {user_id} does not exist")
+    try:
+        await users.delete(user_id)
+        await cascades.enqueue(cascade.KIND_USER, user_id, user_id)
+    except repository.FirestoreTimeout:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete; error: {e}")
+    geo.geofence_cache.invalidate(user_id)
+    return True
+
 # --- relation endpoints ---
 
-@app.post('/api/friends/create')
+@router.get('/api/friends')
+async def fetch_friends(
+    limit: int = Query(50, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
+) -> schemas.Page[schemas.User]:
+    '''Fetch friends.
+    '''
+    friend_ids, next_cursor = await repository.run(friends.fetch_friend_page, db, fb_user.uid, limit, cursor)
+    friend_users = await users.get_many(friend_ids)
+    items = [schemas.public_user(friend_users[friend_id]) for friend_id in friend_ids if friend_id in friend_users]
+    return schemas.Page[schemas.User](items=items, nextCursor=next_cursor)
+
+# Largest radius of a nearby search, half the earth's circumference
+MAX_NEARBY_RADIUS = 20037509
+
+@router.get('/api/friends/nearby')
+async def fetch_nearby_friends(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius: float = Query(5000, gt=0, le=MAX_NEARBY_RADIUS),
+    limit: int = Query(50, ge=1, le=pagination.MAX_PAGE_SIZE),
+    fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
+) -> List[schemas.NearbyFriend]:
+    '''Fetch friends whose latest location lies within `radius` meters, closest first.
+    '''
+    return await repository.run(feed.find_nearby, db, fb_user.uid, lat, lng, radius, limit)
+
+@router.post('/api/friends/create')
 async def create_friend(
     body: requests.CreateRelationRequest,
     fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
@@ -190,54 +398,19 @@ async def create_friend(
     # user cannot be the recipient
     if user_id == recipient_id:
         raise HTTPException(status_code=400, detail=f"User {user_id} cannot equal recipientId")
-    now = int(time())
-    # Check if relationship already exists
-    relations = db.collection("Relations")\
-        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
-        .where(filter=firestore.firestore.FieldFilter('recipientId', '==', body.recipientId))\
-        .get()
-    if len(relations) == 0:
-        # If not, create it
-        relation = schemas.Relation(
-            userId=user_id,
-            recipientId=recipient_id,
-            relation=utils.RELATION_FRIEND,
-            createdAt=now,
-            updatedAt=now,
-        )
-        try:
-            _, relation_ref = db.collection('Relations').add(relation.model_dump())
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to write; error: {e}")
-        relation = schemas.relation_to_pydantic(relation_ref.get(), relation_ref.id)
-    else:
-        relation = schemas.relation_to_pydantic(relations[0], relations[0].id)
-
-    # Check if the reverse relationship exists
-    inv_relations = db.collection("Relations")\
-        .where(filter=firestore.firestore.FieldFilter('userId', '==', body.recipientId))\
-        .where(filter=firestore.firestore.FieldFilter('recipientId', '==', user_id))\
-        .get()
-    if len(inv_relations) == 0:
-        # If no reverse relationship, then create a pending request
-        inv_relation = schemas.Relation(
-            userId=recipient_id,
-            recipientId=user_id,
-            relation=utils.RELATION_FRIEND,
-            createdAt=now,
-            updatedAt=now,
-        )
-        try:
-            _, inv_relation_ref = db.collection('Relations').add(relation.model_dump())
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to write; error: {e}")
-        inv_relation = schemas.relation_to_pydantic(inv_relation_ref.get(), inv_relation_ref.id)
-    else:
-        inv_relation = schemas.relation_to_pydantic(inv_relations[0], inv_relations[0].id)
+    # Both relations and friend lists are written in one transaction
+    try:
+        relation, inv_relation = await repository.run(friends.befriend, db, user_id, recipient_id)
+    except repository.FirestoreTimeout:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to write; error: {e}")
+    finally:
+        friends.invalidate(user_id, recipient_id)
 
     return relation, inv_relation
 
-@app.post('/api/friends/{friend_id}/delete')
+@router.post('/api/friends/{friend_id}/delete')
 async def unfriend(
     friend_id: str,
     fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
@@ -249,65 +422,106 @@ async def unfriend(
     if user_id == friend_id:
         raise HTTPException(status_code=400, detail=f"User {user_id} cannot equal recipientId")
 
-    # Check if relationship already exists
-    relations = db.collection("Relations")\
-        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
-        .where(filter=firestore.firestore.FieldFilter('recipientId', '==', friend_id))\
-        .get()
-    if len(relations) > 0:
-        relation = schemas.relation_to_pydantic(relations[0], relations[0].id)
-        relation_ref = db.collection('Relations').document(relation.relationId)
-        try:
-            relation_ref.delete()
-        except Exception as e:
-            raise HTTPException(status_code=500, default=f"Failed to write; error: {e}")
-
-    # Check if the inverse relationship already exists
-    inv_relations = db.collection("Relations")\
-        .where(filter=firestore.firestore.FieldFilter('userId', '==', friend_id))\
-        .where(filter=firestore.firestore.FieldFilter('recipientId', '==', user_id))\
-        .get()
-    if len(inv_relations) > 0:
-        inv_relation = schemas.relation_to_pydantic(inv_relations[0], inv_relations[0].id)
-        inv_relation_ref = db.collection('Relations').document(inv_relation.relationId)
-        try:
-            inv_relation_ref.delete()
-        except Exception as e:
-            raise HTTPException(status_code=500, default=f"Failed to write; error: {e}")
+    # Both relations and friend lists are deleted in one batched write
+    try:
+        await repository.run(friends.unfriend, db, user_id, friend_id)
+    except repository.FirestoreTimeout:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to write; error: {e}")
+    finally:
+        friends.invalidate(user_id, friend_id)
 
     return True
 
 # --- location endpoints ---
 
-@app.get('/api/locations')
-async def fetch_locations(fb_user: schemas.FBUser = Depends(utils.get_firebase_user)) -> List[schemas.Location]:
-    '''Fetch locations.
+async def load_geofence_index(user_id: str) -> geo.GeofenceIndex:
+    '''Fetch the geofence index over a user's locations, building it on a miss.
+    '''
+    index = geo.geofence_cache.get(user_id)
+    if index is not None:
+        return index
+
+    # Taken before the read, so a write invalidating the cache during the build keeps its index out
+    generation = geo.geofence_cache.generation(user_id)
+
+    async def _build() -> geo.GeofenceIndex:
+        user_locations = await locations.query([('userId', '==', user_id)])
+        index = geo.GeofenceIndex(user_locations)
+        geo.geofence_cache.put_if_current(user_id, index, generation)
+        return index
+
+    # Concurrent misses build the index once, misses after an invalidation do not join an older build
+    return await index_builds.do((user_id, generation), _build)
+
+@router.get('/api/locations')
+async def fetch_locations(
+    limit: int = Query(50, ge=1, le=pagination.MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
+) -> schemas.Page[schemas.Location]:
+    '''Fetch locations, most recently updated first.
     '''
     user_id = fb_user.uid
-    location_docs = db.collection('Locations')\
-        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
-        .order_by('updated_at', direction=firestore.Query.DESCENDING)\
-        .stream()
-    locations = [
-        schemas.location_to_pydantic(location_doc, location_doc.id)
-        for location_doc in location_docs
-    ]
-    return locations
-
-@app.get('/api/locations/{location_id}')
+    items, next_cursor = await reads.do(
+        ('locations', user_id, limit, cursor),
+        lambda: locations.page(
+            [('userId', '==', user_id)],
+            order_by='updatedAt',
+            descending=True,
+            limit=limit,
+            cursor=cursor,
+        ),
+    )
+    return schemas.Page[schemas.Location](items=[schemas.public_location(location) for location in items], nextCursor=next_cursor)
+
+@router.post('/api/locations/match')
+async def match_locations(
+    body: requests.MatchLocationRequest,
+    fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
+) -> List[schemas.Location]:
+    '''Fetch the user's locations that contain a GPS fix.
+    '''
+    index = await load_geofence_index(fb_user.uid)
+    return [schemas.public_location(location) for location in index.match(body.latitude, body.longitude)]
+
+@router.post('/api/locations/batch')
+async def fetch_locations_batch(
+    body: requests.BatchGetRequest,
+    fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
+) -> Dict[str, Optional[schemas.Location]]:
+    '''Fetch locations of the user and their friends by id, None for the rest.
+    '''
+    return await fetch_visible(locations, body.ids, fb_user.uid, schemas.Location, schemas.LOCATION_INTERNAL_FIELDS)
+
+@router.get('/api/locations/{location_id}')
 async def fetch_location(
     location_id: str,
     fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
     ) -> Optional[schemas.Location]:
-    '''Fetch location.
+    '''Fetch a location of the user or a friend, None for the rest.
     '''
-    location_doc = db.collection('Locations').document(location_id).get()
-    if location_doc.exists:
-        location = schemas.location_to_pydantic(location_doc, location_doc.id)
-        return location
-    return None
+    found = await fetch_visible(locations, [location_id], fb_user.uid, schemas.Location, schemas.LOCATION_INTERNAL_FIELDS)
+    return found[location_id]
+
+# Most days of daily totals returned with location stats
+MAX_STATS_DAYS = 366
 
-@app.post('/api/locations/create')
+@router.get('/api/locations/{location_id}/stats')
+async def fetch_location_stats(
+    location_id: str,
+    days: int = Query(30, ge=1, le=MAX_STATS_DAYS),
+    fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
+) -> schemas.LocationStats:
+    '''Visits and dwell time at one of the user's locations, in total and per day.
+    '''
+    location = await locations.get(location_id)
+    if location is None or location.userId != fb_user.uid:
+        raise HTTPException(status_code=400, detail=f"Location {location_id} does not exist")
+    return await repository.run(stats.fetch_stats, db, location, days)
+
+@router.post('/api/locations/create')
 async def create_location(
     body: requests.CreateLocationRequest,
     fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
@@ -315,9 +529,9 @@ async def create_location(
     '''Create a location
     '''
     if body.width <= 0 or body.height <= 0:
-        raise HTTPException(status_code=400, default="Width and height cannot be non positive")
+        raise HTTPException(status_code=400, detail="Width and height cannot be non positive")
     if len(body.tag) == 0:
-        raise HTTPException(status_code=400, default="Tag length cannot be zero")
+        raise HTTPException(status_code=400, detail="Tag length cannot be zero")
 
     now = int(time())
     user_id = fb_user.uid
@@ -328,19 +542,22 @@ async def create_location(
         width=body.width,
         height=body.height,
         tag=body.tag,
+        category=body.category,
+        cells=geo.location_cells(body),
         createdAt=now,
         updatedAt=now,
     )
     # Create the location in Firebase
     try:
-        _, location_ref = db.collection("Locations").add(location.model_dump())
+        location = await locations.create(location)
+    except repository.FirestoreTimeout:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to write location to Firebase: {e}")
-    # Return the location
-    location = schemas.location_to_pydantic(location_ref.get(), location_ref.id)
-    return location
+    geo.geofence_cache.invalidate(user_id)
+    return schemas.public_location(location)
 
-@app.post('/api/locations/{location_id}/edit')
+@router.post('/api/locations/{location_id}/edit')
 async def edit_location(
     location_id: str,
     body: requests.EditLocationRequest,
@@ -349,64 +566,105 @@ async def edit_location(
     '''Edit a location.
     '''
     if body.width <= 0 or body.height <= 0:
-        raise HTTPException(status_code=400, default="Width and height cannot be non positive")
+        raise HTTPException(status_code=400, detail="Width and height cannot be non positive")
     if len(body.tag) == 0:
-        raise HTTPException(status_code=400, default="Tag length cannot be zero")
-    location_ref = db.collection("Locations").document(location_id)
-    location = location_ref.get()
-    if not location.exists:
+        raise HTTPException(status_code=400, detail="Tag length cannot be zero")
+    location = await locations.get(location_id)
+    if location is None:
         raise HTTPException(status_code=400, detail=f"Location {location_id} does not exist")
+    if location.userId != fb_user.uid:
+        raise HTTPException(status_code=403, detail=f"User {fb_user.uid} does not own location {location_id}")
     try:
-        location_ref.update({
+        location = await locations.patch(location_id, {
             'latitude': body.latitude,
             'longitude': body.longitude,
             'width': body.width,
             'height': body.height,
             'tag': body.tag,
             'category': body.category,
+            'cells': geo.location_cells(body),
             'updatedAt': int(time()),
         })
+    except repository.FirestoreTimeout:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, default=f"Failed to write; error: {e}")
-    location = location_ref.get()
-    location = schemas.Location.model_validate(location.to_dict())
-    return location
+        raise HTTPException(status_code=500, detail=f"Failed to write; error: {e}")
+    if location is None:
+        raise HTTPException(status_code=400, detail=f"Location {location_id} does not exist")
+    geo.geofence_cache.invalidate(location.userId)
+    # Keep the location snapshots in the latest event index current
+    await repository.run(latest_events.refresh_location, db, location)
+    return schemas.public_location(location)
 
-@app.post('/api/locations/{location_id}/delete')
+@router.post('/api/locations/{location_id}/delete')
 async def delete_location(
     location_id: str,
     fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
 ) -> bool:
-    '''Delete a location
+    '''Delete a location. Its events, stats and feed entries are removed in the background.
     '''
-    location_ref = db.collection("Locations").document(location_id)
-    location = location_ref.get()
-    if not location.exists:
+    location = await locations.get(location_id)
+    if location is None:
         raise HTTPException(status_code=400, detail=f"Location {location_id} does not exist")
+    if location.userId != fb_user.uid:
+        raise HTTPException(status_code=403, detail=f"User {fb_user.uid} does not own location {location_id}")
     try:
-        location_ref.delete()
+        await locations.delete(location_id)
+        await cascades.enqueue(cascade.KIND_LOCATION, location_id, location.userId)
+    except repository.FirestoreTimeout:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, default=f"Failed to delete; error: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to delete; error: {e}")
+    geo.geofence_cache.invalidate(location.userId)
     return True
 
 # --- event endpoints ---
 
-@app.get('/api/events/{event_id}')
+# Longest time range of an events query, in days
+MAX_EVENT_RANGE_DAYS = 366
+
+@router.get('/api/events')
+async def fetch_events(
+    start: int = Query(..., alias='from', ge=0),
+    end: int = Query(..., alias='to', ge=0),
+    fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
+) -> List[schemas.Event]:
+    '''Fetch the user's events created between `from` (inclusive) and `to` (exclusive), oldest first.
+    '''
+    if end <= start:
+        raise HTTPException(status_code=400, detail="`to` must be after `from`")
+    if end - start > MAX_EVENT_RANGE_DAYS * 24 * 60 * 60:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_EVENT_RANGE_DAYS} days per query")
+    return await repository.run(archive.fetch_events, db, fb_user.uid, start, end)
+
+async def fetch_visible_events(event_ids: List[str], user_id: str) -> Dict[str, Optional[schemas.Event]]:
+    '''Fetch events of a user and their friends, looking in the archives for ids compaction moved.
+    '''
+    return await fetch_visible(events, event_ids, user_id, schemas.Event, fallback=lambda missing: archive.fetch_archived(db, missing))
+
+@router.post('/api/events/batch')
+async def fetch_events_batch(
+    body: requests.BatchGetRequest,
+    fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
+) -> Dict[str, Optional[schemas.Event]]:
+    '''Fetch events of the user and their friends by id, archived or not, None for the rest.
+    '''
+    return await fetch_visible_events(body.ids, fb_user.uid)
+
+@router.get('/api/events/{event_id}')
 async def fetch_event(
     event_id: str,
     fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
     ) -> Optional[schemas.Event]:
-    '''Fetch location.
+    '''Fetch an event of the user or a friend, archived or not, None for the rest.
     '''
-    event_doc = db.collection('Events').document(event_id).get()
-    if event_doc.exists:
-        event = schemas.event_to_pydantic(event_doc, event_doc.id)
-        return event
-    return None
+    found = await fetch_visible_events([event_id], fb_user.uid)
+    return found[event_id]
 
-@app.post('/api/events/create')
+@router.post('/api/events/create')
 async def create_event(
     body: requests.CreateEventRequest,
+    background_tasks: BackgroundTasks,
     fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
 ) -> schemas.Event:
     '''Create a event
@@ -418,28 +676,123 @@ async def create_event(
         createdAt=now,
         updatedAt=now,
     )
-    # Create the location in Firebase
+    # Write the event and the latest event index together
     try:
-        _, event_ref = db.collection("Events").add(event.model_dump())
+        written = await repository.run(latest_events.create_event, db, event)
+    except repository.FirestoreTimeout:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to write event to Firebase: {e}")
-    # Return the event
-    event = schemas.event_to_pydantic(event_ref.get(), event_ref.id)
+    if len(written) == 0:
+        raise HTTPException(status_code=400, detail=f"Location {body.locationId} does not exist")
+    # The previous latest event may have been closed
+    for written_event in written:
+        events.invalidate(written_event.eventId)
+    event = written[-1]
+    background_tasks.add_task(publish_event, event)
+    notifier.enqueue(event)
     return event
 
-@app.post('/api/events/{event_id}/delete')
+@router.post('/api/events/{event_id}/delete')
 async def delete_event(
     event_id: str,
     fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
 ) -> bool:
-    '''Delete a event
+    '''Delete a event, archived or not
     '''
-    event_ref = db.collection("Events").document(event_id)
-    event = event_ref.get()
-    if not event.exists:
+    event = await events.get(event_id)
+    if event is None:
+        archived = await repository.run(archive.fetch_archived, db, [event_id])
+        event = archived.get(event_id)
+    if event is None:
         raise HTTPException(status_code=400, detail=f"Event {event_id} does not exist")
+    if event.userId != fb_user.uid:
+        raise HTTPException(status_code=403, detail=f"User {fb_user.uid} does not own event {event_id}")
     try:
-        event_ref.delete()
+        deleted = await repository.run(latest_events.delete_event, db, event_id)
+    except repository.FirestoreTimeout:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, default=f"Failed to delete; error: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to delete; error: {e}")
+    finally:
+        events.invalidate(event_id)
+    if not deleted:
+        raise HTTPException(status_code=400, detail=f"Event {event_id} does not exist")
     return True
+
+# --- ping endpoints ---
+
+MAX_PINGS_PER_BATCH = 5000
+
+@router.post('/api/pings/batch')
+async def create_pings(
+    body: requests.PingBatchRequest,
+    background_tasks: BackgroundTasks,
+    fb_user: schemas.FBUser = Depends(utils.get_firebase_user),
+) -> List[schemas.Event]:
+    '''Turn a batch of GPS fixes into events.
+    '''
+    if len(body.pings) > MAX_PINGS_PER_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_PINGS_PER_BATCH} pings per batch")
+    user_id = fb_user.uid
+    index = await load_geofence_index(user_id)
+    visits = pings.find_visits(index, body.pings)
+    try:
+        written = await repository.run(pings.write_visits, db, user_id, index, visits)
+    except repository.FirestoreTimeout:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to write events to Firebase: {e}")
+    for event in written:
+        events.invalidate(event.eventId)
+    if len(written) > 0:
+        background_tasks.add_task(publish_event, written[-1])
+        notifier.enqueue(written[-1])
+    return written
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    '''Create the worker's client and start its background workers before it accepts requests.
+    '''
+    await repository.run(database.get_client)
+    notifier.start()
+    cascades.start()
+    yield
+    await cascades.stop()
+    await notifier.stop()
+    database.close_client()
+
+async def firestore_timeout_handler(request: Request, exc: repository.FirestoreTimeout) -> JSONResponse:
+    return JSONResponse(status_code=status.HTTP_504_GATEWAY_TIMEOUT, content={'detail': "Firestore request timed out"})
+
+def create_app() -> FastAPI:
+    '''Build the application.
+
+    Importing this module opens no connections, so a pre-fork server can
+    import it (and call `database.warm_up`) once in its master process.
+    '''
+    app = FastAPI(title="whereabout", lifespan=lifespan)
+
+    # Answer 304 to conditional GETs of unchanged JSON
+    app.add_middleware(etag.ETagMiddleware)
+
+    # Compress larger bodies, e.g. long feeds and location lists
+    app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE, compresslevel=GZIP_LEVEL)
+
+    # Add CORS to site
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # Time requests and count their firestore calls
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    app.include_router(router)
+    app.add_exception_handler(repository.FirestoreTimeout, firestore_timeout_handler)
+    return app
+
+app = create_app()
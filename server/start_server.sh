@@ -1,3 +1,6 @@
 #!/bin/bash
 
-fastapi run main.py --host 0.0.0.0 --port 8000
+# Run from the repository root so the app imports as the `server` package
+cd "$(dirname "$0")/.."
+
+exec gunicorn server.main:app --config server/gunicorn.conf.py
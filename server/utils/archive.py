@@ -0,0 +1,275 @@
+'''Monthly archives of old events.
+
+Events older than `ARCHIVE_AGE_DAYS` are moved out of `Events` into one
+`EventArchives/{userId}_{YYYY-MM}` document per user and UTC month, which
+holds the month's events as packed arrays. A year of history then costs
+about a dozen document reads instead of one read per event.
+
+Each chunk of events is moved in a transaction that rewrites the archive
+and deletes the hot documents together, so an event is always in exactly
+one place. Run `python -m server.utils.archive [days]` to compact.
+
+An archived event keeps its id: it is found by id with a query on the
+archives' `eventIds`, and deleting it rewrites the archive that holds it.
+'''
+from datetime import datetime, timezone
+from os import environ as env
+from time import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from firebase_admin import firestore
+from pydantic import TypeAdapter
+
+from .schemas import Event, EventArchive, event_archive_to_pydantic, event_to_pydantic, latest_event_to_pydantic
+
+EVENT_ARCHIVES = "EventArchives"
+
+# Events older than this many days are archived
+ARCHIVE_AGE_DAYS = int(env.get('EVENT_ARCHIVE_AGE_DAYS', 90))
+
+# Firestore caps a transaction at 500 writes, one of which is the archive
+CHUNK_SIZE = 499
+
+# Firestore allows this many values in an array_contains_any filter
+MAX_DISJUNCTIONS = 30
+
+_events_adapter = TypeAdapter(List[Event])
+
+def archive_ref(db, user_id: str, month: str):
+    return db.collection(EVENT_ARCHIVES).document(f"{user_id}_{month}")
+
+def month_key(timestamp: int) -> str:
+    '''UTC month of epoch seconds, YYYY-MM.
+    '''
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m')
+
+def months_between(start: int, end: int) -> List[str]:
+    '''Months overlapping the time range [start, end).
+    '''
+    first, last = np.array([start, max(start, end - 1)], dtype='datetime64[s]').astype('datetime64[M]')
+    return np.datetime_as_string(np.arange(first, last + 1)).tolist()
+
+def pack(user_id: str, month: str, events: List[Event]) -> EventArchive:
+    '''Archive document holding the given events of one month.
+    '''
+    events = sorted(events, key=lambda event: (event.createdAt, event.eventId))
+    location_ids = list(dict.fromkeys(event.locationId for event in events))
+    positions = {location_id: index for index, location_id in enumerate(location_ids)}
+    created = np.array([event.createdAt for event in events], dtype='<i8')
+    updated = np.array([event.updatedAt for event in events], dtype='<i8')
+    return EventArchive(
+        userId=user_id,
+        month=month,
+        count=len(events),
+        eventIds=[event.eventId for event in events],
+        locationIds=location_ids,
+        createdAt=created.tobytes(),
+        durations=np.maximum(updated - created, 0).astype('<i4').tobytes(),
+        locations=np.array([positions[event.locationId] for event in events], dtype='<i4').tobytes(),
+        updatedAt=int(time()),
+    )
+
+def unpack(archive: EventArchive, start: Optional[int] = None, end: Optional[int] = None) -> List[Event]:
+    '''Events of an archive, optionally only those created in [start, end).
+    '''
+    created = np.frombuffer(archive.createdAt, dtype='<i8')
+    updated = created + np.frombuffer(archive.durations, dtype='<i4')
+    locations = np.frombuffer(archive.locations, dtype='<i4')
+    selected = np.ones(len(created), dtype=bool)
+    if start is not None:
+        selected &= created >= start
+    if end is not None:
+        selected &= created < end
+    location_ids = archive.locationIds
+    return _events_adapter.validate_python([
+        {
+            'eventId': archive.eventIds[index],
+            'userId': archive.userId,
+            'locationId': location_ids[location],
+            'createdAt': created_at,
+            'updatedAt': updated_at,
+        }
+        for index, location, created_at, updated_at in zip(
+            np.flatnonzero(selected).tolist(),
+            locations[selected].tolist(),
+            created[selected].tolist(),
+            updated[selected].tolist(),
+        )
+    ])
+
+def archive_events(db, user_id: str, month: str, events: List[Event]) -> int:
+    '''Move events of one month into its archive in a single transaction.
+    :param db: firestore client
+    :param user_id: owner of the events
+    :param month: UTC month of the events, YYYY-MM
+    :param events: at most CHUNK_SIZE events
+    :return: number of events moved, skipping ones deleted in the meantime and the latest event
+    '''
+    ref = archive_ref(db, user_id, month)
+    latest_ref = db.collection("LatestEvents").document(user_id)
+    event_refs = [db.collection("Events").document(event.eventId) for event in events]
+
+    @firestore.transactional
+    def _archive(transaction) -> int:
+        archive_doc = ref.get(transaction=transaction)
+        archived: Dict[str, Event] = {}
+        if archive_doc.exists:
+            archived = {event.eventId: event for event in unpack(event_archive_to_pydantic(archive_doc))}
+        docs = {doc.reference.path: doc for doc in db.get_all([latest_ref] + event_refs, transaction=transaction)}
+        latest_doc = docs.pop(latest_ref.path)
+        # The latest event stays in `Events`, the next event closes it there
+        latest_id = latest_event_to_pydantic(latest_doc).event.eventId if latest_doc.exists else None
+        moved = 0
+        for event_doc in docs.values():
+            if not event_doc.exists or event_doc.id == latest_id:
+                continue
+            archived[event_doc.id] = event_to_pydantic(event_doc, event_doc.id)
+            transaction.delete(event_doc.reference)
+            moved += 1
+        if moved > 0:
+            transaction.set(ref, pack(user_id, month, list(archived.values())).model_dump())
+        return moved
+
+    return _archive(db.transaction())
+
+def compact_user(db, user_id: str, cutoff: int) -> int:
+    '''Archive a user's events created before a cutoff, one month at a time.
+    :return: number of events archived
+    '''
+    query = db.collection("Events")\
+        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
+        .where(filter=firestore.firestore.FieldFilter('createdAt', '<', cutoff))\
+        .order_by('createdAt')
+    moved = 0
+    month: Optional[str] = None
+    pending: List[Event] = []
+    for event_doc in query.stream():
+        event = event_to_pydantic(event_doc, event_doc.id)
+        event_month = month_key(event.createdAt)
+        if len(pending) > 0 and (event_month != month or len(pending) == CHUNK_SIZE):
+            moved += archive_events(db, user_id, month, pending)
+            pending = []
+        month = event_month
+        pending.append(event)
+    if len(pending) > 0:
+        moved += archive_events(db, user_id, month, pending)
+    return moved
+
+def compact(db, max_age_days: int = ARCHIVE_AGE_DAYS, user_id: Optional[str] = None, now: Optional[int] = None) -> int:
+    '''Archive events older than an age.
+    :param db: firestore client
+    :param max_age_days: age in days after which events are archived
+    :param user_id: only compact this user's events, all users if None
+    :param now: current time in epoch seconds, defaults to now
+    :return: number of events archived
+    '''
+    cutoff = int(now if now is not None else time()) - max_age_days * 24 * 60 * 60
+    if user_id is not None:
+        return compact_user(db, user_id, cutoff)
+    return sum(compact_user(db, user_doc.id, cutoff) for user_doc in db.collection("Users").select([]).stream())
+
+def drop_location(db, user_id: str, location_id: str) -> int:
+    '''Remove the archived events of a deleted location from its owner's archives.
+    :param db: firestore client
+    :param user_id: owner of the location
+    :param location_id: id of the deleted location
+    :return: number of archived events removed
+    '''
+    query = db.collection(EVENT_ARCHIVES)\
+        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
+        .where(filter=firestore.firestore.FieldFilter('locationIds', 'array_contains', location_id))
+
+    @firestore.transactional
+    def _drop(transaction, ref) -> int:
+        archive_doc = ref.get(transaction=transaction)
+        if not archive_doc.exists:
+            return 0
+        archive = event_archive_to_pydantic(archive_doc)
+        events = unpack(archive)
+        kept = [event for event in events if event.locationId != location_id]
+        if len(kept) < len(events):
+            stage_kept(transaction, ref, archive, kept)
+        return len(events) - len(kept)
+
+    return sum(_drop(db.transaction(), archive_doc.reference) for archive_doc in query.stream())
+
+def stage_kept(batch, ref, archive: EventArchive, kept: List[Event]):
+    '''Stage rewriting an archive with only some of its events, deleting it if none are left.
+    '''
+    if len(kept) == 0:
+        batch.delete(ref)
+    else:
+        batch.set(ref, pack(archive.userId, archive.month, kept).model_dump())
+
+def find_archive(db, event_id: str, transaction=None) -> Optional[Tuple[Any, EventArchive]]:
+    '''The archive holding an event, whatever its month.
+    :param db: firestore client
+    :param event_id: id of the archived event
+    :param transaction: read inside this transaction if given
+    :return: reference and archive, None if no archive holds the event
+    '''
+    query = db.collection(EVENT_ARCHIVES)\
+        .where(filter=firestore.firestore.FieldFilter('eventIds', 'array_contains', event_id))\
+        .limit(1)
+    archive_docs = transaction.get(query) if transaction is not None else query.stream()
+    for archive_doc in archive_docs:
+        return archive_doc.reference, event_archive_to_pydantic(archive_doc)
+    return None
+
+def fetch_archived(db, event_ids: List[str]) -> Dict[str, Event]:
+    '''Archived events by id, one query per `MAX_DISJUNCTIONS` ids.
+    :param db: firestore client
+    :param event_ids: ids of events no longer in `Events`
+    :return: map from id to event for the ids found in an archive
+    '''
+    wanted = set(event_ids)
+    found: Dict[str, Event] = {}
+    ids = list(wanted)
+    for start in range(0, len(ids), MAX_DISJUNCTIONS):
+        query = db.collection(EVENT_ARCHIVES)\
+            .where(filter=firestore.firestore.FieldFilter('eventIds', 'array_contains_any', ids[start:start + MAX_DISJUNCTIONS]))
+        for archive_doc in query.stream():
+            archive = event_archive_to_pydantic(archive_doc)
+            found.update((event.eventId, event) for event in unpack(archive) if event.eventId in wanted)
+    return found
+
+def stream_archived(db, user_id: Optional[str] = None) -> Iterable[Event]:
+    '''Every archived event, archive by archive.
+    '''
+    query = db.collection(EVENT_ARCHIVES)
+    if user_id is not None:
+        query = query.where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))
+    for archive_doc in query.stream():
+        yield from unpack(event_archive_to_pydantic(archive_doc))
+
+def fetch_events(db, user_id: str, start: int, end: int) -> List[Event]:
+    '''A user's events created in [start, end), from archives and `Events` together.
+    :param db: firestore client
+    :param user_id: owner of the events
+    :param start: start of the range in epoch seconds, inclusive
+    :param end: end of the range in epoch seconds, exclusive
+    :return: events ordered by creation time
+    '''
+    refs = [archive_ref(db, user_id, month) for month in months_between(start, end)]
+    events: List[Event] = []
+    for archive_doc in db.get_all(refs):
+        if archive_doc.exists:
+            events.extend(unpack(event_archive_to_pydantic(archive_doc), start, end))
+    hot_docs = db.collection("Events")\
+        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
+        .where(filter=firestore.firestore.FieldFilter('createdAt', '>=', start))\
+        .where(filter=firestore.firestore.FieldFilter('createdAt', '<', end))\
+        .order_by('createdAt')\
+        .get()
+    events.extend(event_to_pydantic(event_doc, event_doc.id) for event_doc in hot_docs)
+    events.sort(key=lambda event: (event.createdAt, event.eventId))
+    return events
+
+if __name__ == '__main__':
+    import sys
+    from dotenv import load_dotenv
+    from .database import get_client
+
+    load_dotenv()
+    count = compact(get_client(), int(sys.argv[1]) if len(sys.argv) > 1 else ARCHIVE_AGE_DAYS)
+    print(f"Archived {count} events")
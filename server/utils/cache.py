@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from os import environ as env
+from threading import Lock
+from time import time
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+class LRUCache:
+    '''Thread-safe LRU cache whose entries expire at a given time.
+    '''
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        '''
+        :param max_size: maximum number of entries kept
+        :param ttl: default lifetime of an entry in seconds, None for no expiry
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, Tuple[Optional[float], Any]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any, expires_at: Optional[float] = None):
+        '''
+        :param expires_at: unix time at which the entry expires, defaults to now + ttl
+        '''
+        if expires_at is None and self.ttl is not None:
+            expires_at = time() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'hit_ratio': self.hits / total if total > 0 else 0.0,
+            }
+
+class ModelCache(LRUCache):
+    '''Cache of validated pydantic models keyed by (collection, document id).
+    '''
+
+    def get_many(self, collection: str, doc_ids: List[str]) -> Tuple[Dict[str, Any], List[str]]:
+        '''Split document ids into cached models and ids that must be fetched.
+        :param collection: collection name
+        :param doc_ids: list of document ids
+        :return: map of cached models, list of missing ids
+        '''
+        found: Dict[str, Any] = {}
+        missing: List[str] = []
+        for doc_id in doc_ids:
+            model = self.get((collection, doc_id))
+            if model is None:
+                missing.append(doc_id)
+            else:
+                found[doc_id] = model
+        return found, missing
+
+# Users, Locations and Events change rarely, so a short ttl bounds staleness
+# across workers while writes on this worker invalidate immediately
+model_cache = ModelCache(
+    max_size=int(env.get('MODEL_CACHE_SIZE', 50000)),
+    ttl=float(env.get('MODEL_CACHE_TTL', 60)),
+)
@@ -0,0 +1,374 @@
+'''Background cascade deletes.
+
+Deleting a location or an account removes its own document right away and
+records a `CascadeJobs/{kind}_{targetId}` document; the `CascadeEngine`
+workers then delete everything that depends on it, so the request never
+waits on the user's history.
+
+A job is a list of steps. Most steps page through a query ordered by
+document id and delete each page in one batched write of at most
+`BATCH_SIZE` operations, keeping up to `CONCURRENCY` commits in flight.
+After every page the job records its step and cursor, renewing its lease.
+A job left behind by a crashed or stopped worker is picked up again by the
+sweep once its lease expires and resumes from its checkpoint; deletes are
+idempotent, so replaying the pages in flight at the time is harmless.
+'''
+import asyncio
+import logging
+from os import environ as env
+from time import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from firebase_admin import firestore
+
+from . import archive, friends, geo, latest_events, stats
+from .cache import model_cache
+from .pagination import paginate
+from .repository import run
+from .schemas import CascadeJob, cascade_job_to_pydantic
+
+logger = logging.getLogger(__name__)
+
+CASCADE_JOBS = "CascadeJobs"
+
+KIND_LOCATION = 'location'
+KIND_USER = 'user'
+
+# Firestore caps a batched write at 500 operations
+BATCH_SIZE = 500
+
+# Jobs run at once
+WORKERS = int(env.get('CASCADE_WORKERS', 2))
+# Batched writes in flight per job
+CONCURRENCY = int(env.get('CASCADE_CONCURRENCY', 4))
+# Seconds a worker owns a job without checkpointing before others may take it over
+LEASE_SECONDS = int(env.get('CASCADE_LEASE_SECONDS', 120))
+# Seconds between scans for jobs to resume
+SWEEP_SECONDS = float(env.get('CASCADE_SWEEP_SECONDS', 60))
+# Runs of a job before it is marked failed, each retry waiting a lease longer
+MAX_ATTEMPTS = int(env.get('CASCADE_MAX_ATTEMPTS', 5))
+
+def cascade_job_ref(db, job_id: str):
+    return db.collection(CASCADE_JOBS).document(job_id)
+
+class Step:
+    '''One step of a job: a query whose documents are deleted page by page, or a single call.
+    '''
+
+    def __init__(
+        self,
+        name: str,
+        query: Any = None,
+        stage: Optional[Callable[[Any, Any], None]] = None,
+        writes: int = 1,
+        invalidate: Optional[Callable[[List[Any]], None]] = None,
+        call: Optional[Callable[[], Any]] = None,
+    ):
+        '''
+        :param name: name of the step, for logs
+        :param query: query of the documents to delete
+        :param stage: stages the writes for one document on a batch
+        :param writes: writes staged per document, at most BATCH_SIZE
+        :param invalidate: drops cached copies of a committed page
+        :param call: blocking callable run instead of a query
+        '''
+        self.name = name
+        self.query = query
+        self.stage = stage
+        self.writes = writes
+        self.invalidate = invalidate
+        self.call = call
+
+def _delete(batch, doc):
+    batch.delete(doc.reference)
+
+def _uncache(collection: str) -> Callable[[List[Any]], None]:
+    def _invalidate(docs: List[Any]):
+        for doc in docs:
+            model_cache.invalidate((collection, doc.id))
+    return _invalidate
+
+def location_steps(db, job: CascadeJob) -> List[Step]:
+    '''Steps removing what depends on a deleted location.
+    '''
+    location_id, user_id = job.targetId, job.userId
+    return [
+        # Friends' feeds stop showing the location first
+        Step('latest events', call=lambda: latest_events.drop_location(db, location_id)),
+        Step(
+            'events',
+            query=db.collection("Events").where(filter=firestore.firestore.FieldFilter('locationId', '==', location_id)),
+            stage=_delete,
+            invalidate=_uncache("Events"),
+        ),
+        Step('archives', call=lambda: archive.drop_location(db, user_id, location_id)),
+        Step('stats', call=lambda: stats.drop_location(db, location_id)),
+        Step('latest event', call=lambda: latest_events.rebuild_user(db, user_id)),
+    ]
+
+def user_steps(db, job: CascadeJob) -> List[Step]:
+    '''Steps removing what depends on a deleted account.
+    '''
+    user_id = job.targetId
+
+    def _stage_relation(batch, relation_doc):
+        relation = relation_doc.to_dict()
+        owner_id, recipient_id = relation['userId'], relation['recipientId']
+        other_id = recipient_id if owner_id == user_id else owner_id
+        batch.delete(relation_doc.reference)
+        if owner_id == user_id:
+            # Deletes the inverse before the second query reaches it
+            batch.delete(friends.relation_ref(db, recipient_id, owner_id))
+        batch.set(friends.friend_list_ref(db, other_id), {
+            'userId': other_id,
+            'friendIds': firestore.ArrayRemove([user_id]),
+            'updatedAt': int(time()),
+        }, merge=True)
+
+    def _invalidate_friends(relation_docs: List[Any]):
+        for relation_doc in relation_docs:
+            relation = relation_doc.to_dict()
+            friends.invalidate(relation['userId'], relation['recipientId'])
+
+    def _stage_location(batch, location_doc):
+        batch.delete(location_doc.reference)
+        batch.delete(stats.location_stats_ref(db, location_doc.id))
+
+    def _invalidate_locations(location_docs: List[Any]):
+        _uncache("Locations")(location_docs)
+        # The geofence index built since the account was deleted still holds these
+        geo.geofence_cache.invalidate(user_id)
+
+    def _drop_indexes():
+        batch = db.batch()
+        batch.delete(latest_events.latest_event_ref(db, user_id))
+        batch.delete(friends.friend_list_ref(db, user_id))
+        batch.commit()
+        friends.invalidate(user_id)
+
+    def _owned(collection: str):
+        return db.collection(collection).where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))
+
+    return [
+        # Friends stop reading the account in their feeds first
+        Step('relations', query=_owned("Relations"), stage=_stage_relation, writes=3, invalidate=_invalidate_friends),
+        Step(
+            'inverse relations',
+            query=db.collection("Relations").where(filter=firestore.firestore.FieldFilter('recipientId', '==', user_id)),
+            stage=_stage_relation,
+            writes=2,
+            invalidate=_invalidate_friends,
+        ),
+        Step('indexes', call=_drop_indexes),
+        Step('locations', query=_owned("Locations"), stage=_stage_location, writes=2, invalidate=_invalidate_locations),
+        Step('events', query=_owned("Events"), stage=_delete, invalidate=_uncache("Events")),
+        Step('archives', query=_owned(archive.EVENT_ARCHIVES), stage=_delete),
+    ]
+
+STEPS: Dict[str, Callable[[Any, CascadeJob], List[Step]]] = {
+    KIND_LOCATION: location_steps,
+    KIND_USER: user_steps,
+}
+
+def claim(db, job_id: str, now: int) -> Optional[CascadeJob]:
+    '''Take the lease of a job that is not finished and not leased by another worker.
+    :param db: firestore client
+    :param job_id: id of the job
+    :param now: current time in epoch seconds
+    :return: the claimed job, or None if it cannot be claimed
+    '''
+    ref = cascade_job_ref(db, job_id)
+
+    @firestore.transactional
+    def _claim(transaction) -> Optional[CascadeJob]:
+        job_doc = ref.get(transaction=transaction)
+        if not job_doc.exists:
+            return None
+        job = cascade_job_to_pydantic(job_doc)
+        if job.status in ('done', 'failed') or job.leaseUntil > now:
+            return None
+        job = job.model_copy(update={'status': 'running', 'leaseUntil': now + LEASE_SECONDS, 'updatedAt': now})
+        transaction.set(ref, job.model_dump(exclude={'jobId'}))
+        return job
+
+    return _claim(db.transaction())
+
+def fetch_resumable(db, now: int) -> List[str]:
+    '''Ids of unfinished jobs whose lease has expired.
+    '''
+    job_docs = db.collection(CASCADE_JOBS)\
+        .where(filter=firestore.firestore.FieldFilter('status', 'in', ['pending', 'running']))\
+        .stream()
+    return [job_doc.id for job_doc in job_docs if job_doc.get('leaseUntil') <= now]
+
+class CascadeEngine:
+    '''Persisted cascade jobs and the workers running them.
+    '''
+
+    def __init__(self, db, workers: int = WORKERS, concurrency: int = CONCURRENCY):
+        '''
+        :param db: firestore client
+        :param workers: jobs run at once
+        :param concurrency: batched writes in flight per job
+        '''
+        self.db = db
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.num_workers = workers
+        self.concurrency = concurrency
+        self.workers: List[asyncio.Task] = []
+        # Ids of jobs queued or running in this process
+        self.scheduled: Set[str] = set()
+        self.counts = {
+            'enqueued': 0,
+            'resumed': 0,
+            'completed': 0,
+            'retried': 0,
+            'failed': 0,
+            'batches': 0,
+            'deleted': 0,
+        }
+
+    def start(self):
+        for _ in range(self.num_workers):
+            self.workers.append(asyncio.create_task(self._work()))
+        self.workers.append(asyncio.create_task(self._sweep()))
+
+    async def stop(self):
+        '''Stop the workers; unfinished jobs resume from their checkpoints later.
+        '''
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def enqueue(self, kind: str, target_id: str, user_id: str) -> CascadeJob:
+        '''Record a job and schedule it without waiting for it to run.
+        :param kind: KIND_LOCATION or KIND_USER
+        :param target_id: id of the deleted location or user
+        :param user_id: owner of the deleted data
+        :return: the recorded job
+        '''
+        now = int(time())
+        job = CascadeJob(
+            jobId=f"{kind}_{target_id}",
+            kind=kind,
+            targetId=target_id,
+            userId=user_id,
+            createdAt=now,
+            updatedAt=now,
+        )
+        await run(cascade_job_ref(self.db, job.jobId).set, job.model_dump(exclude={'jobId'}))
+        self.counts['enqueued'] += 1
+        self.schedule(job.jobId)
+        return job
+
+    def schedule(self, job_id: str) -> bool:
+        '''Queue a recorded job unless this process already has it.
+        '''
+        if job_id in self.scheduled:
+            return False
+        self.scheduled.add(job_id)
+        self.queue.put_nowait(job_id)
+        return True
+
+    async def _sweep(self):
+        while True:
+            try:
+                for job_id in await run(fetch_resumable, self.db, int(time())):
+                    if self.schedule(job_id):
+                        self.counts['resumed'] += 1
+            except Exception:
+                logger.exception("Failed to scan for cascade jobs")
+            await asyncio.sleep(SWEEP_SECONDS)
+
+    async def _work(self):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self.process(job_id)
+            except Exception:
+                logger.exception("Failed to run cascade job %s", job_id)
+            finally:
+                self.scheduled.discard(job_id)
+                self.queue.task_done()
+
+    async def checkpoint(self, job: CascadeJob, lease: int = LEASE_SECONDS):
+        '''Save a job's progress and hold its lease for another `lease` seconds.
+        '''
+        now = int(time())
+        job.updatedAt = now
+        job.leaseUntil = now + lease
+        await run(cascade_job_ref(self.db, job.jobId).set, job.model_dump(exclude={'jobId'}))
+
+    async def process(self, job_id: str):
+        '''Run a job from its checkpoint to the end.
+        '''
+        job = await run(claim, self.db, job_id, int(time()))
+        if job is None:
+            return
+        steps: List[Step] = []
+        try:
+            steps = STEPS[job.kind](self.db, job)
+            while job.step < len(steps):
+                step = steps[job.step]
+                if step.call is not None:
+                    await run(step.call, timeout=LEASE_SECONDS)
+                else:
+                    await self.delete_query(job, step)
+                job.step += 1
+                job.cursor = None
+                await self.checkpoint(job)
+        except Exception as e:
+            job.attempts += 1
+            job.status = 'failed' if job.attempts >= MAX_ATTEMPTS else 'pending'
+            job.error = f"{steps[job.step].name if job.step < len(steps) else job.kind}: {e}"
+            self.counts['failed' if job.status == 'failed' else 'retried'] += 1
+            # The lease doubles as the delay before the sweep retries the job
+            await self.checkpoint(job, lease=LEASE_SECONDS * job.attempts)
+            raise
+        job.status = 'done'
+        job.error = None
+        await self.checkpoint(job, lease=0)
+        self.counts['completed'] += 1
+
+    async def delete_query(self, job: CascadeJob, step: Step):
+        '''Delete a step's documents page by page from the job's cursor.
+
+        Pages are read ahead of their commits, which stay correct because
+        every page starts after the last id of the previous one. The cursor
+        is checkpointed in page order, only once all earlier commits are done.
+        '''
+        query = step.query.order_by('__name__')
+        page_size = BATCH_SIZE // step.writes
+        cursor = job.cursor
+        # Commits in page order with the cursor after their page
+        pending: List[Tuple[asyncio.Future, Optional[str]]] = []
+        try:
+            while True:
+                docs, cursor = await run(paginate, query, ['__name__'], page_size, cursor)
+                if len(docs) > 0:
+                    pending.append((asyncio.ensure_future(self.commit(step, docs)), cursor))
+                while len(pending) > 0 and (len(pending) >= self.concurrency or cursor is None):
+                    commit, job.cursor = pending.pop(0)
+                    job.deleted += await commit
+                    await self.checkpoint(job)
+                if cursor is None:
+                    return
+        finally:
+            await asyncio.gather(*(commit for commit, _ in pending), return_exceptions=True)
+
+    async def commit(self, step: Step, docs: List[Any]) -> int:
+        '''Delete one page in a single batched write.
+        :return: number of documents deleted
+        '''
+        batch = self.db.batch()
+        for doc in docs:
+            step.stage(batch, doc)
+        await run(batch.commit)
+        if step.invalidate is not None:
+            step.invalidate(docs)
+        self.counts['batches'] += 1
+        self.counts['deleted'] += len(docs)
+        return len(docs)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.counts, 'queued': self.queue.qsize(), 'scheduled': len(self.scheduled)}
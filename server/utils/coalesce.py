@@ -0,0 +1,81 @@
+'''Single-flight coalescing of identical concurrent reads.
+
+Bursts of the same request from one user, e.g. several screens mounting
+at once, share a single computation: the first caller runs it and the
+others await its result. Keys include the route, the caller's uid and
+the parameters, so only truly identical reads are merged.
+
+With a window set, results are also served for that many seconds after
+they complete. Such a micro-cache can hide the caller's own writes for
+the length of the window, so it is off unless COALESCE_WINDOW is set.
+'''
+import asyncio
+from os import environ as env
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from .cache import LRUCache
+
+# Set to 0 to run every read on its own, e.g. to measure the savings
+COALESCE_READS = env.get('COALESCE_READS', '1') == '1'
+# Seconds a result keeps being served after it completes, 0 to disable
+COALESCE_WINDOW = float(env.get('COALESCE_WINDOW', 0))
+
+class SingleFlight:
+    '''Shares in-flight and just-finished results of calls with the same key.
+    '''
+
+    def __init__(self, window: float = COALESCE_WINDOW, max_size: int = 10000, enabled: bool = COALESCE_READS):
+        '''
+        :param window: seconds results are reused after completing, 0 to only share in-flight calls
+        :param max_size: maximum number of completed results kept
+        :param enabled: False to call fn every time
+        '''
+        self.enabled = enabled
+        self.window = window
+        self.inflight: Dict[Hashable, asyncio.Task] = {}
+        self.recent: Optional[LRUCache] = LRUCache(max_size=max_size, ttl=window) if window > 0 else None
+        self.calls = 0
+        self.coalesced = 0
+        self.cached = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        '''Run fn, or wait for the run already in progress under the same key.
+
+        The run is a task of its own, so a caller that disconnects does not
+        cancel it for the others. Errors are shared like results.
+        :param key: identity of the call
+        :param fn: coroutine function computing the result
+        :return: the result of fn
+        '''
+        if not self.enabled:
+            self.calls += 1
+            return await fn()
+        if self.recent is not None:
+            entry = self.recent.get(key)
+            if entry is not None:
+                self.cached += 1
+                return entry[0]
+        task = self.inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if self.recent is not None and not task.cancelled() and task.exception() is None:
+            # Wrapped so that a None result is cached too
+            self.recent.put(key, (task.result(),))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'cached': self.cached,
+            'inflight': len(self.inflight),
+        }
@@ -1,19 +1,98 @@
+from os import environ as env
+from functools import lru_cache
 from os.path import dirname, join
 from typing import Optional
 from firebase_admin import firestore, credentials, get_app, initialize_app
 
+from . import metrics, storage
+
 SERVICE_ACCOUNT_FILE = join(dirname(__file__), '../firebase.json')
 FIREBASE_STORAGE_BUCKET = 'gs://whereabout-81534.appspot.com'
 
+# Storage backends selectable with WHEREABOUT_STORAGE
+STORAGE_BACKENDS = ('firestore', 'memory', 'sqlite')
+
+_client = None
+
+@lru_cache(maxsize=None)
+def initialize_firebase(service_account_file: Optional[str] = SERVICE_ACCOUNT_FILE):
+  '''Parse the service account and register the default firebase app.
+
+  Opens no connections, so it is safe to run before worker processes fork.
+  :param service_account_file: path to service account file
+  :return: the firebase app
+  '''
+  try:
+      return get_app()
+  except ValueError:
+      return initialize_app(credentials.Certificate(service_account_file))
+
 def get_firebase_client(service_account_file: Optional[str] = SERVICE_ACCOUNT_FILE) -> firestore.firestore.Client:
   '''Instantiate a firebase client.
   :param service_account_file: path to service account file
   :return: a firebase client
   '''
-  firebase_credentials = credentials.Certificate(service_account_file)
-  try:
-      get_app()
-  except ValueError:
-      initialize_app(firebase_credentials)
+  initialize_firebase(service_account_file)
   client = firestore.client()
   return client
+
+def storage_backend() -> str:
+  '''Name of the configured storage backend.
+  '''
+  backend = env.get('WHEREABOUT_STORAGE', 'firestore')
+  if backend not in STORAGE_BACKENDS:
+    raise ValueError(f"Unknown storage backend: {backend}")
+  return backend
+
+def get_client():
+  '''Client of the configured storage backend, shared by the whole process.
+
+  `WHEREABOUT_STORAGE=memory` keeps documents in process memory and
+  `WHEREABOUT_STORAGE=sqlite` keeps them in `WHEREABOUT_SQLITE_PATH`; both
+  run without network access or service account credentials. Every call
+  is counted in the metrics registry.
+  :return: a firestore compatible client
+  '''
+  global _client
+  if _client is None:
+    backend = storage_backend()
+    if backend == 'memory':
+      client = storage.MemoryClient()
+    elif backend == 'sqlite':
+      client = storage.SqliteClient(env.get('WHEREABOUT_SQLITE_PATH', 'whereabout.sqlite3'))
+    else:
+      client = get_firebase_client()
+    _client = metrics.instrument(client)
+  return _client
+
+def is_ready() -> bool:
+  '''Whether this process has created its shared client.
+  '''
+  return _client is not None
+
+def close_client():
+  '''Close the shared client, the next `get_client` creates a new one.
+  '''
+  global _client
+  if _client is not None:
+    _client.close()
+    _client = None
+
+def warm_up():
+  '''Do the fork-safe part of client setup ahead of time.
+
+  Call from a pre-fork server's master process so workers inherit the
+  parsed credentials; each worker still opens its own connections.
+  '''
+  if storage_backend() == 'firestore':
+    initialize_firebase()
+
+class LazyClient:
+  '''Stand-in for the shared client that creates it on first use.
+  '''
+
+  def __getattr__(self, name: str):
+    return getattr(get_client(), name)
+
+# Importing modules hold this instead of creating a client at import time
+client = LazyClient()
@@ -0,0 +1,65 @@
+'''Conditional GET support for JSON responses.
+
+`ETagMiddleware` tags every JSON `GET` response with a hash of its body and
+answers `304 Not Modified` without a body when the client already holds
+that version, e.g. an unchanged feed or location list.
+'''
+from hashlib import blake2b
+from starlette.datastructures import Headers, MutableHeaders
+
+def compute_etag(body: bytes) -> str:
+    # Weak, since compression further out changes the bytes on the wire
+    return f'W/"{blake2b(body, digest_size=16).hexdigest()}"'
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
+
+class ETagMiddleware:
+    '''ASGI middleware adding ETags to JSON GET responses.
+
+    Only complete `200` JSON bodies are buffered and hashed; streamed and
+    non-JSON responses pass through untouched.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET':
+            return await self.app(scope, receive, send)
+        if_none_match = Headers(scope=scope).get('if-none-match')
+        start_message = None
+        chunks = []
+        passthrough = False
+
+        async def send_tagged(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                return await send(message)
+            if message['type'] == 'http.response.start':
+                content_type = Headers(raw=message['headers']).get('content-type', '')
+                if message['status'] != 200 or not content_type.startswith('application/json'):
+                    passthrough = True
+                    return await send(message)
+                start_message = message
+                return
+            chunks.append(message.get('body', b''))
+            if message.get('more_body', False):
+                return
+            body = b''.join(chunks)
+            etag = compute_etag(body)
+            headers = MutableHeaders(raw=start_message['headers'])
+            headers['etag'] = etag
+            # Cacheable by the client only, and always revalidated
+            headers['cache-control'] = 'private, no-cache'
+            if if_none_match is not None and etag_matches(etag, if_none_match):
+                del headers['content-type']
+                del headers['content-length']
+                await send({**start_message, 'status': 304})
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            await send(start_message)
+            await send({'type': 'http.response.body', 'body': body})
+
+        await self.app(scope, receive, send_tagged)
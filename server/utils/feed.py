@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Dict, List, Optional
+import numpy as np
+
+from .cache import model_cache
+from .friends import fetch_friend_ids, fetch_friend_page
+from .geo import haversine, nearby_cells
+from .schemas import User, FeedItem, NearbyFriend, Page, public_location, public_user, user_to_pydantic
+from .latest_events import fetch_latest_events, fetch_positions
+
+# Upper bound on concurrent batched gets
+FEED_MAX_WORKERS = 16
+
+# Friend counts above which distances are only computed for nearby cells
+NEARBY_PREFILTER_SIZE = 1000
+
+_executor = ThreadPoolExecutor(max_workers=FEED_MAX_WORKERS, thread_name_prefix='feed')
+
+def fetch_users(db, user_ids: List[str]) -> Dict[str, User]:
+    '''Fetch many users in a single batched get.
+    :param db: firestore client
+    :param user_ids: list of user ids
+    :return: map from user id to user, missing users are omitted
+    '''
+    users, user_ids = model_cache.get_many("Users", user_ids)
+    if len(user_ids) == 0:
+        return users
+    refs = [db.collection("Users").document(user_id) for user_id in user_ids]
+    for user_doc in db.get_all(refs):
+        if user_doc.exists:
+            users[user_doc.id] = user_to_pydantic(user_doc)
+            model_cache.put(("Users", user_doc.id), users[user_doc.id])
+    return users
+
+def build_feed(db, user_id: str, limit: int, cursor: Optional[str] = None) -> Page[FeedItem]:
+    '''Assemble the feed of latest friend events.
+
+    After the friend page is read from the user's friend list, the
+    friends' `Users` docs and their
+    `LatestEvents` index docs are fetched as two concurrent batched gets.
+    :param db: firestore client
+    :param user_id: id of the user requesting the feed
+    :param limit: number of friends per page
+    :param cursor: cursor returned with the previous page
+    :return: page of feed items, in friend order
+    '''
+    friend_ids, next_cursor = fetch_friend_page(db, user_id, limit, cursor)
+    friends_future = _executor.submit(copy_context().run, fetch_users, db, friend_ids)
+    latest_future = _executor.submit(copy_context().run, fetch_latest_events, db, friend_ids)
+    friends, latest_events = friends_future.result(), latest_future.result()
+
+    feed_items: List[FeedItem] = []
+    for friend_id in friend_ids:
+        friend = friends.get(friend_id)
+        latest = latest_events.get(friend_id)
+        if friend is None or latest is None:
+            continue
+        feed_items.append(FeedItem(user=public_user(friend), event=latest.event, location=public_location(latest.location)))
+    return Page[FeedItem](items=feed_items, nextCursor=next_cursor)
+
+def find_nearby(db, user_id: str, latitude: float, longitude: float, radius: float, limit: int) -> List[NearbyFriend]:
+    '''Friends whose latest location is within a radius of a point, closest first.
+
+    Only the coordinates of every friend's latest event are read; the
+    distances are one vectorized pass and the full documents are fetched
+    for the returned friends alone.
+    :param db: firestore client
+    :param user_id: id of the requesting user
+    :param latitude: latitude of the point
+    :param longitude: longitude of the point
+    :param radius: search radius in meters
+    :param limit: maximum number of friends returned
+    :return: nearby friends sorted by distance
+    '''
+    friend_ids, latitudes, longitudes = fetch_positions(db, fetch_friend_ids(db, user_id))
+    candidates = np.arange(len(friend_ids))
+    if len(candidates) > NEARBY_PREFILTER_SIZE:
+        candidates = np.flatnonzero(nearby_cells(latitude, longitude, radius, latitudes, longitudes))
+    distances = haversine(latitude, longitude, latitudes[candidates], longitudes[candidates])
+    inside = np.flatnonzero(distances <= radius)
+    if len(inside) > limit:
+        inside = inside[np.argpartition(distances[inside], limit - 1)[:limit]]
+    inside = inside[np.argsort(distances[inside], kind='stable')]
+    nearby_ids = [friend_ids[index] for index in candidates[inside]]
+    friends_future = _executor.submit(copy_context().run, fetch_users, db, nearby_ids)
+    latest_future = _executor.submit(copy_context().run, fetch_latest_events, db, nearby_ids)
+    friends, latest_events = friends_future.result(), latest_future.result()
+
+    nearby: List[NearbyFriend] = []
+    for friend_id, distance in zip(nearby_ids, distances[inside].tolist()):
+        friend = friends.get(friend_id)
+        latest = latest_events.get(friend_id)
+        if friend is None or latest is None:
+            continue
+        nearby.append(NearbyFriend(user=public_user(friend), event=latest.event, location=public_location(latest.location), distance=distance))
+    return nearby
@@ -0,0 +1,210 @@
+'''Adjacency lists of the friend graph.
+
+`FriendLists/{userId}` holds the ids of all of a user's friends, so listing
+friends is a single document read. It is derived from `Relations`; run
+`python -m server.utils.friends` to rebuild it.
+'''
+from bisect import bisect_right
+from os import environ as env
+from time import time
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+from fastapi import HTTPException
+from firebase_admin import firestore
+
+from .cache import LRUCache
+from .pagination import decode_cursor, encode_cursor
+from .schemas import FriendList, Relation, relation_to_pydantic
+
+FRIEND_LISTS = "FriendLists"
+
+RELATION_FRIEND = 1
+
+# Firestore caps a batched write at 500 operations
+BATCH_SIZE = 500
+
+# Sorted friend ids and the same ids as a set, keyed by user id
+friend_list_cache = LRUCache(
+    max_size=int(env.get('FRIEND_LIST_CACHE_SIZE', 50000)),
+    ttl=float(env.get('MODEL_CACHE_TTL', 60)),
+)
+
+def friend_list_ref(db, user_id: str):
+    return db.collection(FRIEND_LISTS).document(user_id)
+
+def relation_id(user_id: str, recipient_id: str) -> str:
+    '''Deterministic id of the relation from a user to a recipient.
+    '''
+    return f"{user_id}_{recipient_id}"
+
+def relation_ref(db, user_id: str, recipient_id: str):
+    return db.collection("Relations").document(relation_id(user_id, recipient_id))
+
+def _load(db, user_id: str) -> Tuple[List[str], FrozenSet[str]]:
+    entry = friend_list_cache.get(user_id)
+    if entry is not None:
+        return entry
+    friend_list_doc = friend_list_ref(db, user_id).get()
+    friend_ids: List[str] = []
+    if friend_list_doc.exists:
+        friend_ids = FriendList.model_validate(friend_list_doc.to_dict()).friendIds
+    entry = (sorted(set(friend_ids)), frozenset(friend_ids))
+    friend_list_cache.put(user_id, entry)
+    return entry
+
+def fetch_friend_ids(db, user_id: str) -> List[str]:
+    '''All friend ids of a user, sorted.
+    :param db: firestore client
+    :param user_id: id of the user
+    :return: sorted list of friend ids
+    '''
+    friend_ids, _ = _load(db, user_id)
+    return friend_ids
+
+def fetch_friend_page(db, user_id: str, limit: int, cursor: Optional[str] = None) -> Tuple[List[str], Optional[str]]:
+    '''One page of a user's friend ids.
+    :param db: firestore client
+    :param user_id: id of the user
+    :param limit: page size
+    :param cursor: cursor returned with the previous page
+    :return: list of friend ids, cursor of the next page
+    '''
+    friend_ids, _ = _load(db, user_id)
+    start = 0
+    if cursor is not None:
+        values = decode_cursor(cursor)
+        if len(values) != 1:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        start = bisect_right(friend_ids, str(values[0]))
+    page = friend_ids[start:start + limit]
+    next_cursor = None
+    if start + limit < len(friend_ids):
+        next_cursor = encode_cursor([page[-1]])
+    return page, next_cursor
+
+def are_friends(db, user_id: str, friend_id: str) -> bool:
+    _, friend_set = _load(db, user_id)
+    return friend_id in friend_set
+
+def invalidate(*user_ids: str):
+    for user_id in user_ids:
+        friend_list_cache.invalidate(user_id)
+
+def add_friends(batch, db, user_id: str, friend_id: str):
+    '''Stage adding a friendship to both users' lists on a batch or transaction.
+    '''
+    now = int(time())
+    for owner_id, other_id in ((user_id, friend_id), (friend_id, user_id)):
+        batch.set(friend_list_ref(db, owner_id), {
+            'userId': owner_id,
+            'friendIds': firestore.ArrayUnion([other_id]),
+            'updatedAt': now,
+        }, merge=True)
+
+def remove_friends(batch, db, user_id: str, friend_id: str):
+    '''Stage removing a friendship from both users' lists on a batch or transaction.
+    '''
+    now = int(time())
+    for owner_id, other_id in ((user_id, friend_id), (friend_id, user_id)):
+        batch.set(friend_list_ref(db, owner_id), {
+            'userId': owner_id,
+            'friendIds': firestore.ArrayRemove([other_id]),
+            'updatedAt': now,
+        }, merge=True)
+
+def befriend(db, user_id: str, recipient_id: str) -> Tuple[Relation, Relation]:
+    '''Create both relation docs and friend list entries in one transaction.
+
+    Relations have deterministic ids, so existence is one batched get and
+    a repeated or concurrent request converges on the same documents.
+    :param db: firestore client
+    :param user_id: id of the requesting user
+    :param recipient_id: id of the new friend
+    :return: the relation and its inverse
+    '''
+    pairs = ((user_id, recipient_id), (recipient_id, user_id))
+    refs = [relation_ref(db, owner_id, other_id) for owner_id, other_id in pairs]
+
+    @firestore.transactional
+    def _befriend(transaction) -> Tuple[Relation, Relation]:
+        docs = {doc.id: doc for doc in db.get_all(refs, transaction=transaction)}
+        now = int(time())
+        relations: List[Relation] = []
+        for ref, (owner_id, other_id) in zip(refs, pairs):
+            doc = docs.get(ref.id)
+            if doc is not None and doc.exists:
+                relations.append(relation_to_pydantic(doc, doc.id))
+                continue
+            relation = Relation(
+                relationId=ref.id,
+                userId=owner_id,
+                recipientId=other_id,
+                relation=RELATION_FRIEND,
+                createdAt=now,
+                updatedAt=now,
+            )
+            transaction.set(ref, relation.model_dump())
+            relations.append(relation)
+        add_friends(transaction, db, user_id, recipient_id)
+        return relations[0], relations[1]
+
+    return _befriend(db.transaction())
+
+def unfriend(db, user_id: str, friend_id: str):
+    '''Delete both relation docs and friend list entries in one batched write.
+
+    Deleting a missing document is a no-op, so no reads are needed.
+    :param db: firestore client
+    :param user_id: id of the requesting user
+    :param friend_id: id of the friend to remove
+    '''
+    batch = db.batch()
+    batch.delete(relation_ref(db, user_id, friend_id))
+    batch.delete(relation_ref(db, friend_id, user_id))
+    remove_friends(batch, db, user_id, friend_id)
+    batch.commit()
+
+def migrate(db) -> int:
+    '''Rebuild every friend list from the `Relations` collection.
+
+    Relations stored under auto-generated ids are moved to their
+    deterministic ids along the way.
+    :param db: firestore client
+    :return: number of friend lists written
+    '''
+    adjacency: Dict[str, Set[str]] = {}
+    batch, size = db.batch(), 0
+    for relation_doc in db.collection("Relations").stream():
+        relation = relation_to_pydantic(relation_doc, relation_doc.id)
+        expected_id = relation_id(relation.userId, relation.recipientId)
+        if relation_doc.id != expected_id:
+            relation = relation.model_copy(update={'relationId': expected_id})
+            batch.set(relation_ref(db, relation.userId, relation.recipientId), relation.model_dump())
+            batch.delete(relation_doc.reference)
+            size += 2
+            if size >= BATCH_SIZE - 1:
+                batch.commit()
+                batch, size = db.batch(), 0
+        if relation.relation != RELATION_FRIEND:
+            continue
+        adjacency.setdefault(relation.userId, set()).add(relation.recipientId)
+    if size > 0:
+        batch.commit()
+
+    now = int(time())
+    user_ids = sorted(adjacency)
+    for start in range(0, len(user_ids), BATCH_SIZE):
+        batch = db.batch()
+        for user_id in user_ids[start:start + BATCH_SIZE]:
+            friend_list = FriendList(userId=user_id, friendIds=sorted(adjacency[user_id]), updatedAt=now)
+            batch.set(friend_list_ref(db, user_id), friend_list.model_dump())
+        batch.commit()
+    invalidate(*user_ids)
+    return len(user_ids)
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from .database import get_client
+
+    load_dotenv()
+    count = migrate(get_client())
+    print(f"Migrated {count} friend lists")
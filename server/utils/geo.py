@@ -0,0 +1,247 @@
+'''Geohash cell keys and an in-memory geofence index for Locations.
+
+A Location is a rectangle centered on (latitude, longitude) that spans
+`width` degrees of longitude and `height` degrees of latitude.
+'''
+from math import asin, ceil, cos, degrees, floor, radians, sin
+from threading import RLock
+from typing import Dict, List, Tuple
+import numpy as np
+
+from .cache import LRUCache
+from .schemas import Location
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Finest precision used for cell keys, cells are roughly 1.2km x 0.6km
+GEOHASH_PRECISION = 6
+# Coarsen the cells of large regions until they are covered by this many keys
+MAX_CELLS = 32
+
+# Mean earth radius in meters
+EARTH_RADIUS = 6371008.8
+
+class GeofenceCache(LRUCache):
+    '''Per-user geofence indexes with a generation that every invalidation bumps.
+
+    A build records the generation before it reads the locations and only
+    stores its index if no invalidation happened in the meantime, so an
+    index built from locations read before a write is never cached after it.
+    '''
+
+    def __init__(self, max_size: int, ttl: float):
+        super().__init__(max_size=max_size, ttl=ttl)
+        # Reentrant so that the generation check and the put happen under one hold
+        self._lock = RLock()
+        self._generations: Dict[str, int] = {}
+
+    def generation(self, user_id: str) -> int:
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            self._entries.pop(user_id, None)
+
+    def put_if_current(self, user_id: str, index: 'GeofenceIndex', generation: int) -> bool:
+        '''Cache an index unless the user's locations changed since `generation`.
+        :return: False if the index is already stale and was not cached
+        '''
+        with self._lock:
+            if self._generations.get(user_id, 0) != generation:
+                return False
+            self.put(user_id, index)
+            return True
+
+# Per-user indexes, invalidated whenever one of the user's locations changes
+geofence_cache = GeofenceCache(max_size=10000, ttl=300)
+
+def encode(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    '''Geohash of a point.
+    :param latitude: latitude in degrees
+    :param longitude: longitude in degrees
+    :param precision: number of characters
+    :return: geohash string
+    '''
+    latitude = min(max(latitude, -90.0), 90.0)
+    longitude = (longitude + 180.0) % 360.0 - 180.0
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars: List[str] = []
+    bit, value, even = 0, 0, True
+    while len(chars) < precision:
+        bounds, coordinate = (lng_range, longitude) if even else (lat_range, latitude)
+        middle = (bounds[0] + bounds[1]) / 2
+        if coordinate >= middle:
+            value = (value << 1) | 1
+            bounds[0] = middle
+        else:
+            value = value << 1
+            bounds[1] = middle
+        even = not even
+        bit += 1
+        if bit == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bit, value = 0, 0
+    return ''.join(chars)
+
+def cell_size(precision: int) -> Tuple[float, float]:
+    '''Size of a geohash cell in degrees.
+    :return: (height in latitude, width in longitude)
+    '''
+    bits = 5 * precision
+    lng_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+def cover(
+    latitude: float,
+    longitude: float,
+    width: float,
+    height: float,
+    precision: int = GEOHASH_PRECISION,
+    ) -> List[str]:
+    '''Geohash cells that together cover a rectangle.
+    :param precision: starting precision, lowered until at most MAX_CELLS are needed
+    :return: list of geohash cells
+    '''
+    lat_min = max(latitude - height / 2, -90.0)
+    lat_max = min(latitude + height / 2, 90.0)
+    lng_min = longitude - width / 2
+    while precision > 1:
+        cell_height, cell_width = cell_size(precision)
+        rows = floor((lat_max + 90.0) / cell_height) - floor((lat_min + 90.0) / cell_height) + 1
+        cols = floor((lng_min + width + 180.0) / cell_width) - floor((lng_min + 180.0) / cell_width) + 1
+        if rows * cols <= MAX_CELLS:
+            break
+        precision -= 1
+    cell_height, cell_width = cell_size(precision)
+    first_row = floor((lat_min + 90.0) / cell_height)
+    last_row = floor((lat_max + 90.0) / cell_height)
+    first_col = floor((lng_min + 180.0) / cell_width)
+    last_col = floor((lng_min + width + 180.0) / cell_width)
+    cells = {
+        encode(
+            (row + 0.5) * cell_height - 90.0,
+            (col + 0.5) * cell_width - 180.0,
+            precision,
+        )
+        for row in range(first_row, last_row + 1)
+        for col in range(first_col, last_col + 1)
+    }
+    return sorted(cells)
+
+def haversine(latitude: float, longitude: float, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    '''Great-circle distances from one point to many.
+    :param latitude: latitude of the point in degrees
+    :param longitude: longitude of the point in degrees
+    :param latitudes: array of latitudes in degrees
+    :param longitudes: array of longitudes in degrees
+    :return: array of distances in meters
+    '''
+    latitude, longitude = radians(latitude), radians(longitude)
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((latitudes - latitude) / 2) ** 2 + \
+        cos(latitude) * np.cos(latitudes) * np.sin((longitudes - longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def nearby_cells(latitude: float, longitude: float, radius: float, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    '''Points in the geohash cells around a point that a circle can reach.
+
+    Cells are those of the finest precision at which the circle spans at
+    most one cell of latitude each way, so the test is a few integer
+    comparisons per point and never drops a point inside the circle.
+    :param radius: radius of the circle in meters
+    :return: boolean array, True for points that may be within the radius
+    '''
+    angle = radius / EARTH_RADIUS
+    # Longitude reach of the circle, the whole circle of latitude near the poles
+    if angle >= np.pi / 2 or sin(angle) >= cos(radians(latitude)):
+        return np.ones(len(latitudes), dtype=bool)
+    lat_reach = degrees(angle)
+    lng_reach = degrees(asin(sin(angle) / cos(radians(latitude))))
+    precision = GEOHASH_PRECISION
+    while precision > 1 and cell_size(precision)[0] < lat_reach:
+        precision -= 1
+    cell_height, cell_width = cell_size(precision)
+    columns = round(360.0 / cell_width)
+    rows = np.floor((latitudes + 90.0) / cell_height) - floor((latitude + 90.0) / cell_height)
+    cols = np.abs(np.floor((longitudes + 180.0) / cell_width) - floor((longitude + 180.0) / cell_width)) % columns
+    # Column distance the short way around the antimeridian
+    cols = np.minimum(cols, columns - cols)
+    return (np.abs(rows) <= ceil(lat_reach / cell_height)) & (cols <= ceil(lng_reach / cell_width))
+
+def location_cells(location) -> List[str]:
+    '''Cell keys of a location or location request.
+    '''
+    return cover(location.latitude, location.longitude, location.width, location.height)
+
+class GeofenceIndex:
+    '''Point-in-region lookups over a fixed set of locations.
+
+    Candidates are found through the geohash prefixes of the point, then
+    checked with one vectorized containment test.
+    '''
+
+    def __init__(self, locations: List[Location]):
+        self.locations = locations
+        self.latitudes = np.array([location.latitude for location in locations], dtype=np.float64)
+        self.longitudes = np.array([location.longitude for location in locations], dtype=np.float64)
+        self.half_widths = np.array([location.width / 2 for location in locations], dtype=np.float64)
+        self.half_heights = np.array([location.height / 2 for location in locations], dtype=np.float64)
+        self.cells: Dict[str, List[int]] = {}
+        for index, location in enumerate(locations):
+            for cell in location.cells or location_cells(location):
+                self.cells.setdefault(cell, []).append(index)
+
+    def __len__(self) -> int:
+        return len(self.locations)
+
+    def candidates(self, latitude: float, longitude: float) -> np.ndarray:
+        point_hash = encode(latitude, longitude, GEOHASH_PRECISION)
+        indices: List[int] = []
+        for precision in range(1, GEOHASH_PRECISION + 1):
+            indices.extend(self.cells.get(point_hash[:precision], ()))
+        return np.unique(np.array(indices, dtype=np.intp))
+
+    def contains(self, indices: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+        '''Vectorized containment test of points against regions.
+        :param indices: region indices, broadcastable against the points
+        :return: boolean array of the broadcast shape
+        '''
+        # Wrap longitude differences so regions may cross the antimeridian
+        delta_lng = (longitudes - self.longitudes[indices] + 180.0) % 360.0 - 180.0
+        delta_lat = latitudes - self.latitudes[indices]
+        return (np.abs(delta_lng) <= self.half_widths[indices]) & \
+            (np.abs(delta_lat) <= self.half_heights[indices])
+
+    def match(self, latitude: float, longitude: float) -> List[Location]:
+        '''Locations containing a point.
+        '''
+        indices = self.candidates(latitude, longitude)
+        if len(indices) == 0:
+            return []
+        inside = self.contains(indices, latitude, longitude)
+        return [self.locations[index] for index in indices[inside]]
+
+    def match_many(self, latitudes: np.ndarray, longitudes: np.ndarray, chunk_size: int = 1024) -> np.ndarray:
+        '''Most specific location containing each of many points.
+
+        Points are tested against every region at once, in chunks to bound
+        the size of the containment matrix. When regions overlap the one
+        with the smallest area wins.
+        :param latitudes: array of latitudes
+        :param longitudes: array of longitudes
+        :return: array of location indices, -1 where no location matches
+        '''
+        matches = np.full(len(latitudes), -1, dtype=np.intp)
+        if len(self) == 0:
+            return matches
+        areas = self.half_widths * self.half_heights
+        regions = np.arange(len(self))[None, :]
+        for start in range(0, len(latitudes), chunk_size):
+            stop = start + chunk_size
+            inside = self.contains(regions, latitudes[start:stop, None], longitudes[start:stop, None])
+            masked_areas = np.where(inside, areas[None, :], np.inf)
+            best = np.argmin(masked_areas, axis=1)
+            matches[start:stop] = np.where(inside.any(axis=1), best, -1)
+        return matches
@@ -0,0 +1,160 @@
+'''Pub/sub hub pushing feed updates to connected friends over websockets.
+
+Each connected user subscribes to the channel `feed:{userId}` on a broker.
+The in-memory broker only reaches sockets on this worker; a broker backed
+by e.g. Redis pub/sub can implement the same interface for multi-worker
+deployments.
+'''
+import asyncio
+import json
+import logging
+from typing import Callable, Dict, List, Set
+from fastapi import WebSocket, WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT = json.dumps({'type': 'heartbeat'})
+
+class Broker:
+    '''Delivers messages published on a channel to local subscribers.
+    '''
+
+    async def publish(self, channel: str, message: str):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str, callback: Callable[[str], None]):
+        raise NotImplementedError
+
+    async def unsubscribe(self, channel: str, callback: Callable[[str], None]):
+        raise NotImplementedError
+
+class MemoryBroker(Broker):
+    '''Broker for a single worker process.
+    '''
+
+    def __init__(self):
+        self.subscribers: Dict[str, Set[Callable[[str], None]]] = {}
+
+    async def publish(self, channel: str, message: str):
+        for callback in list(self.subscribers.get(channel, ())):
+            callback(message)
+
+    async def subscribe(self, channel: str, callback: Callable[[str], None]):
+        self.subscribers.setdefault(channel, set()).add(callback)
+
+    async def unsubscribe(self, channel: str, callback: Callable[[str], None]):
+        callbacks = self.subscribers.get(channel)
+        if callbacks is None:
+            return
+        callbacks.discard(callback)
+        if len(callbacks) == 0:
+            del self.subscribers[channel]
+
+class Connection:
+    '''One websocket with a bounded send queue.
+
+    A slow client never blocks publishers: when its queue is full the
+    oldest message is dropped to make room for the newest.
+    '''
+
+    def __init__(self, websocket: WebSocket, user_id: str, queue_size: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def push(self, message: str):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def send_forever(self, heartbeat_interval: float):
+        '''Drain the queue into the socket, sending heartbeats when idle.
+
+        Returns once a send fails, after logging why.
+        '''
+        while True:
+            try:
+                message = await asyncio.wait_for(self.queue.get(), heartbeat_interval)
+            except asyncio.TimeoutError:
+                message = HEARTBEAT
+            try:
+                await self.websocket.send_text(message)
+            except Exception:
+                logger.warning("Failed to send to the feed socket of %s", self.user_id, exc_info=True)
+                return
+
+    async def receive_forever(self):
+        '''Read until the client disconnects. Client messages are ignored.
+        '''
+        try:
+            while True:
+                await self.websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+
+    async def serve(self, heartbeat_interval: float):
+        '''Send and receive until the client disconnects or a send fails.
+        '''
+        sender = asyncio.create_task(self.send_forever(heartbeat_interval))
+        receiver = asyncio.create_task(self.receive_forever())
+        try:
+            done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            sender.cancel()
+            receiver.cancel()
+            await asyncio.gather(sender, receiver, return_exceptions=True)
+        for task in done:
+            task.result()
+
+class FeedHub:
+    '''Tracks connections and fans feed items out to them through a broker.
+    '''
+
+    def __init__(self, broker: Broker, queue_size: int = 64, heartbeat_interval: float = 25):
+        self.broker = broker
+        self.queue_size = queue_size
+        self.heartbeat_interval = heartbeat_interval
+        self.connections: Set[Connection] = set()
+        self.published = 0
+        self.dropped = 0
+
+    @staticmethod
+    def channel(user_id: str) -> str:
+        return f"feed:{user_id}"
+
+    def open(self, websocket: WebSocket, user_id: str) -> Connection:
+        return Connection(websocket, user_id, self.queue_size)
+
+    async def connect(self, connection: Connection):
+        self.connections.add(connection)
+        await self.broker.subscribe(self.channel(connection.user_id), connection.push)
+
+    async def serve(self, connection: Connection):
+        '''Register a connection and serve it until it ends, then unregister it.
+        '''
+        await self.connect(connection)
+        try:
+            await connection.serve(self.heartbeat_interval)
+        finally:
+            await self.disconnect(connection)
+
+    async def disconnect(self, connection: Connection):
+        self.connections.discard(connection)
+        self.dropped += connection.dropped
+        await self.broker.unsubscribe(self.channel(connection.user_id), connection.push)
+
+    async def publish(self, user_ids: List[str], message: str):
+        '''Send a message to every connection of the given users.
+        '''
+        for user_id in user_ids:
+            await self.broker.publish(self.channel(user_id), message)
+        self.published += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'connections': len(self.connections),
+            'published': self.published,
+            'dropped': self.dropped + sum(connection.dropped for connection in self.connections),
+        }
@@ -0,0 +1,264 @@
+'''Materialized index of every user's latest event.
+
+`LatestEvents/{userId}` holds the user's most recent event together with a
+snapshot of its location so the feed can be served with a batched get.
+Run `python -m server.utils.latest_events` to backfill from `Events`.
+'''
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from firebase_admin import firestore
+
+from .archive import find_archive, stage_kept, unpack
+from .schemas import (
+    Event,
+    Location,
+    LatestEvent,
+    event_to_pydantic,
+    location_to_pydantic,
+    latest_event_to_pydantic,
+)
+from .stats import Interval, closed_at, closing_interval, event_interval, stage_intervals
+
+LATEST_EVENTS = "LatestEvents"
+
+# Firestore caps a batched write at 500 operations
+BATCH_SIZE = 500
+
+def latest_event_ref(db, user_id: str):
+    return db.collection(LATEST_EVENTS).document(user_id)
+
+def fetch_latest_events(db, user_ids: List[str]) -> Dict[str, LatestEvent]:
+    '''Fetch the latest event of many users in a single batched get.
+    :param db: firestore client
+    :param user_ids: list of user ids
+    :return: map from user id to latest event, users without events are omitted
+    '''
+    if len(user_ids) == 0:
+        return {}
+    refs = [latest_event_ref(db, user_id) for user_id in user_ids]
+    latest_events: Dict[str, LatestEvent] = {}
+    for latest_doc in db.get_all(refs):
+        if latest_doc.exists:
+            latest_events[latest_doc.id] = latest_event_to_pydantic(latest_doc)
+    return latest_events
+
+def fetch_positions(db, user_ids: List[str]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    '''Centers of the latest locations of many users, reading only the coordinates.
+    :param db: firestore client
+    :param user_ids: list of user ids
+    :return: ids of users with a latest event, their latitudes and longitudes
+    '''
+    if len(user_ids) == 0:
+        return [], np.empty(0), np.empty(0)
+    refs = [latest_event_ref(db, user_id) for user_id in user_ids]
+    found: List[str] = []
+    latitudes: List[float] = []
+    longitudes: List[float] = []
+    for latest_doc in db.get_all(refs, field_paths=['location.latitude', 'location.longitude']):
+        if latest_doc.exists:
+            location = latest_doc.to_dict()['location']
+            found.append(latest_doc.id)
+            latitudes.append(location['latitude'])
+            longitudes.append(location['longitude'])
+    return found, np.array(latitudes, dtype=np.float64), np.array(longitudes, dtype=np.float64)
+
+def create_event(db, event: Event) -> List[Event]:
+    '''Write an event, advance the user's latest event and count the visit in one transaction.
+
+    An open previous latest event is closed at the new event's creation,
+    so its dwell runs up to the new event.
+    :param db: firestore client
+    :param event: event to write
+    :return: the closed previous event if any, then the written event;
+        empty if the event's location does not exist
+    '''
+    event_ref = db.collection("Events").document()
+    location_ref = db.collection("Locations").document(event.locationId)
+    latest_ref = latest_event_ref(db, event.userId)
+    event = event.model_copy(update={'eventId': event_ref.id})
+
+    @firestore.transactional
+    def _create(transaction) -> List[Event]:
+        # Both reads go out in one batched get
+        docs = {doc.reference.path: doc for doc in db.get_all([location_ref, latest_ref], transaction=transaction)}
+        location_doc, latest_doc = docs[location_ref.path], docs[latest_ref.path]
+        if not location_doc.exists:
+            return []
+        location = location_to_pydantic(location_doc, location_doc.id)
+        transaction.set(event_ref, event.model_dump())
+        written: List[Event] = []
+        intervals: List[Interval] = [event_interval(event)]
+        if latest_doc.exists:
+            latest = latest_event_to_pydantic(latest_doc)
+            # Only advance the index, an out of order write must not regress it
+            if latest.event.updatedAt > event.updatedAt:
+                stage_intervals(transaction, db, event.userId, intervals)
+                return [event]
+            # The latest event is never archived, so it is still in `Events`
+            end = closed_at(latest.event, event.createdAt)
+            if end is not None:
+                transaction.update(db.collection("Events").document(latest.event.eventId), {'updatedAt': end})
+                intervals.append(closing_interval(latest.event, end))
+                written.append(latest.event.model_copy(update={'updatedAt': end}))
+        stage_intervals(transaction, db, event.userId, intervals)
+        latest = LatestEvent(userId=event.userId, event=event, location=location)
+        transaction.set(latest_ref, latest.model_dump())
+        written.append(event)
+        return written
+
+    return _create(db.transaction())
+
+def delete_event(db, event_id: str) -> bool:
+    '''Delete an event, rewind the user's latest event and uncount the visit in one transaction.
+
+    An event compaction moved out of `Events` is removed from its archive instead.
+    :param db: firestore client
+    :param event_id: id of the event to delete
+    :return: False if the event does not exist
+    '''
+    event_ref = db.collection("Events").document(event_id)
+
+    @firestore.transactional
+    def _delete(transaction) -> bool:
+        event_doc = event_ref.get(transaction=transaction)
+        archived = None
+        if event_doc.exists:
+            event = event_to_pydantic(event_doc, event_doc.id)
+        else:
+            # Compaction may have moved the event into its month's archive
+            archived = find_archive(db, event_id, transaction=transaction)
+            if archived is None:
+                return False
+            archived_events = unpack(archived[1])
+            event = next(archived_event for archived_event in archived_events if archived_event.eventId == event_id)
+        latest_ref = latest_event_ref(db, event.userId)
+        latest_doc = latest_ref.get(transaction=transaction)
+        is_latest = latest_doc.exists and \
+            latest_event_to_pydantic(latest_doc).event.eventId == event_id
+        # All reads have to happen before the first write
+        replacement: Optional[LatestEvent] = None
+        if is_latest:
+            query = db.collection("Events")\
+                .where(filter=firestore.firestore.FieldFilter('userId', '==', event.userId))\
+                .order_by('updatedAt', direction=firestore.Query.DESCENDING)\
+                .limit(2)
+            for candidate_doc in transaction.get(query):
+                if candidate_doc.id == event_id:
+                    continue
+                candidate = event_to_pydantic(candidate_doc, candidate_doc.id)
+                location_ref = db.collection("Locations").document(candidate.locationId)
+                location_doc = location_ref.get(transaction=transaction)
+                if location_doc.exists:
+                    location = location_to_pydantic(location_doc, location_doc.id)
+                    replacement = LatestEvent(userId=event.userId, event=candidate, location=location)
+                break
+        if archived is None:
+            transaction.delete(event_ref)
+        else:
+            stage_kept(transaction, *archived, [kept for kept in archived_events if kept.eventId != event_id])
+        stage_intervals(transaction, db, event.userId, [event_interval(event)], sign=-1)
+        if replacement is not None:
+            transaction.set(latest_ref, replacement.model_dump())
+        elif is_latest:
+            transaction.delete(latest_ref)
+        return True
+
+    return _delete(db.transaction())
+
+def refresh_location(db, location: Location):
+    '''Rewrite the location snapshot of every latest event pointing at it.
+    :param db: firestore client
+    :param location: the edited location
+    '''
+    latest_docs = db.collection(LATEST_EVENTS)\
+        .where(filter=firestore.firestore.FieldFilter('event.locationId', '==', location.locationId))\
+        .stream()
+    batch, size = db.batch(), 0
+    for latest_doc in latest_docs:
+        batch.update(latest_doc.reference, {'location': location.model_dump()})
+        size += 1
+        if size == BATCH_SIZE:
+            batch.commit()
+            batch, size = db.batch(), 0
+    if size > 0:
+        batch.commit()
+
+def drop_location(db, location_id: str):
+    '''Remove every latest event pointing at a deleted location.
+    :param db: firestore client
+    :param location_id: id of the deleted location
+    '''
+    latest_docs = db.collection(LATEST_EVENTS)\
+        .where(filter=firestore.firestore.FieldFilter('event.locationId', '==', location_id))\
+        .stream()
+    batch, size = db.batch(), 0
+    for latest_doc in latest_docs:
+        batch.delete(latest_doc.reference)
+        size += 1
+        if size == BATCH_SIZE:
+            batch.commit()
+            batch, size = db.batch(), 0
+    if size > 0:
+        batch.commit()
+
+def rebuild_user(db, user_id: str):
+    '''Point a user's latest event at their newest event.
+    :param db: firestore client
+    :param user_id: id of the user
+    '''
+    latest_ref = latest_event_ref(db, user_id)
+    event_docs = db.collection("Events")\
+        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
+        .order_by('updatedAt', direction=firestore.Query.DESCENDING)\
+        .limit(1)\
+        .get()
+    for event_doc in event_docs:
+        event = event_to_pydantic(event_doc, event_doc.id)
+        location_doc = db.collection("Locations").document(event.locationId).get()
+        if location_doc.exists:
+            location = location_to_pydantic(location_doc, location_doc.id)
+            latest_ref.set(LatestEvent(userId=user_id, event=event, location=location).model_dump())
+            return
+    latest_ref.delete()
+
+def backfill(db) -> int:
+    '''Rebuild the latest event index from the `Events` collection.
+    :param db: firestore client
+    :return: number of index documents written
+    '''
+    # Keep only the newest event per user while streaming
+    latest: Dict[str, Event] = {}
+    for event_doc in db.collection("Events").stream():
+        event = event_to_pydantic(event_doc, event_doc.id)
+        current = latest.get(event.userId)
+        if current is None or event.updatedAt > current.updatedAt:
+            latest[event.userId] = event
+
+    events = list(latest.values())
+    count = 0
+    for start in range(0, len(events), BATCH_SIZE):
+        chunk = events[start:start + BATCH_SIZE]
+        location_ids = list(dict.fromkeys(event.locationId for event in chunk))
+        refs = [db.collection("Locations").document(location_id) for location_id in location_ids]
+        locations: Dict[str, Location] = {}
+        for location_doc in db.get_all(refs):
+            if location_doc.exists:
+                locations[location_doc.id] = location_to_pydantic(location_doc, location_doc.id)
+        batch = db.batch()
+        for event in chunk:
+            location = locations.get(event.locationId)
+            if location is None:
+                continue
+            latest_event = LatestEvent(userId=event.userId, event=event, location=location)
+            batch.set(latest_event_ref(db, event.userId), latest_event.model_dump())
+            count += 1
+        batch.commit()
+    return count
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from .database import get_client
+
+    load_dotenv()
+    count = backfill(get_client())
+    print(f"Backfilled {count} latest events")
@@ -0,0 +1,309 @@
+'''Request latency histograms and firestore RPC accounting.
+
+`MetricsMiddleware` times every request by route template and collects the
+firestore calls it makes through a client wrapped with `instrument`. Calls
+made on worker threads are attributed to the request when the thread runs
+in a copy of the request's context (`contextvars.copy_context().run`).
+`registry.render` exports everything in the Prometheus text format.
+'''
+import logging
+from bisect import bisect_left
+from contextvars import ContextVar
+from os import environ as env
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Requests slower than this many seconds are logged with their RPC breakdown
+SLOW_REQUEST_SECONDS = float(env.get('SLOW_REQUEST_SECONDS', 1.0))
+
+# rpcs: round trips, reads/writes: billed documents, queries: query round trips
+RPC_FIELDS = ('rpcs', 'reads', 'writes', 'queries')
+
+_request_counts: ContextVar[Optional[Dict[str, int]]] = ContextVar('firestore_rpc_counts', default=None)
+
+RouteKey = Tuple[str, str]
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        '''Bucket bounds with cumulative counts, ending with `+Inf`.
+        '''
+        total, rows = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            rows.append(('+Inf' if bound == float('inf') else repr(bound), total))
+        return rows
+
+class Registry:
+    '''Process-wide request and firestore metrics.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latency: Dict[RouteKey, Histogram] = {}
+        self.responses: Dict[Tuple[str, str, int], int] = {}
+        self.route_rpcs: Dict[RouteKey, Dict[str, int]] = {}
+        self.rpcs: Dict[str, int] = dict.fromkeys(RPC_FIELDS, 0)
+
+    def record_rpc(self, **counts: int):
+        '''Count firestore calls for the current request and the process.
+        '''
+        request_counts = _request_counts.get()
+        with self.lock:
+            for field, count in counts.items():
+                self.rpcs[field] += count
+                if request_counts is not None:
+                    request_counts[field] += count
+
+    def observe(self, method: str, route: str, status: int, elapsed: float, counts: Dict[str, int]):
+        key = (method, route)
+        with self.lock:
+            self.latency.setdefault(key, Histogram()).observe(elapsed)
+            self.responses[(method, route, status)] = self.responses.get((method, route, status), 0) + 1
+            totals = self.route_rpcs.setdefault(key, dict.fromkeys(RPC_FIELDS, 0))
+            for field, count in counts.items():
+                totals[field] += count
+
+    def render(self, gauges: Optional[Dict[str, float]] = None) -> str:
+        '''Metrics in the Prometheus text exposition format.
+        :param gauges: extra gauges to export, keyed by metric name
+        :return: exposition text
+        '''
+        lines: List[str] = []
+        with self.lock:
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            for (method, route), histogram in sorted(self.latency.items()):
+                labels = f'method="{method}",route="{route}"'
+                for bound, count in histogram.cumulative():
+                    lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'http_request_duration_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'http_request_duration_seconds_count{{{labels}}} {histogram.count}')
+            lines.append('# TYPE http_responses_total counter')
+            for (method, route, status), count in sorted(self.responses.items()):
+                lines.append(f'http_responses_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+            for field in RPC_FIELDS:
+                lines.append(f'# TYPE http_request_firestore_{field}_total counter')
+                for (method, route), totals in sorted(self.route_rpcs.items()):
+                    lines.append(f'http_request_firestore_{field}_total{{method="{method}",route="{route}"}} {totals[field]}')
+            for field in RPC_FIELDS:
+                lines.append(f'# TYPE firestore_{field}_total counter')
+                lines.append(f'firestore_{field}_total {self.rpcs[field]}')
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+class MetricsMiddleware:
+    '''ASGI middleware timing requests by route and counting their RPCs.
+
+    Latency stops at the last body chunk, so background tasks run after
+    the response are excluded from it but their RPCs are still counted.
+    '''
+
+    def __init__(self, app, registry: Registry = registry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        counts = dict.fromkeys(RPC_FIELDS, 0)
+        token = _request_counts.set(counts)
+        start = perf_counter()
+        status, elapsed = 500, None
+
+        async def send_timed(message):
+            nonlocal status, elapsed
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body' and not message.get('more_body', False):
+                elapsed = perf_counter() - start
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            _request_counts.reset(token)
+            if elapsed is None:
+                elapsed = perf_counter() - start
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            self.registry.observe(scope['method'], route, status, elapsed, counts)
+            if elapsed >= SLOW_REQUEST_SECONDS:
+                breakdown = ' '.join(f"{field}={count}" for field, count in counts.items())
+                logger.warning(f"Slow request {scope['method']} {route} {status} took {elapsed:.3f}s: {breakdown}")
+
+def _unwrap(value):
+    return value._target if isinstance(value, _Instrumented) else value
+
+class _Instrumented:
+    '''Forwards attribute access to the wrapped firestore object.
+    '''
+    __slots__ = ('_target',)
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name: str):
+        return getattr(self._target, name)
+
+    def __len__(self) -> int:
+        return len(self._target)
+
+class InstrumentedQuery(_Instrumented):
+    __slots__ = ()
+
+    def where(self, *args, **kwargs) -> 'InstrumentedQuery':
+        return InstrumentedQuery(self._target.where(*args, **kwargs))
+
+    def order_by(self, *args, **kwargs) -> 'InstrumentedQuery':
+        return InstrumentedQuery(self._target.order_by(*args, **kwargs))
+
+    def limit(self, count: int) -> 'InstrumentedQuery':
+        return InstrumentedQuery(self._target.limit(count))
+
+    def offset(self, num_to_skip: int) -> 'InstrumentedQuery':
+        return InstrumentedQuery(self._target.offset(num_to_skip))
+
+    def select(self, field_paths) -> 'InstrumentedQuery':
+        return InstrumentedQuery(self._target.select(field_paths))
+
+    def start_after(self, document_fields_or_snapshot) -> 'InstrumentedQuery':
+        return InstrumentedQuery(self._target.start_after(document_fields_or_snapshot))
+
+    def stream(self, transaction=None, **kwargs):
+        registry.record_rpc(rpcs=1, queries=1)
+        count = 0
+        for doc in self._target.stream(transaction=_unwrap(transaction), **kwargs):
+            count += 1
+            yield doc
+        # A query is billed at least one read even when it matches nothing
+        registry.record_rpc(reads=max(count, 1))
+
+    def get(self, transaction=None, **kwargs) -> list:
+        return list(self.stream(transaction=transaction, **kwargs))
+
+class InstrumentedCollection(InstrumentedQuery):
+    __slots__ = ()
+
+    def document(self, document_id: Optional[str] = None) -> 'InstrumentedDocument':
+        return InstrumentedDocument(self._target.document(document_id))
+
+    def add(self, document_data, document_id: Optional[str] = None):
+        registry.record_rpc(rpcs=1, writes=1)
+        update_time, ref = self._target.add(document_data, document_id=document_id)
+        return update_time, InstrumentedDocument(ref)
+
+class InstrumentedDocument(_Instrumented):
+    __slots__ = ()
+
+    def collection(self, name: str) -> InstrumentedCollection:
+        return InstrumentedCollection(self._target.collection(name))
+
+    def get(self, field_paths=None, transaction=None, **kwargs):
+        registry.record_rpc(rpcs=1, reads=1)
+        return self._target.get(field_paths=field_paths, transaction=_unwrap(transaction), **kwargs)
+
+    def create(self, document_data, **kwargs):
+        registry.record_rpc(rpcs=1, writes=1)
+        return self._target.create(document_data, **kwargs)
+
+    def set(self, document_data, merge: bool = False, **kwargs):
+        registry.record_rpc(rpcs=1, writes=1)
+        return self._target.set(document_data, merge=merge, **kwargs)
+
+    def update(self, field_updates, option=None, **kwargs):
+        registry.record_rpc(rpcs=1, writes=1)
+        return self._target.update(field_updates, option=option, **kwargs)
+
+    def delete(self, option=None, **kwargs):
+        registry.record_rpc(rpcs=1, writes=1)
+        return self._target.delete(option=option, **kwargs)
+
+class InstrumentedBatch(_Instrumented):
+    '''Writes are staged locally and counted when committed.
+    '''
+    __slots__ = ()
+
+    def create(self, reference, document_data):
+        return self._target.create(_unwrap(reference), document_data)
+
+    def set(self, reference, document_data, merge: bool = False):
+        return self._target.set(_unwrap(reference), document_data, merge=merge)
+
+    def update(self, reference, field_updates, option=None):
+        return self._target.update(_unwrap(reference), field_updates, option=option)
+
+    def delete(self, reference, option=None):
+        return self._target.delete(_unwrap(reference), option=option)
+
+    def commit(self, **kwargs):
+        registry.record_rpc(rpcs=1, writes=len(self._target))
+        return self._target.commit(**kwargs)
+
+class InstrumentedTransaction(InstrumentedBatch):
+    '''Transaction usable with `firestore.transactional`.
+    '''
+    __slots__ = ()
+
+    def _begin(self, retry_id=None):
+        registry.record_rpc(rpcs=1)
+        return self._target._begin(retry_id=retry_id)
+
+    def _commit(self):
+        registry.record_rpc(rpcs=1, writes=len(self._target))
+        return self._target._commit()
+
+    def get(self, ref_or_query, **kwargs):
+        if isinstance(ref_or_query, InstrumentedQuery):
+            return ref_or_query.stream(transaction=self)
+        registry.record_rpc(rpcs=1, reads=1)
+        return self._target.get(_unwrap(ref_or_query), **kwargs)
+
+    def get_all(self, references, **kwargs):
+        references = [_unwrap(reference) for reference in references]
+        registry.record_rpc(rpcs=1, reads=len(references))
+        return self._target.get_all(references, **kwargs)
+
+class InstrumentedClient(_Instrumented):
+    __slots__ = ()
+
+    def collection(self, collection_path: str) -> InstrumentedCollection:
+        return InstrumentedCollection(self._target.collection(collection_path))
+
+    def document(self, document_path: str) -> InstrumentedDocument:
+        return InstrumentedDocument(self._target.document(document_path))
+
+    def get_all(self, references, field_paths=None, transaction=None, **kwargs):
+        references = [_unwrap(reference) for reference in references]
+        registry.record_rpc(rpcs=1, reads=len(references))
+        return self._target.get_all(references, field_paths=field_paths, transaction=_unwrap(transaction), **kwargs)
+
+    def batch(self) -> InstrumentedBatch:
+        return InstrumentedBatch(self._target.batch())
+
+    def transaction(self, **kwargs) -> InstrumentedTransaction:
+        return InstrumentedTransaction(self._target.transaction(**kwargs))
+
+def instrument(client) -> InstrumentedClient:
+    '''Wrap a firestore client so every call is counted in the registry.
+    :param client: firestore or local storage client
+    :return: client with the same interface
+    '''
+    return InstrumentedClient(client)
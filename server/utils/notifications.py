@@ -0,0 +1,283 @@
+'''Push notifications telling friends a user arrived somewhere.
+
+`create_event` only enqueues the event on the `Notifier`, so request
+latency never includes delivery. Background workers resolve the user's
+friends and their tokens, and send in multicast calls of up to
+`MULTICAST_SIZE` tokens, retrying failed tokens with exponential backoff.
+
+Repeated arrivals of a user at the same location within `DEDUP_SECONDS`
+are sent once, and each recipient gets at most `RECIPIENT_LIMIT`
+notifications per `RECIPIENT_WINDOW` seconds. `FcmSender` delivers through
+Firebase Cloud Messaging; `MemorySender` records messages instead, for
+local backends and load tests.
+'''
+import asyncio
+import logging
+import random
+from os import environ as env
+from time import time
+from typing import Dict, List, Optional, Tuple
+from firebase_admin import exceptions, messaging
+from pydantic import BaseModel
+
+from .cache import LRUCache
+from .database import initialize_firebase, storage_backend
+from .friends import fetch_friend_ids
+from .repository import run
+from .schemas import Event
+
+logger = logging.getLogger(__name__)
+
+# FCM accepts at most 500 tokens per multicast call
+MULTICAST_SIZE = 500
+
+# Events waiting for a worker; more are dropped rather than slowing requests
+QUEUE_SIZE = int(env.get('PUSH_QUEUE_SIZE', 10000))
+# Events fanned out at once
+WORKERS = int(env.get('PUSH_WORKERS', 4))
+# Attempts per multicast call, including the first
+MAX_ATTEMPTS = int(env.get('PUSH_MAX_ATTEMPTS', 4))
+# Delay before the first retry in seconds, doubled on every further one
+BACKOFF_BASE = float(env.get('PUSH_BACKOFF_BASE', 0.5))
+BACKOFF_MAX = float(env.get('PUSH_BACKOFF_MAX', 30))
+# Seconds in which repeated arrivals at the same location are sent once
+DEDUP_SECONDS = float(env.get('PUSH_DEDUP_SECONDS', 900))
+# Notifications a recipient receives per window at most
+RECIPIENT_LIMIT = int(env.get('PUSH_RECIPIENT_LIMIT', 20))
+RECIPIENT_WINDOW = float(env.get('PUSH_RECIPIENT_WINDOW', 3600))
+
+# Senders selectable with WHEREABOUT_PUSH
+SENDERS = ('fcm', 'memory')
+
+# Errors of a single token that another attempt may fix
+RETRYABLE_ERRORS = (
+    exceptions.UnavailableError,
+    exceptions.InternalError,
+    exceptions.DeadlineExceededError,
+    exceptions.UnknownError,
+    messaging.QuotaExceededError,
+)
+
+class Notification(BaseModel):
+    title: str
+    body: str
+    data: Dict[str, str] = {} # delivered to the app alongside the notification
+
+class Sender:
+    '''Delivers one notification to a batch of device tokens.
+    '''
+
+    async def send(self, notification: Notification, tokens: List[str]) -> Tuple[List[str], List[str]]:
+        '''
+        :param notification: the notification
+        :param tokens: at most MULTICAST_SIZE device tokens
+        :return: tokens worth retrying, tokens that are no longer valid
+        '''
+        raise NotImplementedError
+
+class FcmSender(Sender):
+    '''Sender using FCM multicast through the default firebase app.
+    '''
+
+    async def send(self, notification: Notification, tokens: List[str]) -> Tuple[List[str], List[str]]:
+        initialize_firebase()
+        message = messaging.MulticastMessage(
+            tokens=tokens,
+            notification=messaging.Notification(title=notification.title, body=notification.body),
+            data=notification.data,
+        )
+        try:
+            response = await messaging.send_each_for_multicast_async(message)
+        except RETRYABLE_ERRORS:
+            return tokens, []
+        retry: List[str] = []
+        invalid: List[str] = []
+        for token, token_response in zip(tokens, response.responses):
+            if token_response.success:
+                continue
+            if isinstance(token_response.exception, RETRYABLE_ERRORS):
+                retry.append(token)
+            else:
+                invalid.append(token)
+        return retry, invalid
+
+class MemorySender(Sender):
+    '''Sender keeping notifications in memory, with optional latency and failures.
+    '''
+
+    def __init__(self, latency: float = 0, failure_rate: float = 0, seed: Optional[int] = None):
+        '''
+        :param latency: seconds every call takes
+        :param failure_rate: probability that a token fails with a retryable error
+        :param seed: seed of the failure draws
+        '''
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.sent: List[Tuple[str, Notification]] = []
+
+    async def send(self, notification: Notification, tokens: List[str]) -> Tuple[List[str], List[str]]:
+        self.calls += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        retry = [token for token in tokens if self.random.random() < self.failure_rate]
+        failed = set(retry)
+        self.sent.extend((token, notification) for token in tokens if token not in failed)
+        return retry, []
+
+def create_sender() -> Sender:
+    '''Sender named by WHEREABOUT_PUSH, FCM with firestore storage and memory otherwise.
+    '''
+    default = 'fcm' if storage_backend() == 'firestore' else 'memory'
+    name = env.get('WHEREABOUT_PUSH', default)
+    if name not in SENDERS:
+        raise ValueError(f"Unknown push sender: {name}")
+    return FcmSender() if name == 'fcm' else MemorySender()
+
+def arrival_notification(event: Event, name: Optional[str], tag: str) -> Notification:
+    return Notification(
+        title=f"{name or 'A friend'} arrived",
+        body=f"At {tag}",
+        data={'type': 'arrival', 'eventId': event.eventId, 'userId': event.userId, 'locationId': event.locationId},
+    )
+
+class Notifier:
+    '''Queue of arrival events and the workers fanning them out.
+    '''
+
+    def __init__(self, db, users, locations, sender: Sender, queue_size: int = QUEUE_SIZE, workers: int = WORKERS):
+        '''
+        :param db: firestore client
+        :param users: users repository
+        :param locations: locations repository
+        :param sender: delivers the notifications
+        '''
+        self.db = db
+        self.users = users
+        self.locations = locations
+        self.sender = sender
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.num_workers = workers
+        self.workers: List[asyncio.Task] = []
+        # (userId, locationId) of recent arrivals
+        self.recent = LRUCache(max_size=100000, ttl=DEDUP_SECONDS)
+        # Notifications sent to a recipient in its current window
+        self.received = LRUCache(max_size=100000)
+        self.counts = {
+            'enqueued': 0,
+            'dropped': 0,
+            'deduplicated': 0,
+            'rate_limited': 0,
+            'calls': 0,
+            'retries': 0,
+            'sent': 0,
+            'failed': 0,
+            'invalid': 0,
+        }
+
+    def start(self):
+        for _ in range(self.num_workers):
+            self.workers.append(asyncio.create_task(self._work()))
+
+    async def stop(self, timeout: float = 5):
+        '''Give queued events a moment to go out, then stop the workers.
+        '''
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def enqueue(self, event: Event) -> bool:
+        '''Queue an event for notification without waiting.
+        :return: False if the event was dropped
+        '''
+        key = (event.userId, event.locationId)
+        if self.recent.get(key) is not None:
+            self.counts['deduplicated'] += 1
+            return False
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.counts['dropped'] += 1
+            return False
+        self.recent.put(key, event.eventId)
+        self.counts['enqueued'] += 1
+        return True
+
+    async def _work(self):
+        while True:
+            event = await self.queue.get()
+            try:
+                await self.notify(event)
+            except Exception:
+                logger.exception("Failed to notify friends of event %s", event.eventId)
+            finally:
+                self.queue.task_done()
+
+    def allow(self, recipient_id: str, now: float) -> bool:
+        '''Count a notification against a recipient's limit.
+        '''
+        window = self.received.get(recipient_id)
+        if window is None:
+            self.received.put(recipient_id, [1], expires_at=now + RECIPIENT_WINDOW)
+            return True
+        if window[0] >= RECIPIENT_LIMIT:
+            return False
+        window[0] += 1
+        return True
+
+    async def notify(self, event: Event):
+        '''Send an arrival to every friend of the event's user with a token.
+        '''
+        friend_ids = await run(fetch_friend_ids, self.db, event.userId)
+        if len(friend_ids) == 0:
+            return
+        user, location = await asyncio.gather(self.users.get(event.userId), self.locations.get(event.locationId))
+        if user is None or location is None:
+            return
+        recipients = await self.users.get_many(friend_ids)
+        now = time()
+        tokens: List[str] = []
+        for friend_id in friend_ids:
+            recipient = recipients.get(friend_id)
+            if recipient is None or not recipient.token:
+                continue
+            if not self.allow(friend_id, now):
+                self.counts['rate_limited'] += 1
+                continue
+            tokens.append(recipient.token)
+        notification = arrival_notification(event, user.firstName, location.tag)
+        await asyncio.gather(*(
+            self.deliver(notification, tokens[start:start + MULTICAST_SIZE])
+            for start in range(0, len(tokens), MULTICAST_SIZE)
+        ))
+
+    async def deliver(self, notification: Notification, tokens: List[str]):
+        '''Send to one batch of tokens, retrying the ones that failed.
+        '''
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt > 0:
+                self.counts['retries'] += 1
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+                # Jitter keeps retries of many batches from arriving together
+                await asyncio.sleep(delay * random.uniform(0.5, 1))
+            self.counts['calls'] += 1
+            try:
+                retry, invalid = await self.sender.send(notification, tokens)
+            except Exception:
+                logger.exception("Push call failed")
+                retry, invalid = tokens, []
+            self.counts['sent'] += len(tokens) - len(retry) - len(invalid)
+            self.counts['invalid'] += len(invalid)
+            tokens = retry
+            if len(tokens) == 0:
+                return
+        self.counts['failed'] += len(tokens)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.counts, 'queued': self.queue.qsize()}
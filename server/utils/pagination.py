@@ -0,0 +1,50 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import Any, List, Optional, Tuple
+from fastapi import HTTPException
+
+# Largest page any list endpoint will return
+MAX_PAGE_SIZE = 100
+
+def encode_cursor(values: List[Any]) -> str:
+    '''Opaque cursor holding the order-by values of the last document.
+    '''
+    return urlsafe_b64encode(json.dumps(values).encode('utf8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def paginate(query, order_fields: List[str], limit: int, cursor: Optional[str] = None) -> Tuple[List[Any], Optional[str]]:
+    '''Fetch one page of an ordered query with `start_after`.
+
+    Unlike an offset, skipped documents are never read, so every page
+    costs the same regardless of its depth.
+    :param query: firestore query already ordered by order_fields
+    :param order_fields: fields the query is ordered by, ending with `__name__`
+    :param limit: page size
+    :param cursor: cursor returned with the previous page
+    :return: document snapshots, cursor of the next page or None on the last page
+    '''
+    if cursor is not None:
+        values = decode_cursor(cursor)
+        if len(values) != len(order_fields):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.start_after(dict(zip(order_fields, values)))
+    # Read one extra document to learn whether another page exists
+    docs = list(query.limit(limit + 1).get())
+    if len(docs) <= limit:
+        return docs, None
+    docs = docs[:limit]
+    last = docs[-1]
+    next_cursor = encode_cursor([
+        last.id if field == '__name__' else last.get(field)
+        for field in order_fields
+    ])
+    return docs, next_cursor
@@ -0,0 +1,156 @@
+from hashlib import sha256
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from firebase_admin import firestore
+
+from .geo import GeofenceIndex
+from .latest_events import BATCH_SIZE, latest_event_ref
+from .requests import Ping
+from .schemas import Event, LatestEvent, event_to_pydantic, latest_event_to_pydantic
+from .stats import Interval, closed_at, closing_interval, stage_intervals
+
+# Seconds without a ping after which returning to a location is a new visit
+VISIT_GAP = 30 * 60
+
+# Visits per transaction: each writes its event and at most one stats
+# document, next to the latest event index and an extended or closed event
+CHUNK_SIZE = (BATCH_SIZE - 2) // 2
+
+# (location index, entered at, last seen at)
+Visit = Tuple[int, int, int]
+
+def find_visits(index: GeofenceIndex, pings: List[Ping]) -> List[Visit]:
+    '''Collapse a batch of GPS fixes into visits.
+
+    Every fix is matched against the user's locations in one vectorized
+    pass; a visit is a run of consecutive fixes matching the same location
+    and fixes outside every location end the current visit.
+    :param index: geofence index over the user's locations
+    :param pings: GPS fixes, in any order
+    :return: list of visits in time order
+    '''
+    if len(pings) == 0:
+        return []
+    timestamps = np.array([ping.timestamp for ping in pings], dtype=np.int64)
+    order = np.argsort(timestamps, kind='stable')
+    timestamps = timestamps[order]
+    latitudes = np.array([ping.latitude for ping in pings], dtype=np.float64)[order]
+    longitudes = np.array([ping.longitude for ping in pings], dtype=np.float64)[order]
+    matches = index.match_many(latitudes, longitudes)
+    # Each run of identical matches starts where the match changes
+    starts = np.flatnonzero(np.r_[True, matches[1:] != matches[:-1]])
+    stops = np.r_[starts[1:], len(matches)] - 1
+    return [
+        (int(matches[start]), int(timestamps[start]), int(timestamps[stop]))
+        for start, stop in zip(starts, stops)
+        if matches[start] >= 0
+    ]
+
+def visit_event_id(user_id: str, location_id: str, entered_at: int) -> str:
+    '''Id of the event a visit creates, the same on every upload of the visit.
+    '''
+    return sha256(f"{user_id}/{location_id}/{entered_at}".encode('utf8')).hexdigest()[:20]
+
+def continues(event: Event, location_id: str, entered_at: int) -> bool:
+    '''Whether a visit entering a location at a time belongs to an existing event.
+    '''
+    return event.locationId == location_id and event.createdAt <= entered_at <= event.updatedAt + VISIT_GAP
+
+def write_visits(db, user_id: str, index: GeofenceIndex, visits: List[Visit]) -> List[Event]:
+    '''Write visits as events, one transaction per chunk of visits.
+
+    A visit creates the event `visit_event_id` names, and the first visit
+    of an upload continuing an existing event extends it instead. A new
+    event closes the open event before it, see `stats.closed_at`. Each
+    transaction reads the latest event and the chunk's events in one
+    batched get and skips visits already written, so uploading the same
+    pings again changes nothing. It writes the events, their location
+    stats increments and the advanced latest event index together.
+    :param db: firestore client
+    :param user_id: id of the user
+    :param index: geofence index the visits were matched against
+    :param visits: visits in time order
+    :return: events created, extended or closed, empty when the upload was already written
+    '''
+    written: List[Event] = []
+    for start in range(0, len(visits), CHUNK_SIZE):
+        written.extend(_write_chunk(db, user_id, index, visits[start:start + CHUNK_SIZE], start == 0))
+    return written
+
+def _write_chunk(db, user_id: str, index: GeofenceIndex, visits: List[Visit], is_first: bool) -> List[Event]:
+    latest_ref = latest_event_ref(db, user_id)
+    locations = {location.locationId: location for location in index.locations}
+    event_refs = [
+        db.collection("Events").document(visit_event_id(user_id, index.locations[location_index].locationId, entered_at))
+        for location_index, entered_at, _ in visits
+    ]
+
+    @firestore.transactional
+    def _write(transaction) -> List[Event]:
+        docs = {doc.reference.path: doc for doc in db.get_all([latest_ref] + event_refs, transaction=transaction)}
+        latest_doc = docs[latest_ref.path]
+        latest: Optional[LatestEvent] = latest_event_to_pydantic(latest_doc) if latest_doc.exists else None
+        newest: Optional[Event] = latest.event if latest is not None else None
+        # Staged until the end, so an event created here can still be closed: id -> (event, is new)
+        changed: Dict[str, Tuple[Event, bool]] = {}
+        intervals: List[Interval] = []
+        for position, ((location_index, entered_at, seen_at), event_ref) in enumerate(zip(visits, event_refs)):
+            location_id = index.locations[location_index].locationId
+            event_doc = docs[event_ref.path]
+            if event_doc.exists:
+                # Written by an earlier upload of the same pings
+                event = event_to_pydantic(event_doc, event_doc.id)
+            else:
+                event = None
+                if is_first and position == 0 and newest is not None:
+                    continued = newest if continues(newest, location_id, entered_at) else None
+                    if continued is None and entered_at < newest.createdAt:
+                        # A retry after this visit extended an older event, or a late upload
+                        continued = _find_continued(db, transaction, user_id, location_id, entered_at)
+                    if continued is not None:
+                        event = continued
+                        if seen_at > continued.updatedAt:
+                            event = continued.model_copy(update={'updatedAt': seen_at})
+                            changed[event.eventId] = (event, False)
+                            intervals.append((location_id, continued.updatedAt, seen_at, 0))
+                if event is None:
+                    if newest is not None:
+                        # The visit ends an open previous event
+                        end = closed_at(newest, entered_at)
+                        if end is not None:
+                            intervals.append(closing_interval(newest, end))
+                            newest = newest.model_copy(update={'updatedAt': end})
+                            changed[newest.eventId] = (newest, changed.get(newest.eventId, (newest, False))[1])
+                    event = Event(eventId=event_ref.id, userId=user_id, locationId=location_id, createdAt=entered_at, updatedAt=seen_at)
+                    changed[event.eventId] = (event, True)
+                    intervals.append((location_id, entered_at, seen_at, 1))
+            # Only advance the index, a late upload must not regress it
+            if newest is None or newest.updatedAt <= event.updatedAt:
+                newest = event
+        for event, is_new in changed.values():
+            if is_new:
+                transaction.set(db.collection("Events").document(event.eventId), event.model_dump())
+            else:
+                transaction.update(db.collection("Events").document(event.eventId), {'updatedAt': event.updatedAt})
+        stage_intervals(transaction, db, user_id, intervals)
+        is_current = latest is not None and latest.event == newest
+        if newest is not None and not is_current and newest.locationId in locations:
+            transaction.set(latest_ref, LatestEvent(userId=user_id, event=newest, location=locations[newest.locationId]).model_dump())
+        return [event for event, _ in changed.values()]
+
+    return _write(db.transaction())
+
+def _find_continued(db, transaction, user_id: str, location_id: str, entered_at: int) -> Optional[Event]:
+    '''The user's event at a location that a visit entering at a time continues, if any.
+    '''
+    query = db.collection("Events")\
+        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
+        .where(filter=firestore.firestore.FieldFilter('locationId', '==', location_id))\
+        .where(filter=firestore.firestore.FieldFilter('createdAt', '<=', entered_at))\
+        .order_by('createdAt', direction=firestore.Query.DESCENDING)\
+        .limit(1)
+    for event_doc in transaction.get(query):
+        event = event_to_pydantic(event_doc, event_doc.id)
+        if continues(event, location_id, entered_at):
+            return event
+    return None
@@ -0,0 +1,267 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os import environ as env
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from google.api_core.exceptions import Conflict, NotFound
+from firebase_admin import firestore
+from pydantic import BaseModel
+
+from .cache import model_cache
+from .pagination import paginate
+from .schemas import (
+    User,
+    Location,
+    Event,
+    user_to_pydantic,
+    location_to_pydantic,
+    event_to_pydantic,
+)
+
+# Number of threads making blocking firestore calls
+FIRESTORE_MAX_WORKERS = int(env.get('FIRESTORE_MAX_WORKERS', 32))
+# Number of calls allowed to wait for a thread before callers are queued on the loop
+FIRESTORE_MAX_PENDING = int(env.get('FIRESTORE_MAX_PENDING', 256))
+# Seconds before a single call is abandoned
+FIRESTORE_TIMEOUT = float(env.get('FIRESTORE_TIMEOUT', 10))
+
+_executor = ThreadPoolExecutor(max_workers=FIRESTORE_MAX_WORKERS, thread_name_prefix='firestore')
+_pending = asyncio.Semaphore(FIRESTORE_MAX_PENDING)
+
+Filter = Tuple[str, str, Any]
+
+class FirestoreTimeout(Exception):
+    '''A firestore call did not finish within its timeout.
+
+    The call keeps running on its thread, so a write may still be applied
+    after this is raised. The app answers it with a 504.
+    '''
+
+def _release(future: asyncio.Future):
+    _pending.release()
+    # Nobody awaits a call that timed out, so its error is retrieved here
+    if not future.cancelled():
+        future.exception()
+
+async def run(fn: Callable, *args, timeout: float = FIRESTORE_TIMEOUT, **kwargs) -> Any:
+    '''Run a blocking firestore call on the dedicated executor.
+
+    A call holds its slot of FIRESTORE_MAX_PENDING until its thread is
+    done, even after it timed out, so stalled calls still count toward
+    the cap.
+    :param fn: blocking callable
+    :param timeout: seconds to wait for the result
+    :return: the result of fn
+    :raises FirestoreTimeout: if the call takes longer than timeout
+    '''
+    loop = asyncio.get_running_loop()
+    await _pending.acquire()
+    try:
+        # Run in a copy of the caller's context so RPCs count toward its request
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(_executor, partial(context.run, fn, *args, **kwargs))
+    except BaseException:
+        _pending.release()
+        raise
+    future.add_done_callback(_release)
+    try:
+        # Shielded, so that a timeout or a cancelled caller leaves the slot to the thread
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        raise FirestoreTimeout(f"Firestore call timed out after {timeout} seconds")
+
+class Repository:
+    '''Non-blocking access to one firestore collection.
+
+    Repositories with `cached` set read through the shared model cache and
+    invalidate it around every write they perform, so a read racing the
+    write cannot re-cache the old document.
+    '''
+    collection_name: str
+    id_field: str
+    cached: bool = False
+
+    def __init__(self, db):
+        self.db = db
+
+    def to_pydantic(self, doc) -> BaseModel:
+        raise NotImplementedError
+
+    def collection(self):
+        return self.db.collection(self.collection_name)
+
+    def ref(self, doc_id: Optional[str] = None):
+        return self.collection().document(doc_id)
+
+    def cache_key(self, doc_id: str) -> Tuple[str, str]:
+        return (self.collection_name, doc_id)
+
+    def remember(self, doc_id: str, model: BaseModel):
+        if self.cached:
+            model_cache.put(self.cache_key(doc_id), model)
+
+    def invalidate(self, doc_id: str):
+        '''Drop a cached document, for writes made outside the repository.
+        '''
+        if self.cached:
+            model_cache.invalidate(self.cache_key(doc_id))
+
+    async def get(self, doc_id: str) -> Optional[BaseModel]:
+        if self.cached:
+            model = model_cache.get(self.cache_key(doc_id))
+            if model is not None:
+                return model
+        doc = await run(self.ref(doc_id).get)
+        if not doc.exists:
+            return None
+        model = self.to_pydantic(doc)
+        self.remember(doc_id, model)
+        return model
+
+    async def get_many(self, doc_ids: List[str], field_paths: Optional[List[str]] = None) -> Dict[str, BaseModel]:
+        '''Fetch many documents with a single batched get.
+        :param doc_ids: list of document ids
+        :param field_paths: only read these fields of uncached documents, which are then not cached
+        :return: map from document id to model, missing documents are omitted
+        '''
+        doc_ids = list(dict.fromkeys(doc_ids))
+        models: Dict[str, BaseModel] = {}
+        if self.cached:
+            models, doc_ids = model_cache.get_many(self.collection_name, doc_ids)
+        if len(doc_ids) == 0:
+            return models
+        refs = [self.ref(doc_id) for doc_id in doc_ids]
+        docs = await run(lambda: list(self.db.get_all(refs, field_paths=field_paths)))
+        for doc in docs:
+            if doc.exists:
+                models[doc.id] = self.to_pydantic(doc)
+                if field_paths is None:
+                    self.remember(doc.id, models[doc.id])
+        return models
+
+    async def query(
+        self,
+        filters: List[Filter],
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        limit: Optional[int] = None,
+    ) -> List[BaseModel]:
+        '''Run a query over the collection.
+        :param filters: list of (field, op, value) filters
+        :param order_by: field to order by
+        :param descending: order direction
+        :param limit: maximum number of documents
+        :return: list of models
+        '''
+        query = self.collection()
+        for field, op, value in filters:
+            query = query.where(filter=firestore.firestore.FieldFilter(field, op, value))
+        if order_by is not None:
+            direction = firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING
+            query = query.order_by(order_by, direction=direction)
+        if limit is not None:
+            query = query.limit(limit)
+        docs = await run(query.get)
+        models = [self.to_pydantic(doc) for doc in docs]
+        for doc, model in zip(docs, models):
+            self.remember(doc.id, model)
+        return models
+
+    async def page(
+        self,
+        filters: List[Filter],
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        limit: int = 10,
+        cursor: Optional[str] = None,
+    ) -> Tuple[List[BaseModel], Optional[str]]:
+        '''Fetch one page of a query, ordered with the document id as tie-breaker.
+        :param filters: list of (field, op, value) filters
+        :param order_by: field to order by, None to order by document id only
+        :param descending: order direction
+        :param limit: page size
+        :param cursor: cursor returned with the previous page
+        :return: list of models, cursor of the next page
+        '''
+        query = self.collection()
+        for field, op, value in filters:
+            query = query.where(filter=firestore.firestore.FieldFilter(field, op, value))
+        direction = firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING
+        order_fields = ['__name__'] if order_by is None else [order_by, '__name__']
+        for field in order_fields:
+            query = query.order_by(field, direction=direction)
+        docs, next_cursor = await run(paginate, query, order_fields, limit, cursor)
+        models = [self.to_pydantic(doc) for doc in docs]
+        for doc, model in zip(docs, models):
+            self.remember(doc.id, model)
+        return models, next_cursor
+
+    async def create(self, model: BaseModel, doc_id: Optional[str] = None) -> Optional[BaseModel]:
+        '''Write a new document without reading it before or after.
+
+        The write carries an exists=False precondition, so it fails instead
+        of overwriting and the response is built from the data written.
+        :param model: model to write
+        :param doc_id: document id, None for an auto-generated id
+        :return: the written model with its id, None if the document already exists
+        '''
+        ref = self.ref(doc_id)
+        model = model.model_copy(update={self.id_field: ref.id})
+        try:
+            await run(ref.create, model.model_dump())
+        except Conflict:
+            return None
+        self.remember(ref.id, model)
+        return model
+
+    async def patch(self, doc_id: str, fields: Dict[str, Any]) -> Optional[BaseModel]:
+        '''Update fields of an existing document without reading it first.
+
+        Updates carry an exists=True precondition, so a missing document
+        fails the write itself. The response merges the written fields into
+        the cached model and only reads the document on a cache miss.
+        :param doc_id: document id
+        :param fields: fields to set
+        :return: the updated model, None if the document does not exist
+        '''
+        current = model_cache.get(self.cache_key(doc_id)) if self.cached else None
+        self.invalidate(doc_id)
+        try:
+            await run(self.ref(doc_id).update, fields)
+        except NotFound:
+            return None
+        if current is None:
+            return await self.get(doc_id)
+        model = current.model_copy(update=fields)
+        self.remember(doc_id, model)
+        return model
+
+    async def delete(self, doc_id: str):
+        self.invalidate(doc_id)
+        await run(self.ref(doc_id).delete)
+        self.invalidate(doc_id)
+
+class UsersRepository(Repository):
+    collection_name = "Users"
+    id_field = "userId"
+    cached = True
+
+    def to_pydantic(self, doc) -> User:
+        return user_to_pydantic(doc)
+
+class LocationsRepository(Repository):
+    collection_name = "Locations"
+    id_field = "locationId"
+    cached = True
+
+    def to_pydantic(self, doc) -> Location:
+        return location_to_pydantic(doc, doc.id)
+
+class EventsRepository(Repository):
+    collection_name = "Events"
+    id_field = "eventId"
+    cached = True
+
+    def to_pydantic(self, doc) -> Event:
+        return event_to_pydantic(doc, doc.id)
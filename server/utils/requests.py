@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel
 
 # --- user requests ---
@@ -18,6 +18,11 @@ class UpdateUserTokenRequest(BaseModel):
 class CreateRelationRequest(BaseModel):
     recipientId: str
 
+# --- batch requests ---
+
+class BatchGetRequest(BaseModel):
+    ids: List[str] # document ids, duplicates are read once
+
 # --- location requests ---
 
 class CreateLocationRequest(BaseModel):
@@ -37,8 +42,22 @@ class EditLocationRequest(BaseModel):
     tag: str
     category: Optional[str] = None
 
+class MatchLocationRequest(BaseModel):
+    latitude: float
+    longitude: float
+
 # --- event requests ---
 
 class CreateEventRequest(BaseModel):
     userId: str
     locationId: str
+
+# --- ping requests ---
+
+class Ping(BaseModel):
+    latitude: float
+    longitude: float
+    timestamp: int
+
+class PingBatchRequest(BaseModel):
+    pings: List[Ping]
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Any, Dict, Generic, List, Optional, TypeVar
 from pydantic import BaseModel
 
 class FBUser(BaseModel):
@@ -32,6 +32,11 @@ class Relation(BaseModel):
     createdAt: int
     updatedAt: int
 
+class FriendList(BaseModel):
+    userId: str
+    friendIds: List[str] # user ids of all friends
+    updatedAt: int
+
 class Location(BaseModel):
     locationId: Optional[str] = None
     userId: str
@@ -41,6 +46,7 @@ class Location(BaseModel):
     height: float
     tag: str
     category: Optional[str] = None
+    cells: Optional[List[str]] = None # geohash cells covering the region
     createdAt: int
     updatedAt: int
 
@@ -51,16 +57,93 @@ class Event(BaseModel):
     createdAt: int
     updatedAt: int
 
+class EventArchive(BaseModel):
+    userId: str
+    month: str # UTC month of the archived events, YYYY-MM
+    count: int
+    eventIds: List[str]
+    locationIds: List[str] # distinct locations, referenced by index
+    createdAt: bytes # little-endian int64 per event, ascending
+    durations: bytes # little-endian int32 seconds from createdAt to updatedAt per event
+    locations: bytes # little-endian int32 index into locationIds per event
+    updatedAt: int
+
+class LatestEvent(BaseModel):
+    userId: str
+    event: Event
+    location: Location # snapshot of the location at write time
+
+class DayStats(BaseModel):
+    visits: int = 0
+    dwellSeconds: int = 0
+
+class LocationStats(BaseModel):
+    locationId: str
+    userId: str
+    visits: int = 0
+    dwellSeconds: int = 0
+    firstVisitAt: Optional[int] = None
+    lastVisitAt: Optional[int] = None
+    days: Dict[str, DayStats] = {} # keyed by UTC date, YYYY-MM-DD
+
+class CascadeJob(BaseModel):
+    jobId: Optional[str] = None
+    kind: str # location or user
+    targetId: str # id of the deleted location or user
+    userId: str # owner of the deleted data
+    status: str = 'pending' # pending, running, done or failed
+    step: int = 0 # index of the step in progress
+    cursor: Optional[str] = None # position within the step's query
+    deleted: int = 0 # documents deleted so far
+    attempts: int = 0 # failed runs so far
+    leaseUntil: int = 0 # epoch seconds before which no other worker may claim the job
+    error: Optional[str] = None
+    createdAt: int
+    updatedAt: int
+
 class FeedItem(BaseModel):
     user: User
     event: Event
     location: Location
 
+class NearbyFriend(BaseModel):
+    user: User
+    event: Event
+    location: Location
+    distance: float # meters from the requested point to the location's center
+
+class FeedMessage(BaseModel):
+    type: str = 'feed'
+    item: FeedItem
+
+class ExportRecord(BaseModel):
+    collection: str # Locations, Events or Relations
+    data: Dict[str, Any] # the document, including its id field
+
+T = TypeVar('T')
+
+class Page(BaseModel, Generic[T]):
+    items: List[T]
+    nextCursor: Optional[str] = None # pass back as `cursor` for the next page
+
 # --- pydantic utilities ---
 
 def user_to_pydantic(user) -> User:
     return User.model_validate(user.to_dict())
 
+def public_user(user: User) -> User:
+    '''Copy of a user without the push token, for anyone but the user.
+    '''
+    return user.model_copy(update={'token': None})
+
+# Location fields kept for the server's own lookups, never returned by the API
+LOCATION_INTERNAL_FIELDS = frozenset({'cells'})
+
+def public_location(location: Location) -> Location:
+    '''Copy of a location without its internal fields, for every response.
+    '''
+    return location.model_copy(update=dict.fromkeys(LOCATION_INTERNAL_FIELDS))
+
 def relation_to_pydantic(relation, relation_id: str) -> Relation:
     relation_dict = relation.to_dict()
     relation_dict['relationId'] = relation_id
@@ -75,3 +158,17 @@ def event_to_pydantic(event, event_id: str) -> Event:
     event_dict = event.to_dict()
     event_dict['eventId'] = event_id
     return Event.model_validate(event_dict)
+
+def latest_event_to_pydantic(latest_event) -> LatestEvent:
+    return LatestEvent.model_validate(latest_event.to_dict())
+
+def event_archive_to_pydantic(event_archive) -> EventArchive:
+    return EventArchive.model_validate(event_archive.to_dict())
+
+def location_stats_to_pydantic(location_stats) -> LocationStats:
+    return LocationStats.model_validate(location_stats.to_dict())
+
+def cascade_job_to_pydantic(cascade_job) -> CascadeJob:
+    cascade_job_dict = cascade_job.to_dict()
+    cascade_job_dict['jobId'] = cascade_job.id
+    return CascadeJob.model_validate(cascade_job_dict)
@@ -0,0 +1,305 @@
+'''Visit and dwell time rollups per location.
+
+`LocationStats/{locationId}` holds a location's total visits and dwell
+seconds plus the same totals per UTC day. Every event is one visit lasting
+from `createdAt` to `updatedAt`; dwell time crossing midnight is split
+between the days and the visit is counted on the day it started.
+
+An event with no observed departure (`updatedAt == createdAt`, as created
+by the API or by a single ping) is open: it lasts until the user's next
+event, at most `MAX_DWELL`. The write that creates the next event closes
+it by moving its `updatedAt` and counting the extra dwell, and a rebuild
+closes events that are still open the same way.
+
+Rollups are updated with increments in the same commit as the events they
+count, so reading them is a single document get. Run
+`python -m server.utils.stats [userId]` to rebuild them from `Events` and
+the event archives.
+'''
+from datetime import datetime, timezone
+from os import environ as env
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from firebase_admin import firestore
+
+from .archive import stream_archived
+from .schemas import DayStats, Event, Location, LocationStats, event_to_pydantic, location_stats_to_pydantic
+
+LOCATION_STATS = "LocationStats"
+
+DAY = 24 * 60 * 60
+
+# Firestore caps a batched write at 500 operations
+BATCH_SIZE = 500
+
+# Events read into memory at a time while rebuilding
+REBUILD_CHUNK_SIZE = 10000
+
+# An open event lasts until the user's next event, at most this many seconds
+MAX_DWELL = int(env.get('STATS_MAX_DWELL_SECONDS', 12 * 60 * 60))
+
+# (location id, start, end, visits), visits is 0 for a visit being extended
+Interval = Tuple[str, int, int, int]
+
+def location_stats_ref(db, location_id: str):
+    return db.collection(LOCATION_STATS).document(location_id)
+
+def day_key(day: int) -> str:
+    '''UTC date of a day number counted from the epoch.
+    '''
+    return str(np.datetime64(day, 'D'))
+
+def split_days(starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''Split intervals at UTC midnights.
+    :param starts: interval starts in epoch seconds
+    :param ends: interval ends in epoch seconds, not before the starts
+    :return: interval index, day number and dwell seconds of every piece,
+        and whether the piece is the first of its interval
+    '''
+    first_days = starts // DAY
+    spans = ends // DAY - first_days + 1
+    rows = np.repeat(np.arange(len(starts)), spans)
+    # Offset of each piece within its interval: 0, 1, ... spans - 1
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(spans) - spans, spans)
+    days = first_days[rows] + offsets
+    piece_starts = np.maximum(starts[rows], days * DAY)
+    piece_ends = np.minimum(ends[rows], (days + 1) * DAY)
+    return rows, days, piece_ends - piece_starts, offsets == 0
+
+def rollup(intervals: Sequence[Interval]) -> Dict[str, Dict[str, Any]]:
+    '''Total visits and dwell time per location and day, as plain dicts.
+
+    The interval math runs in a few NumPy passes and no model is built, so
+    this is what the write paths use; `aggregate` validates the same totals.
+    :param intervals: (location id, start, end, visits) tuples
+    :return: `LocationStats` fields keyed by location id, without `userId`
+    '''
+    if len(intervals) == 0:
+        return {}
+    location_ids, starts, ends, visits = zip(*intervals)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.maximum(np.asarray(ends, dtype=np.int64), starts)
+    visits = np.asarray(visits, dtype=np.int64)
+    positions: Dict[str, int] = {}
+    locations = np.array([positions.setdefault(location_id, len(positions)) for location_id in location_ids], dtype=np.int64)
+    names = list(positions)
+
+    rows, days, dwell, is_first = split_days(starts, ends)
+    piece_visits = np.where(is_first, visits[rows], 0)
+    # Sum pieces sharing a (location, day) key, packed into one integer
+    first_day = days.min()
+    num_days = days.max() - first_day + 1
+    keys, groups = np.unique(locations[rows] * num_days + (days - first_day), return_inverse=True)
+    day_visits = np.bincount(groups, weights=piece_visits, minlength=len(keys)).astype(np.int64)
+    day_dwell = np.bincount(groups, weights=dwell, minlength=len(keys)).astype(np.int64)
+    day_keys = np.datetime_as_string((keys % num_days + first_day).astype('datetime64[D]'))
+
+    location_visits = np.bincount(locations, weights=visits, minlength=len(names)).astype(np.int64)
+    location_dwell = np.bincount(locations, weights=ends - starts, minlength=len(names)).astype(np.int64)
+    last_visits = np.full(len(names), np.iinfo(np.int64).min)
+    np.maximum.at(last_visits, locations, ends)
+    # Extensions of an earlier visit do not move the first visit
+    no_visit = np.iinfo(np.int64).max
+    first_visits = np.full(len(names), no_visit)
+    np.minimum.at(first_visits, locations, np.where(visits > 0, starts, no_visit))
+
+    days_by_location: List[Dict[str, Dict[str, int]]] = [{} for _ in names]
+    for position, day, count, seconds in zip((keys // num_days).tolist(), day_keys.tolist(), day_visits.tolist(), day_dwell.tolist()):
+        days_by_location[position][day] = {'visits': count, 'dwellSeconds': seconds}
+    return {
+        name: {
+            'locationId': name,
+            'visits': total_visits,
+            'dwellSeconds': total_dwell,
+            'firstVisitAt': first_visit if first_visit != no_visit else None,
+            'lastVisitAt': last_visit,
+            'days': days,
+        }
+        for name, total_visits, total_dwell, first_visit, last_visit, days in zip(
+            names, location_visits.tolist(), location_dwell.tolist(), first_visits.tolist(), last_visits.tolist(), days_by_location,
+        )
+    }
+
+def aggregate(intervals: Sequence[Interval]) -> Dict[str, LocationStats]:
+    '''Totals of `rollup` as models.
+    :param intervals: (location id, start, end, visits) tuples
+    :return: stats keyed by location id, without `userId` filled in
+    '''
+    # One validation per location covers all of its days
+    return {
+        location_id: LocationStats.model_validate({**totals, 'userId': ''})
+        for location_id, totals in rollup(intervals).items()
+    }
+
+def stage_intervals(batch, db, user_id: str, intervals: Sequence[Interval], sign: int = 1):
+    '''Stage increments of the rollups on a batch or transaction.
+
+    One merge write per location; pass sign=-1 to take intervals back out.
+    Visit bounds only ever widen, they are fixed up by a rebuild.
+    :param batch: firestore batch or transaction
+    :param db: firestore client
+    :param user_id: owner of the locations
+    :param intervals: (location id, start, end, visits) tuples
+    :param sign: 1 to add the intervals, -1 to subtract them
+    '''
+    for location_id, totals in rollup(intervals).items():
+        fields = {
+            'locationId': location_id,
+            'userId': user_id,
+            'visits': firestore.Increment(sign * totals['visits']),
+            'dwellSeconds': firestore.Increment(sign * totals['dwellSeconds']),
+            'days': {
+                day: {
+                    'visits': firestore.Increment(sign * day_totals['visits']),
+                    'dwellSeconds': firestore.Increment(sign * day_totals['dwellSeconds']),
+                }
+                for day, day_totals in totals['days'].items()
+            },
+        }
+        if sign > 0:
+            if totals['firstVisitAt'] is not None:
+                fields['firstVisitAt'] = firestore.Minimum(totals['firstVisitAt'])
+            fields['lastVisitAt'] = firestore.Maximum(totals['lastVisitAt'])
+        batch.set(location_stats_ref(db, location_id), fields, merge=True)
+
+def event_interval(event: Event) -> Interval:
+    return (event.locationId, event.createdAt, event.updatedAt, 1)
+
+def is_open(event: Event) -> bool:
+    '''Whether an event has no observed departure yet.
+    '''
+    return event.updatedAt <= event.createdAt
+
+def closed_at(event: Event, next_created_at: int) -> Optional[int]:
+    '''When an open event ends, given the creation of the user's next event.
+    :param event: the event
+    :param next_created_at: creation time of the event following it
+    :return: the new `updatedAt`, or None if the event is not open or would not grow
+    '''
+    if not is_open(event):
+        return None
+    end = min(next_created_at, event.createdAt + MAX_DWELL)
+    return end if end > event.updatedAt else None
+
+def closing_interval(event: Event, end: int) -> Interval:
+    '''Dwell added by closing an event at a time, not a new visit.
+    '''
+    return (event.locationId, event.updatedAt, end, 0)
+
+def fetch_stats(db, location: Location, days: int, now: Optional[int] = None) -> LocationStats:
+    '''Rollups of a location with the daily totals of the last days.
+    :param db: firestore client
+    :param location: the location
+    :param days: number of days up to and including today to return
+    :param now: current time in epoch seconds, defaults to now
+    :return: stats of the location, zero if it was never visited
+    '''
+    location_stats_doc = location_stats_ref(db, location.locationId).get()
+    if not location_stats_doc.exists:
+        return LocationStats(locationId=location.locationId, userId=location.userId)
+    location_stats = location_stats_to_pydantic(location_stats_doc)
+    today = int(now if now is not None else datetime.now(timezone.utc).timestamp()) // DAY
+    window: Dict[str, DayStats] = {}
+    for day in range(today - days + 1, today + 1):
+        key = day_key(day)
+        if key in location_stats.days:
+            window[key] = location_stats.days[key]
+    return location_stats.model_copy(update={'days': window})
+
+def drop_location(db, location_id: str):
+    location_stats_ref(db, location_id).delete()
+
+def stream_intervals(db, user_id: Optional[str] = None) -> Iterable[Tuple[str, Interval]]:
+    '''Every event as (user id, interval), archived events first.
+
+    An open event is held back until the user's next event closes it; the
+    ones still open at the end are yielded as they are.
+    '''
+    # Open event of each user, waiting for the user's next event
+    open_events: Dict[str, Event] = {}
+
+    def _next(event: Event) -> Iterable[Tuple[str, Interval]]:
+        previous = open_events.pop(event.userId, None)
+        if previous is not None:
+            end = closed_at(previous, event.createdAt)
+            yield previous.userId, event_interval(previous if end is None else previous.model_copy(update={'updatedAt': end}))
+        if is_open(event):
+            open_events[event.userId] = event
+        else:
+            yield event.userId, event_interval(event)
+
+    for event in stream_archived(db, user_id):
+        yield from _next(event)
+    query = db.collection("Events")
+    if user_id is not None:
+        query = query.where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))
+    for event_doc in query.order_by('createdAt').stream():
+        yield from _next(event_to_pydantic(event_doc, event_doc.id))
+    for event in open_events.values():
+        yield event.userId, event_interval(event)
+
+def rebuild(db, user_id: Optional[str] = None) -> int:
+    '''Recompute rollups from `Events`, replacing the stored ones.
+
+    Events are summed chunk by chunk, so memory grows with the number of
+    location days rather than the number of events.
+    :param db: firestore client
+    :param user_id: only rebuild this user's locations, all users if None
+    :return: number of location stats written
+    '''
+    totals: Dict[str, Dict[str, Any]] = {}
+    owners: Dict[str, str] = {}
+
+    def _flush(chunk: List[Interval]):
+        for location_id, chunk_totals in rollup(chunk).items():
+            total = totals.get(location_id)
+            if total is None:
+                totals[location_id] = chunk_totals
+                continue
+            total['visits'] += chunk_totals['visits']
+            total['dwellSeconds'] += chunk_totals['dwellSeconds']
+            bounds = [value for value in (total['firstVisitAt'], chunk_totals['firstVisitAt']) if value is not None]
+            total['firstVisitAt'] = min(bounds) if len(bounds) > 0 else None
+            total['lastVisitAt'] = max(total['lastVisitAt'], chunk_totals['lastVisitAt'])
+            for day, day_totals in chunk_totals['days'].items():
+                current = total['days'].setdefault(day, {'visits': 0, 'dwellSeconds': 0})
+                current['visits'] += day_totals['visits']
+                current['dwellSeconds'] += day_totals['dwellSeconds']
+
+    chunk: List[Interval] = []
+    for owner_id, interval in stream_intervals(db, user_id):
+        owners[interval[0]] = owner_id
+        chunk.append(interval)
+        if len(chunk) >= REBUILD_CHUNK_SIZE:
+            _flush(chunk)
+            chunk = []
+    _flush(chunk)
+
+    # Stats of locations that no longer have events are removed
+    stale_query = db.collection(LOCATION_STATS)
+    if user_id is not None:
+        stale_query = stale_query.where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))
+    stale_refs = [doc.reference for doc in stale_query.stream() if doc.id not in totals]
+
+    location_ids = sorted(totals)
+    writes = [('set', location_id) for location_id in location_ids] + [('delete', ref) for ref in stale_refs]
+    for start in range(0, len(writes), BATCH_SIZE):
+        batch = db.batch()
+        for kind, target in writes[start:start + BATCH_SIZE]:
+            if kind == 'delete':
+                batch.delete(target)
+                continue
+            # Validated once per location, on the way out
+            location_stats = LocationStats.model_validate({**totals[target], 'userId': owners[target]})
+            batch.set(location_stats_ref(db, target), location_stats.model_dump())
+        batch.commit()
+    return len(location_ids)
+
+if __name__ == '__main__':
+    import sys
+    from dotenv import load_dotenv
+    from .database import get_client
+
+    load_dotenv()
+    count = rebuild(get_client(), sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f"Rebuilt {count} location stats")
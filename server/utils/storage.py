@@ -0,0 +1,606 @@
+'''Local storage backends implementing the subset of the Firestore client API
+the server uses.
+
+`MemoryClient` keeps documents in a dict and `SqliteClient` keeps them in a
+SQLite file. Both support references, queries with filters, ordering and
+cursors, batched gets, batched writes and optimistic transactions, so the
+server and its load tests run without network access or Firebase
+credentials. Select one with `WHEREABOUT_STORAGE` (see `database.get_client`).
+'''
+import copy
+import json
+import sqlite3
+import uuid
+from base64 import b64decode, b64encode
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from threading import RLock
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+# Firestore caps a batched write at 500 operations
+MAX_BATCH_SIZE = 500
+
+ASCENDING = 'ASCENDING'
+DESCENDING = 'DESCENDING'
+
+Key = Tuple[str, str]
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+def _get_field(data: Dict[str, Any], field_path: str) -> Any:
+    '''Nested value of a dotted field path, raising KeyError when missing.
+    '''
+    value: Any = data
+    for part in field_path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(field_path)
+        value = value[part]
+    return value
+
+def _project(data: Dict[str, Any], field_paths: Iterable[str]) -> Dict[str, Any]:
+    '''Copy of only the given dotted field paths of data, like a Firestore projection.
+    '''
+    result: Dict[str, Any] = {}
+    for field_path in field_paths:
+        try:
+            value = _get_field(data, field_path)
+        except KeyError:
+            continue
+        parts = field_path.split('.')
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = copy.deepcopy(value)
+    return result
+
+def _type_rank(value: Any) -> int:
+    # Firestore orders values of different types by type first
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, datetime):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, list):
+        return 5
+    return 6
+
+def _sort_key(value: Any) -> Tuple[int, Any]:
+    if isinstance(value, dict):
+        return (_type_rank(value), sorted(value.items()))
+    return (_type_rank(value), value)
+
+def _apply_value(current: Any, value: Any) -> Any:
+    '''Resolve transforms and sentinels against the current field value.
+    '''
+    if value is transforms.SERVER_TIMESTAMP:
+        return _now()
+    if isinstance(value, transforms.ArrayUnion):
+        result = list(current) if isinstance(current, list) else []
+        result.extend(item for item in value.values if item not in result)
+        return result
+    if isinstance(value, transforms.ArrayRemove):
+        current = current if isinstance(current, list) else []
+        return [item for item in current if item not in value.values]
+    if isinstance(value, transforms.Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, transforms.Maximum):
+        return max(current, value.value) if isinstance(current, (int, float)) else value.value
+    if isinstance(value, transforms.Minimum):
+        return min(current, value.value) if isinstance(current, (int, float)) else value.value
+    if isinstance(value, dict):
+        current = current if isinstance(current, dict) else {}
+        return {key: _apply_value(current.get(key), item) for key, item in value.items()}
+    return copy.deepcopy(value)
+
+def _merge(data: Dict[str, Any], updates: Dict[str, Any], dotted: bool) -> Dict[str, Any]:
+    '''Copy of data with updates applied, dotted keys address nested fields.
+    '''
+    result = copy.deepcopy(data)
+    for key, value in updates.items():
+        parts = key.split('.') if dotted else [key]
+        target = result
+        for part in parts[:-1]:
+            if not isinstance(target.get(part), dict):
+                target[part] = {}
+            target = target[part]
+        if value is transforms.DELETE_FIELD:
+            target.pop(parts[-1], None)
+        elif isinstance(value, dict) and not dotted:
+            # set(merge=True) merges nested maps instead of replacing them
+            target[parts[-1]] = _merge(target.get(parts[-1]) or {}, value, dotted=False) \
+                if isinstance(target.get(parts[-1]), dict) else _apply_value(None, value)
+        else:
+            target[parts[-1]] = _apply_value(target.get(parts[-1]), value)
+    return result
+
+class WriteResult:
+    def __init__(self, update_time: datetime):
+        self.update_time = update_time
+
+class DocumentSnapshot:
+    def __init__(self, reference: 'DocumentReference', data: Optional[Dict[str, Any]], version: int, update_time: Optional[datetime] = None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self.create_time = update_time
+        self._data = data
+        self._version = version
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path: str) -> Any:
+        if self._data is None:
+            raise KeyError(field_path)
+        return copy.deepcopy(_get_field(self._data, field_path))
+
+class DocumentReference:
+    def __init__(self, client: 'LocalClient', collection: str, doc_id: str):
+        self._client = client
+        self._collection = collection
+        self.id = doc_id
+
+    @property
+    def path(self) -> str:
+        return f"{self._collection}/{self.id}"
+
+    @property
+    def key(self) -> Key:
+        return (self._collection, self.id)
+
+    @property
+    def parent(self) -> 'CollectionReference':
+        return CollectionReference(self._client, self._collection)
+
+    def collection(self, name: str) -> 'CollectionReference':
+        return CollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction: Optional['Transaction'] = None, **kwargs) -> DocumentSnapshot:
+        snapshot = self._client._snapshot(self, field_paths)
+        if transaction is not None:
+            transaction._record(snapshot)
+        return snapshot
+
+    def create(self, document_data: Dict[str, Any], **kwargs) -> WriteResult:
+        return self._client._commit([('create', self, document_data)])[0]
+
+    def set(self, document_data: Dict[str, Any], merge: bool = False, **kwargs) -> WriteResult:
+        return self._client._commit([('merge' if merge else 'set', self, document_data)])[0]
+
+    def update(self, field_updates: Dict[str, Any], option=None, **kwargs) -> WriteResult:
+        return self._client._commit([('update', self, field_updates)])[0]
+
+    def delete(self, option=None, **kwargs) -> WriteResult:
+        return self._client._commit([('delete', self, None)])[0]
+
+class Query:
+    def __init__(
+        self,
+        client: 'LocalClient',
+        collection: str,
+        filters: Tuple = (),
+        orders: Tuple = (),
+        limit: Optional[int] = None,
+        offset: int = 0,
+        cursor: Optional[Any] = None,
+    ):
+        self._client = client
+        self._collection = collection
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._offset = offset
+        self._cursor = cursor
+
+    def _copy(self, **kwargs) -> 'Query':
+        state = {
+            'filters': self._filters,
+            'orders': self._orders,
+            'limit': self._limit,
+            'offset': self._offset,
+            'cursor': self._cursor,
+        }
+        state.update(kwargs)
+        return Query(self._client, self._collection, **state)
+
+    def where(self, field_path: Optional[str] = None, op_string: Optional[str] = None, value: Any = None, *, filter: Optional[FieldFilter] = None) -> 'Query':
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING) -> 'Query':
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int) -> 'Query':
+        return self._copy(limit=count)
+
+    def offset(self, num_to_skip: int) -> 'Query':
+        return self._copy(offset=num_to_skip)
+
+    def start_after(self, document_fields_or_snapshot: Any) -> 'Query':
+        return self._copy(cursor=document_fields_or_snapshot)
+
+    def select(self, field_paths: Iterable[str]) -> 'Query':
+        return self
+
+    def _matches(self, doc_id: str, data: Dict[str, Any]) -> bool:
+        for field_path, op, expected in self._filters:
+            try:
+                value = doc_id if field_path == '__name__' else _get_field(data, field_path)
+            except KeyError:
+                return False
+            if op == '==' and not value == expected:
+                return False
+            if op == '!=' and not value != expected:
+                return False
+            if op in ('<', '<=', '>', '>='):
+                if _type_rank(value) != _type_rank(expected):
+                    return False
+                if op == '<' and not value < expected:
+                    return False
+                if op == '<=' and not value <= expected:
+                    return False
+                if op == '>' and not value > expected:
+                    return False
+                if op == '>=' and not value >= expected:
+                    return False
+            if op == 'in' and value not in expected:
+                return False
+            if op == 'not-in' and value in expected:
+                return False
+            if op == 'array_contains' and not (isinstance(value, list) and expected in value):
+                return False
+            if op == 'array_contains_any' and not (isinstance(value, list) and any(item in value for item in expected)):
+                return False
+        return True
+
+    def _order_values(self, doc_id: str, data: Dict[str, Any]) -> List[Any]:
+        return [doc_id if field == '__name__' else _get_field(data, field) for field, _ in self._orders]
+
+    def _compare(self, left: List[Any], right: List[Any]) -> int:
+        for (_, direction), a, b in zip(self._orders, left, right):
+            a, b = _sort_key(a), _sort_key(b)
+            if a == b:
+                continue
+            result = -1 if a < b else 1
+            return -result if direction == DESCENDING else result
+        return 0
+
+    def _cursor_values(self) -> List[Any]:
+        cursor = self._cursor
+        if isinstance(cursor, DocumentSnapshot):
+            return self._order_values(cursor.id, cursor._data or {})
+        return [cursor[field] for field, _ in self._orders]
+
+    def _run(self, transaction: Optional['Transaction'] = None) -> List[DocumentSnapshot]:
+        rows = []
+        for doc_id, data, version, update_time in self._client._scan(self._collection):
+            if not self._matches(doc_id, data):
+                continue
+            try:
+                values = self._order_values(doc_id, data)
+            except KeyError:
+                # Documents missing an order-by field are excluded
+                continue
+            rows.append((values, doc_id, data, version, update_time))
+        for index in reversed(range(len(self._orders))):
+            descending = self._orders[index][1] == DESCENDING
+            rows.sort(key=lambda row: _sort_key(row[0][index]), reverse=descending)
+        if self._cursor is not None:
+            cursor_values = self._cursor_values()
+            rows = [row for row in rows if self._compare(row[0], cursor_values) > 0]
+        rows = rows[self._offset:]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        snapshots = [
+            DocumentSnapshot(DocumentReference(self._client, self._collection, doc_id), data, version, update_time)
+            for _, doc_id, data, version, update_time in rows
+        ]
+        if transaction is not None:
+            for snapshot in snapshots:
+                transaction._record(snapshot)
+        return snapshots
+
+    def stream(self, transaction: Optional['Transaction'] = None, **kwargs) -> Iterable[DocumentSnapshot]:
+        return iter(self._run(transaction))
+
+    def get(self, transaction: Optional['Transaction'] = None, **kwargs) -> List[DocumentSnapshot]:
+        return self._run(transaction)
+
+class CollectionReference(Query):
+    def __init__(self, client: 'LocalClient', collection: str):
+        super().__init__(client, collection)
+
+    @property
+    def id(self) -> str:
+        return self._collection.split('/')[-1]
+
+    def document(self, document_id: Optional[str] = None) -> DocumentReference:
+        return DocumentReference(self._client, self._collection, document_id or uuid.uuid4().hex[:20])
+
+    def add(self, document_data: Dict[str, Any], document_id: Optional[str] = None) -> Tuple[datetime, DocumentReference]:
+        reference = self.document(document_id)
+        result = reference.create(document_data)
+        return result.update_time, reference
+
+class WriteBatch:
+    def __init__(self, client: 'LocalClient'):
+        self._client = client
+        self._ops: List[Tuple[str, DocumentReference, Any]] = []
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    def create(self, reference: DocumentReference, document_data: Dict[str, Any]):
+        self._ops.append(('create', reference, document_data))
+
+    def set(self, reference: DocumentReference, document_data: Dict[str, Any], merge: bool = False):
+        self._ops.append(('merge' if merge else 'set', reference, document_data))
+
+    def update(self, reference: DocumentReference, field_updates: Dict[str, Any], option=None):
+        self._ops.append(('update', reference, field_updates))
+
+    def delete(self, reference: DocumentReference, option=None):
+        self._ops.append(('delete', reference, None))
+
+    def commit(self, **kwargs) -> List[WriteResult]:
+        ops, self._ops = self._ops, []
+        return self._client._commit(ops)
+
+class Transaction(WriteBatch):
+    '''Optimistic transaction compatible with `firestore.transactional`.
+
+    Versions of every document read are checked at commit and a conflict
+    raises Aborted, which makes the decorator retry the whole function.
+    '''
+
+    def __init__(self, client: 'LocalClient', max_attempts: int = 5, read_only: bool = False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id: Optional[bytes] = None
+        self._reads: Dict[Key, int] = {}
+
+    @property
+    def in_progress(self) -> bool:
+        return self._id is not None
+
+    @property
+    def id(self) -> Optional[bytes]:
+        return self._id
+
+    def _record(self, snapshot: DocumentSnapshot):
+        self._reads.setdefault(snapshot.reference.key, snapshot._version)
+
+    def _clean_up(self):
+        self._ops = []
+        self._reads = {}
+        self._id = None
+
+    def _begin(self, retry_id: Optional[bytes] = None):
+        self._id = uuid.uuid4().bytes
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self) -> List[WriteResult]:
+        ops, reads = self._ops, self._reads
+        self._clean_up()
+        return self._client._commit(ops, reads)
+
+    def get(self, ref_or_query, **kwargs):
+        if isinstance(ref_or_query, DocumentReference):
+            return iter([ref_or_query.get(transaction=self)])
+        return ref_or_query.stream(transaction=self)
+
+    def get_all(self, references: Iterable[DocumentReference], **kwargs):
+        return self._client.get_all(references, transaction=self)
+
+class LocalClient:
+    '''Shared logic of the local backends, subclasses provide the storage.
+    '''
+
+    def __init__(self):
+        self._lock = RLock()
+        self._version = 0
+
+    # --- storage primitives ---
+
+    def _read(self, key: Key) -> Optional[Tuple[Dict[str, Any], int, datetime]]:
+        raise NotImplementedError
+
+    def _scan(self, collection: str) -> Iterable[Tuple[str, Dict[str, Any], int, datetime]]:
+        raise NotImplementedError
+
+    def _write(self, changes: Dict[Key, Optional[Tuple[Dict[str, Any], int, datetime]]]):
+        raise NotImplementedError
+
+    def _exclusive(self):
+        '''Context in which no other writer can interleave with a commit.
+        '''
+        return nullcontext()
+
+    def _next_version(self) -> int:
+        self._version += 1
+        return self._version
+
+    # --- client api ---
+
+    def collection(self, collection_path: str) -> CollectionReference:
+        return CollectionReference(self, collection_path)
+
+    def document(self, document_path: str) -> DocumentReference:
+        collection, doc_id = document_path.rsplit('/', 1)
+        return DocumentReference(self, collection, doc_id)
+
+    def get_all(self, references: Iterable[DocumentReference], field_paths=None, transaction: Optional[Transaction] = None, **kwargs):
+        for reference in references:
+            yield reference.get(field_paths=field_paths, transaction=transaction)
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def transaction(self, max_attempts: int = 5, read_only: bool = False) -> Transaction:
+        return Transaction(self, max_attempts=max_attempts, read_only=read_only)
+
+    def close(self):
+        pass
+
+    def _snapshot(self, reference: DocumentReference, field_paths: Optional[Iterable[str]] = None) -> DocumentSnapshot:
+        with self._lock:
+            stored = self._read(reference.key)
+        if stored is None:
+            return DocumentSnapshot(reference, None, 0)
+        data, version, update_time = stored
+        data = copy.deepcopy(data) if field_paths is None else _project(data, field_paths)
+        return DocumentSnapshot(reference, data, version, update_time)
+
+    def _commit(self, ops: List[Tuple[str, DocumentReference, Any]], reads: Optional[Dict[Key, int]] = None) -> List[WriteResult]:
+        '''Atomically check read versions and apply a list of writes.
+        '''
+        if len(ops) > MAX_BATCH_SIZE:
+            raise exceptions.InvalidArgument(f"maximum {MAX_BATCH_SIZE} writes allowed per request")
+        with self._lock, self._exclusive():
+            for key, version in (reads or {}).items():
+                stored = self._read(key)
+                if (stored[1] if stored is not None else 0) != version:
+                    raise exceptions.Aborted("Transaction lock timeout: document changed")
+            version = self._next_version()
+            update_time = _now()
+            staged: Dict[Key, Optional[Tuple[Dict[str, Any], int, datetime]]] = {}
+            for kind, reference, data in ops:
+                key = reference.key
+                current = staged[key] if key in staged else self._read(key)
+                if kind == 'create':
+                    if current is not None:
+                        raise exceptions.AlreadyExists(f"Document already exists: {reference.path}")
+                    staged[key] = (_merge({}, data, dotted=False), version, update_time)
+                elif kind == 'set':
+                    staged[key] = (_merge({}, data, dotted=False), version, update_time)
+                elif kind == 'merge':
+                    base = current[0] if current is not None else {}
+                    staged[key] = (_merge(base, data, dotted=False), version, update_time)
+                elif kind == 'update':
+                    if current is None:
+                        raise exceptions.NotFound(f"No document to update: {reference.path}")
+                    staged[key] = (_merge(current[0], data, dotted=True), version, update_time)
+                elif kind == 'delete':
+                    staged[key] = None
+            self._write(staged)
+        return [WriteResult(update_time) for _ in ops]
+
+class MemoryClient(LocalClient):
+    '''Documents kept in process memory, lost on exit.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self._collections: Dict[str, Dict[str, Tuple[Dict[str, Any], int, datetime]]] = {}
+
+    def _read(self, key: Key):
+        return self._collections.get(key[0], {}).get(key[1])
+
+    def _scan(self, collection: str):
+        with self._lock:
+            rows = list(self._collections.get(collection, {}).items())
+        # Stored data is replaced, never mutated, and snapshots hand out copies
+        return [(doc_id, data, version, update_time) for doc_id, (data, version, update_time) in rows]
+
+    def _write(self, changes):
+        for (collection, doc_id), stored in changes.items():
+            documents = self._collections.setdefault(collection, {})
+            if stored is None:
+                documents.pop(doc_id, None)
+            else:
+                documents[doc_id] = stored
+
+def _encode_json(value: Any) -> Any:
+    # Blobs round-trip as tagged base64, anything else is stored as text
+    if isinstance(value, bytes):
+        return {'__bytes__': b64encode(value).decode('ascii')}
+    return str(value)
+
+def _decode_json(value: Dict[str, Any]) -> Any:
+    if len(value) == 1 and '__bytes__' in value:
+        return b64decode(value['__bytes__'])
+    return value
+
+class SqliteClient(LocalClient):
+    '''Documents kept as JSON rows in a SQLite database.
+
+    Commits hold the database write lock from the version checks to the
+    last write, so several worker processes can share one file.
+    '''
+
+    def __init__(self, path: str = ':memory:'):
+        super().__init__()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS documents ('
+            'collection TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, '
+            'version INTEGER NOT NULL, updated REAL NOT NULL, '
+            'PRIMARY KEY (collection, id))'
+        )
+        # Versions come from one counter shared by every process
+        self._connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        self._connection.execute(
+            "INSERT OR IGNORE INTO meta (key, value) SELECT 'version', COALESCE(MAX(version), 0) FROM documents"
+        )
+
+    @contextmanager
+    def _exclusive(self):
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        self._connection.execute('COMMIT')
+
+    def _next_version(self) -> int:
+        self._connection.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        return self._connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    @staticmethod
+    def _decode(data: str, version: int, updated: float):
+        return json.loads(data, object_hook=_decode_json), version, datetime.fromtimestamp(updated, timezone.utc)
+
+    def _read(self, key: Key):
+        row = self._connection.execute(
+            'SELECT data, version, updated FROM documents WHERE collection = ? AND id = ?', key,
+        ).fetchone()
+        return self._decode(*row) if row is not None else None
+
+    def _scan(self, collection: str):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT id, data, version, updated FROM documents WHERE collection = ?', (collection,),
+            ).fetchall()
+        return [(doc_id, *self._decode(data, version, updated)) for doc_id, data, version, updated in rows]
+
+    def _write(self, changes):
+        for (collection, doc_id), stored in changes.items():
+            if stored is None:
+                self._connection.execute(
+                    'DELETE FROM documents WHERE collection = ? AND id = ?', (collection, doc_id),
+                )
+                continue
+            data, version, update_time = stored
+            self._connection.execute(
+                'INSERT OR REPLACE INTO documents (collection, id, data, version, updated) VALUES (?, ?, ?, ?, ?)',
+                (collection, doc_id, json.dumps(data, default=_encode_json), version, update_time.timestamp()),
+            )
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,221 @@
+'''Bulk export and import of users' data as NDJSON.
+
+Every line holds one document, `{"collection": "Events", "data": {...}}`,
+with the document id in the model's id field. Exports page through each
+collection with cursors and imports commit in bounded batches, so neither
+holds more than a few pages in memory.
+
+Imports keep document ids and overwrite existing documents, so a failed
+import can be rerun with the same file. Derived data (friend lists, latest
+events and location stats) is rebuilt for every imported user.
+'''
+import asyncio
+from os import environ as env
+from time import time
+from typing import AsyncIterable, AsyncIterator, Callable, Dict, List, Set, Tuple, Type
+from fastapi import HTTPException
+from firebase_admin import firestore
+from pydantic import BaseModel, ValidationError
+
+from . import latest_events, stats
+from .archive import EVENT_ARCHIVES, unpack
+from .cache import model_cache
+from .friends import RELATION_FRIEND, friend_list_ref, invalidate as invalidate_friends, relation_id
+from .geo import geofence_cache
+from .pagination import paginate
+from .repository import run
+from .schemas import (
+    Event,
+    ExportRecord,
+    Location,
+    Relation,
+    event_archive_to_pydantic,
+    event_to_pydantic,
+    location_to_pydantic,
+    relation_to_pydantic,
+)
+
+# Exported collections in import order, so events follow their locations
+COLLECTIONS: Dict[str, Tuple[Type[BaseModel], str, Callable]] = {
+    "Locations": (Location, 'locationId', location_to_pydantic),
+    "Events": (Event, 'eventId', event_to_pydantic),
+    "Relations": (Relation, 'relationId', relation_to_pydantic),
+}
+
+# Documents read per export query
+EXPORT_PAGE_SIZE = int(env.get('EXPORT_PAGE_SIZE', 500))
+# Event archives read per export query, each holds up to a month of events
+ARCHIVE_PAGE_SIZE = 12
+
+# Firestore caps a batched write at 500 operations
+BATCH_SIZE = 500
+
+# Batches committed at once by an import
+IMPORT_CONCURRENCY = int(env.get('IMPORT_CONCURRENCY', 4))
+
+# Longest import line accepted, in bytes
+MAX_LINE_SIZE = 1 << 20
+
+# Seconds allowed for rebuilding one user's derived data after an import
+REBUILD_TIMEOUT = float(env.get('IMPORT_REBUILD_TIMEOUT', 300))
+
+async def export_archived(db, user_id: str) -> AsyncIterator[bytes]:
+    '''Stream a user's archived events as `Events` records.
+    '''
+    query = db.collection(EVENT_ARCHIVES)\
+        .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
+        .order_by('__name__')
+    cursor = None
+    while True:
+        archive_docs, cursor = await run(paginate, query, ['__name__'], ARCHIVE_PAGE_SIZE, cursor)
+        for archive_doc in archive_docs:
+            lines = [
+                ExportRecord(collection="Events", data=event.model_dump()).model_dump_json()
+                for event in unpack(event_archive_to_pydantic(archive_doc))
+            ]
+            if len(lines) > 0:
+                yield ('\n'.join(lines) + '\n').encode('utf8')
+        if cursor is None:
+            break
+
+async def export_records(db, user_id: str) -> AsyncIterator[bytes]:
+    '''Stream a user's documents as NDJSON, one page per chunk.
+
+    Archived events are exported as plain events; an import writes them
+    back to `Events` for the next compaction to archive again.
+    :param db: firestore client
+    :param user_id: id of the user to export
+    :return: async iterator of NDJSON chunks
+    '''
+    for collection_name, (_, _, to_pydantic) in COLLECTIONS.items():
+        if collection_name == "Events":
+            async for chunk in export_archived(db, user_id):
+                yield chunk
+        query = db.collection(collection_name)\
+            .where(filter=firestore.firestore.FieldFilter('userId', '==', user_id))\
+            .order_by('__name__')
+        cursor = None
+        while True:
+            docs, cursor = await run(paginate, query, ['__name__'], EXPORT_PAGE_SIZE, cursor)
+            lines = [
+                ExportRecord(collection=collection_name, data=to_pydantic(doc, doc.id).model_dump()).model_dump_json()
+                for doc in docs
+            ]
+            if len(lines) > 0:
+                yield ('\n'.join(lines) + '\n').encode('utf8')
+            if cursor is None:
+                break
+
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[Tuple[int, bytes]]:
+    '''Split a byte stream into numbered non-empty lines.
+    '''
+    buffer = b''
+    number = 0
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        if len(buffer) > MAX_LINE_SIZE:
+            raise HTTPException(status_code=400, detail=f"Line {number + len(lines) + 1} is longer than {MAX_LINE_SIZE} bytes")
+        for line in lines:
+            number += 1
+            if line.strip():
+                yield number, line
+    if buffer.strip():
+        yield number + 1, buffer
+
+def parse_record(number: int, line: bytes) -> Tuple[str, BaseModel]:
+    '''Validate one import line.
+    :return: collection name and the document's model
+    '''
+    try:
+        record = ExportRecord.model_validate_json(line)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid record on line {number}: {e}")
+    if record.collection not in COLLECTIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown collection {record.collection} on line {number}")
+    model_class, id_field, _ = COLLECTIONS[record.collection]
+    try:
+        model = model_class.model_validate(record.data)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid record on line {number}: {e}")
+    if getattr(model, id_field) is None:
+        raise HTTPException(status_code=400, detail=f"Record on line {number} has no {id_field}")
+    if record.collection == "Relations" and model.relationId != relation_id(model.userId, model.recipientId):
+        raise HTTPException(status_code=400, detail=f"Relation on line {number} does not have id {relation_id(model.userId, model.recipientId)}")
+    return record.collection, model
+
+def stage_record(batch, db, collection_name: str, model: BaseModel) -> int:
+    '''Stage the write of one imported document.
+    :return: number of operations staged
+    '''
+    _, id_field, _ = COLLECTIONS[collection_name]
+    batch.set(db.collection(collection_name).document(getattr(model, id_field)), model.model_dump())
+    if collection_name != "Relations" or model.relation != RELATION_FRIEND:
+        return 1
+    # The inverse relation belongs to the friend, so only this side is listed
+    batch.set(friend_list_ref(db, model.userId), {
+        'userId': model.userId,
+        'friendIds': firestore.ArrayUnion([model.recipientId]),
+        'updatedAt': int(time()),
+    }, merge=True)
+    return 2
+
+def rebuild_user(db, user_id: str):
+    '''Recompute the data derived from a user's events.
+    '''
+    latest_events.rebuild_user(db, user_id)
+    stats.rebuild(db, user_id)
+
+async def import_records(db, chunks: AsyncIterable[bytes]) -> Dict[str, int]:
+    '''Write NDJSON records with batched commits, a few batches at a time.
+
+    Lines are validated as they arrive; an invalid line stops the import
+    with a 400 after the batches before it have been committed.
+    :param db: firestore client
+    :param chunks: NDJSON byte stream, e.g. a request body
+    :return: number of documents written per collection
+    '''
+    counts = {collection_name: 0 for collection_name in COLLECTIONS}
+    user_ids: Set[str] = set()
+    pending: Set[asyncio.Task] = set()
+    batch, size = db.batch(), 0
+    cached: List[Tuple[str, str]] = []
+
+    async def _commit(batch, cached: List[Tuple[str, str]]):
+        await run(batch.commit)
+        for key in cached:
+            model_cache.invalidate(key)
+
+    async def _flush():
+        nonlocal batch, size, cached, pending
+        if size == 0:
+            return
+        pending.add(asyncio.create_task(_commit(batch, cached)))
+        batch, size, cached = db.batch(), 0, []
+        if len(pending) >= IMPORT_CONCURRENCY:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+
+    try:
+        async for number, line in iter_lines(chunks):
+            collection_name, model = parse_record(number, line)
+            if size + 2 > BATCH_SIZE:
+                await _flush()
+            size += stage_record(batch, db, collection_name, model)
+            _, id_field, _ = COLLECTIONS[collection_name]
+            cached.append((collection_name, getattr(model, id_field)))
+            counts[collection_name] += 1
+            user_ids.add(model.userId)
+        await _flush()
+        await asyncio.gather(*pending)
+    except BaseException:
+        # Let batches already sent finish, so the error marks where to resume
+        await asyncio.gather(*pending, return_exceptions=True)
+        raise
+
+    for user_id in sorted(user_ids):
+        geofence_cache.invalidate(user_id)
+        invalidate_friends(user_id)
+        await run(rebuild_user, db, user_id, timeout=REBUILD_TIMEOUT)
+    return counts
@@ -1,3 +1,5 @@
+from hashlib import sha256
+from os import environ as env
 from typing import Optional
 from fastapi import Depends, HTTPException
 from fastapi.security import (
@@ -7,58 +9,104 @@ from fastapi.security import (
     HTTPBasicCredentials,
 )
 from firebase_admin import auth
-from .schemas import FBUser, User, Location, Event
-from .database import get_firebase_client
+from .schemas import (
+    FBUser,
+    User,
+    Location,
+    Event,
+    user_to_pydantic,
+    location_to_pydantic,
+    event_to_pydantic,
+)
+from .cache import LRUCache, model_cache
+from .friends import RELATION_FRIEND
+from .database import client as db, initialize_firebase, storage_backend
 
 security = HTTPBearer()
-db = get_firebase_client()
 
-RELATION_FRIEND = 1
+# Verified tokens keyed by hash, each expiring with the token's own `exp`
+token_cache = LRUCache(max_size=int(env.get('TOKEN_CACHE_SIZE', 10000)))
 
-def get_firebase_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> FBUser:
-    id_token: str = credentials.credentials
-    # This call will raise errors if the token is invalid
-    decoded_token = auth.verify_id_token(id_token)
-    fb_auth_user = FBUser(
-        # We expect name and picture to be None when user authenticates via Apple auth
-        name=decoded_token.get('name', None),
-        picture=decoded_token.get('picture', None),
-        iss=decoded_token['iss'],
-        aud=decoded_token['aud'],
-        auth_time=decoded_token['auth_time'],
-        user_id=decoded_token['user_id'],
-        sub=decoded_token['sub'],
-        iat=decoded_token['iat'],
-        exp=decoded_token['exp'],
-        email=decoded_token['email'],
-        email_verified=decoded_token['email_verified'],
-        uid=decoded_token['uid'],
+# Treat bearer tokens as plain user ids, for local backends and load tests only
+LOCAL_AUTH = env.get('WHEREABOUT_LOCAL_AUTH') == '1'
+if LOCAL_AUTH and storage_backend() == 'firestore':
+    raise RuntimeError("WHEREABOUT_LOCAL_AUTH requires a local storage backend")
+
+def local_firebase_user(user_id: str) -> FBUser:
+    '''Firebase user for a local token, which is the user id itself.
+    '''
+    return FBUser(
+        iss='local',
+        aud='local',
+        auth_time=0,
+        user_id=user_id,
+        sub=user_id,
+        iat=0,
+        exp=2 ** 31 - 1,
+        email=f"{user_id}@local",
+        email_verified=True,
+        uid=user_id,
     )
+
+def verify_firebase_token(id_token: str) -> FBUser:
+    '''Verify a firebase ID token, consulting the token cache first.
+    :param id_token: encoded ID token
+    :return: the authenticated firebase user
+    '''
+    if LOCAL_AUTH:
+        return local_firebase_user(id_token)
+    token_key = sha256(id_token.encode('utf8')).hexdigest()
+    fb_auth_user = token_cache.get(token_key)
+    if fb_auth_user is not None:
+        return fb_auth_user
+    # This call will raise errors if the token is invalid. Signing keys are
+    # cached by firebase_admin according to their Cache-Control headers.
+    initialize_firebase()
+    decoded_token = auth.verify_id_token(id_token)
+    # We expect name and picture to be None when user authenticates via Apple auth
+    fb_auth_user = FBUser.model_validate(decoded_token)
+    token_cache.put(token_key, fb_auth_user, expires_at=fb_auth_user.exp)
     return fb_auth_user
 
+def get_firebase_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> FBUser:
+    id_token: str = credentials.credentials
+    return verify_firebase_token(id_token)
+
 def query_user(user_id: str) -> Optional[User]:
+    user = model_cache.get(("Users", user_id))
+    if user is not None:
+        return user
     user_ref = db.collection("Users").document(user_id)
     user = user_ref.get()
     if user.exists:
         # pass through the pydantic model to standardize
-        user = User.model_validate(user.to_dict())
+        user = user_to_pydantic(user)
+        model_cache.put(("Users", user_id), user)
         return user
     return None
 
 def query_location(location_id: str) -> Optional[Location]:
+    location = model_cache.get(("Locations", location_id))
+    if location is not None:
+        return location
     location_ref = db.collection("Locations").document(location_id)
     location = location_ref.get()
     if location.exists:
         # pass through the pydantic model to standardize
-        location = Location.model_validate(location.to_dict())
+        location = location_to_pydantic(location, location_id)
+        model_cache.put(("Locations", location_id), location)
         return location
     return None
 
 def query_event(event_id: str) -> Optional[Event]:
+    event = model_cache.get(("Events", event_id))
+    if event is not None:
+        return event
     event_ref = db.collection("Events").document(event_id)
     event = event_ref.get()
     if event.exists:
         # pass through the pydantic model to standardize
-        event = Event.model_validate(event.to_dict())
+        event = event_to_pydantic(event, event_id)
+        model_cache.put(("Events", event_id), event)
         return event
     return None
@@ -0,0 +1,11 @@
+'''Gunicorn worker running the app on uvicorn with uvloop and httptools.
+'''
+from uvicorn_worker import UvicornWorker
+
+class Worker(UvicornWorker):
+    CONFIG_KWARGS = {'loop': 'uvloop', 'http': 'httptools'}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Stop waiting on open connections just before gunicorn kills the worker
+        self.config.timeout_graceful_shutdown = max(self.cfg.graceful_timeout - 1, 1)
@@ -1,19 +1,30 @@
 import {axiosInstance} from './axios';
-import {User, Relation, Location, FeedItem, LocationEvent} from './types';
 import {
+  User,
+  Relation,
+  Location,
+  FeedItem,
+  LocationEvent,
+  Page,
+  BatchResult,
+} from './types';
+import {
+  BatchGetRequest,
   CreateUserRequest,
   UpdateUserTokenRequest,
   CreateRelationRequest,
   CreateLocationRequest,
   EditLocationRequest,
+  MatchLocationRequest,
   CreateEventRequest,
+  PingBatchRequest,
 } from './types';
 
 // === feed endpoints ===
 
-export const fetchFeed = async (): Promise<FeedItem[]> => {
+export const fetchFeed = async (cursor?: string): Promise<Page<FeedItem>> => {
   return axiosInstance
-    .get('/api/feed')
+    .get('/api/feed', {params: {cursor}})
     .then((res: any) => res.data)
     .catch((err: Error) => console.error('Error in `fetchFeed`:', err));
 };
@@ -27,6 +38,17 @@ export const fetchUser = async (user_id: string): Promise<User> => {
     .catch((err: Error) => console.error('Error in `fetchUser`:', err));
 };
 
+export const fetchUsersBatch = async (
+  ids: string[],
+): Promise<BatchResult<User>> => {
+  const config = {headers: {'Content-Type': 'application/json'}};
+  const body: BatchGetRequest = {ids};
+  return axiosInstance
+    .post('/api/users/batch', body, config)
+    .then((res: any) => res.data)
+    .catch((err: Error) => console.error('Error in `fetchUsersBatch`:', err));
+};
+
 export const createUser = async (body: CreateUserRequest): Promise<User> => {
   const config = {headers: {'Content-Type': 'application/json'}};
   return axiosInstance
@@ -46,8 +68,23 @@ export const updateUserToken = async (
     .catch((err: Error) => console.error('Error in `updateUserToken`:', err));
 };
 
+export const deleteUser = async (userId: string): Promise<boolean> => {
+  const config = {headers: {'Content-Type': 'application/json'}};
+  return axiosInstance
+    .post(`/api/users/${userId}/delete`, {}, config)
+    .then((res: any) => res.data)
+    .catch((err: Error) => console.error('Error in `deleteUser`:', err));
+};
+
 // === relation endpoints ===
 
+export const fetchFriends = async (cursor?: string): Promise<Page<User>> => {
+  return axiosInstance
+    .get('/api/friends', {params: {cursor}})
+    .then((res: any) => res.data)
+    .catch((err: Error) => console.error('Error in `fetchFriends`:', err));
+};
+
 export const createFriend = async (
   body: CreateRelationRequest,
 ): Promise<[Relation, Relation]> => {
@@ -68,9 +105,11 @@ export const deleteFriend = async (friendId: string): Promise<boolean> => {
 
 // === location endpoints ===
 
-export const fetchLocations = async (): Promise<Location[]> => {
+export const fetchLocations = async (
+  cursor?: string,
+): Promise<Page<Location>> => {
   return axiosInstance
-    .get('/api/locations')
+    .get('/api/locations', {params: {cursor}})
     .then((res: any) => res.data)
     .catch((err: Error) => console.error('Error in `fetchLocations`:', err));
 };
@@ -82,6 +121,29 @@ export const fetchLocation = async (location_id: string): Promise<Location> => {
     .catch((err: Error) => console.error('Error in `fetchLocation`:', err));
 };
 
+export const fetchLocationsBatch = async (
+  ids: string[],
+): Promise<BatchResult<Location>> => {
+  const config = {headers: {'Content-Type': 'application/json'}};
+  const body: BatchGetRequest = {ids};
+  return axiosInstance
+    .post('/api/locations/batch', body, config)
+    .then((res: any) => res.data)
+    .catch((err: Error) =>
+      console.error('Error in `fetchLocationsBatch`:', err),
+    );
+};
+
+export const matchLocations = async (
+  body: MatchLocationRequest,
+): Promise<Location[]> => {
+  const config = {headers: {'Content-Type': 'application/json'}};
+  return axiosInstance
+    .post('/api/locations/match', body, config)
+    .then((res: any) => res.data)
+    .catch((err: Error) => console.error('Error in `matchLocations`:', err));
+};
+
 export const createLocation = async (
   body: CreateLocationRequest,
 ): Promise<Location> => {
@@ -120,6 +182,17 @@ export const fetchEvent = async (eventId: string): Promise<LocationEvent> => {
     .catch((err: Error) => console.error('Error in `fetchEvent`:', err));
 };
 
+export const fetchEventsBatch = async (
+  ids: string[],
+): Promise<BatchResult<LocationEvent>> => {
+  const config = {headers: {'Content-Type': 'application/json'}};
+  const body: BatchGetRequest = {ids};
+  return axiosInstance
+    .post('/api/events/batch', body, config)
+    .then((res: any) => res.data)
+    .catch((err: Error) => console.error('Error in `fetchEventsBatch`:', err));
+};
+
 export const createEvent = async (
   body: CreateEventRequest,
 ): Promise<LocationEvent> => {
@@ -137,3 +210,15 @@ export const deleteEvent = async (eventId: string): Promise<LocationEvent> => {
     .then((res: any) => res.data)
     .catch((err: Error) => console.error('Error in `deleteEvent`:', err));
 };
+
+// === ping endpoints ===
+
+export const createPings = async (
+  body: PingBatchRequest,
+): Promise<LocationEvent[]> => {
+  const config = {headers: {'Content-Type': 'application/json'}};
+  return axiosInstance
+    .post('/api/pings/batch', body, config)
+    .then((res: any) => res.data)
+    .catch((err: Error) => console.error('Error in `createPings`:', err));
+};
@@ -79,6 +79,7 @@ export interface Location {
   height: number;
   tag: string;
   category?: string;
+  cells?: string[];
   createdAt: number;
   updatedAt: number;
 }
@@ -97,8 +98,20 @@ export interface FeedItem {
   event: LocationEvent;
 }
 
+export interface Page<T> {
+  items: T[];
+  nextCursor?: string;
+}
+
+// Batch reads answer every requested id, with null for misses
+export type BatchResult<T> = Record<string, T | null>;
+
 // === requests ===
 
+export interface BatchGetRequest {
+  ids: string[];
+}
+
 export interface CreateUserRequest {
   firstName?: string;
   lastName?: string;
@@ -134,7 +147,22 @@ export interface EditLocationRequest {
   category?: string;
 }
 
+export interface MatchLocationRequest {
+  latitude: number;
+  longitude: number;
+}
+
 export interface CreateEventRequest {
   userId: string;
   locationId: string;
 }
+
+export interface Ping {
+  latitude: number;
+  longitude: number;
+  timestamp: number;
+}
+
+export interface PingBatchRequest {
+  pings: Ping[];
+}